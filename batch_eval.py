@@ -0,0 +1,166 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from threats import B_THREAT_DATA, get_threat_slot
+
+#Value of the cells outside the board in the padded lines, blocking both colors
+BORDER = 3
+#Shortest run of cells holding a threat
+MIN_RUN_LEN = 5
+
+#size -> (n_lines, size + 2) indices of the cells of every line of the four directions
+_LINE_INDICES = {}
+#(weight, priority) of every slot of the threat database, see _get_slot_eval_terms
+_SLOT_EVAL_TERMS = None
+#(forcing weight, nforcing weight) -> score of every slot
+_SLOT_SCORES = {}
+
+def _get_line_indices(size : int) -> np.ndarray:
+    #Flat cell indices of the rows, columns, diagonals and anti-diagonals at least MIN_RUN_LEN long,
+    #with a border cell (index size * size) before and after every line and after the short ones
+    if size not in _LINE_INDICES:
+        border = size * size
+        lines = []
+        lines.extend([[c * size + r for r in range(size)] for c in range(size)])
+        lines.extend([[c * size + r for c in range(size)] for r in range(size)])
+        for d in range(-(size - 1), size):
+            lines.append([c * size + c - d for c in range(size) if 0 <= c - d < size])
+        for s in range(2 * size - 1):
+            lines.append([c * size + s - c for c in range(size) if 0 <= s - c < size])
+        lines = [[border] + line + [border] * (size + 1 - len(line)) for line in lines if len(line) >= MIN_RUN_LEN]
+        _LINE_INDICES[size] = np.array(lines, dtype=np.intp)
+    return _LINE_INDICES[size]
+
+def _get_slot_eval_terms() -> tuple:
+    #The threat of every slot weighs like in BoardState.b_eval: winning threats and empty slots are 0.
+    #The terms are the same for both colors, the table only knows own stones and empty cells.
+    global _SLOT_EVAL_TERMS
+    if _SLOT_EVAL_TERMS is None:
+        weights = np.zeros(len(B_THREAT_DATA.db), dtype=np.intp)
+        priorities = np.zeros(len(B_THREAT_DATA.db), dtype=np.float64)
+        for slot in np.flatnonzero(B_THREAT_DATA.db['n']).tolist():
+            entry = B_THREAT_DATA.table[slot]
+            if entry is False:
+                entry = B_THREAT_DATA.load_slot(slot)
+            _, info, t_class = entry
+            if t_class != 'winning':
+                weights[slot], priorities[slot] = info['eval']
+        _SLOT_EVAL_TERMS = (weights, priorities)
+    return _SLOT_EVAL_TERMS
+
+def _get_slot_scores(t_weights : dict) -> np.ndarray:
+    key = (t_weights['forcing'], t_weights['nforcing'])
+    if key not in _SLOT_SCORES:
+        weights, priorities = _get_slot_eval_terms()
+        _SLOT_SCORES[key] = priorities * np.array([key[0], key[1], 1], dtype=np.float64)[weights]
+    return _SLOT_SCORES[key]
+
+def stack_boards(states : list) -> np.ndarray:
+    #(N, size, size) int8 array of the grids of states: 0 empty, 1 black, 2 white
+    return np.stack([state.grid for state in states]).astype(np.int8)
+
+def gomoku_batch_static_eval(boards : np.ndarray, t_weights : dict) -> np.ndarray:
+    #Static evaluation (version 1, without hooks) of a stack of (N, size, size) boards, the same score
+    #gomoku_state_static_eval gives their BoardState. A threat of BoardState is a maximal run of at
+    #least MIN_RUN_LEN cells free of opponent stones on a line, scored by the pattern of own stones in
+    #it: every line of the four directions is cut in windows of every run length, and the windows
+    #bounded by an opponent stone or the border on both sides are looked up in a table of slot scores.
+    n_boards, size = boards.shape[0], boards.shape[1]
+    slot_scores = _get_slot_scores(t_weights)
+    max_len = min(size, B_THREAT_DATA.max_len)
+
+    flat = np.empty((n_boards, size * size + 1), dtype=np.int8)
+    flat[:, :-1] = boards.reshape(n_boards, size * size)
+    flat[:, -1] = BORDER
+    #(N, lines, size + 2)
+    lines = flat[:, _get_line_indices(size)]
+    line_len = lines.shape[-1]
+
+    scores = np.zeros(n_boards, dtype=np.float64)
+    for stone, opp, sign in ((1, 2, 1), (2, 1, -1)):
+        own = (lines == stone).astype(np.int32)
+        blocked = (lines == opp) | (lines == BORDER)
+        #blocked_count[..., i] is the number of blocked cells before cell i
+        blocked_count = np.zeros(lines.shape[:-1] + (line_len + 1,), dtype=np.int32)
+        np.cumsum(blocked, axis=-1, out=blocked_count[..., 1:])
+        for run_len in range(MIN_RUN_LEN, max_len + 1):
+            #runs starting on cells 1 .. line_len - 1 - run_len, the first and last cells being border
+            n_starts = line_len - 1 - run_len
+            powers = 1 << np.arange(run_len - 1, -1, -1, dtype=np.int32)
+            codes = sliding_window_view(own[..., 1:line_len - 1], run_len, axis=-1) @ powers
+            free = (blocked_count[..., 1 + run_len:line_len] - blocked_count[..., 1:1 + n_starts]) == 0
+            maximal = free & blocked[..., :n_starts] & blocked[..., run_len + 1:line_len]
+            run_scores = slot_scores[get_threat_slot(codes, run_len)]
+            scores += sign * (run_scores * maximal).sum(axis=(1, 2))
+    return scores
+
+
+if __name__ == '__main__':
+    import itertools
+    import random
+    import time
+    from boardstate import BitBoardState
+    from minimax import gomoku_state_static_eval
+
+    T_WEIGHTS = {'forcing' : 100, 'nforcing' : 1}
+
+    def play_random_games(n_games : int, seed : int, size : int = 15, max_moves : int = 120) -> list:
+        rng = random.Random(seed)
+        states = []
+        for _ in range(n_games):
+            state = BitBoardState(size)
+            cells = list(itertools.product(range(size), repeat=2))
+            rng.shuffle(cells)
+            for i, m in enumerate(cells[:rng.randint(0, max_moves)]):
+                state.make_move(m, i % 2 == 0)
+            states.append(state)
+        return states
+
+    def test_matches_static_eval():
+        states = play_random_games(200, 0)
+        for t_weights in (T_WEIGHTS, {'forcing' : 7, 'nforcing' : 3}):
+            scores = gomoku_batch_static_eval(stack_boards(states), t_weights)
+            expected = [gomoku_state_static_eval(state, t_weights) for state in states]
+            assert np.allclose(scores, expected)
+
+    def test_other_sizes():
+        #runs longer than the threat database are skipped by BoardState too
+        for size in (9, 19):
+            states = play_random_games(30, size, size, 2 * size)
+            scores = gomoku_batch_static_eval(stack_boards(states), T_WEIGHTS)
+            assert np.allclose(scores, [gomoku_state_static_eval(state, T_WEIGHTS) for state in states])
+
+    def test_root_children():
+        #scoring every move of a position in one call
+        state = play_random_games(1, 5, max_moves=30)[0]
+        black = len(state.moves) % 2 == 0
+        children = sorted(state.frontier)
+        boards = np.repeat(stack_boards([state]), len(children), axis=0)
+        for i, (c, r) in enumerate(children):
+            boards[i, c, r] = 1 if black else 2
+        scores = gomoku_batch_static_eval(boards, T_WEIGHTS)
+        for i, move in enumerate(children):
+            state.make_move(move, black)
+            assert np.isclose(scores[i], gomoku_state_static_eval(state, T_WEIGHTS))
+            state.unmake_last_move()
+
+    def benchmark_batch_eval(n_boards : int = 1000):
+        #boards per second of one batch call against a loop building a BoardState for every board
+        states = play_random_games(n_boards, 1)
+        boards = stack_boards(states)
+        start = time.time()
+        gomoku_batch_static_eval(boards, T_WEIGHTS)
+        batch_time = time.time() - start
+        start = time.time()
+        for board in boards:
+            state = BitBoardState(board.shape[0])
+            for c, r in zip(*np.nonzero(board)):
+                state.make_move((int(c), int(r)), board[c, r] == 1)
+            gomoku_state_static_eval(state, T_WEIGHTS)
+        loop_time = time.time() - start
+        print('batch: %.0f boards/s\tloop: %.0f boards/s' % (n_boards / batch_time, n_boards / loop_time))
+
+    test_matches_static_eval()
+    test_other_sizes()
+    test_root_children()
+    benchmark_batch_eval()
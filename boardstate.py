@@ -1,6 +1,7 @@
 from copy import copy, deepcopy
 import itertools
 import numpy as np
+import random
 import re
 from tqdm import tqdm
 from utils import *
@@ -9,12 +10,62 @@ B_THREAT_DATA,
 W_THREAT_DATA, 
 Threat, 
 _get_threat_class_from_info, 
+get_threat_slot,
 load_precomputed_threats
 )
 
 BLACK_SEQUENCE_RGX = '[01]{5,}'
 WHITE_SEQUENCE_RGX = '[02]{5,}'
 
+#When True BitBoardState checks every integer-coded threat detection against the regex path
+THREAT_CROSS_CHECK = False
+
+ZOBRIST_SEED = 0x5EED
+_ZOBRIST_TABLES = {}
+
+def get_zobrist_table(size : int) -> tuple:
+    #One random 64-bit key per (cell, color) plus the key xor-ed in when white is to move.
+    #The table only depends on the board size so hashes are stable across processes.
+    if size not in _ZOBRIST_TABLES:
+        rng = random.Random(ZOBRIST_SEED + size)
+        cells = [(rng.getrandbits(64), rng.getrandbits(64)) for _ in range(size * size)]
+        _ZOBRIST_TABLES[size] = (cells, rng.getrandbits(64))
+    return _ZOBRIST_TABLES[size]
+
+
+_INTERSECTION_TABLES = {}
+
+def get_line_intersection_table(size : int) -> dict:
+    #((angle, line), (angle, line)) -> (cell, index of the cell in the first line, in the second one)
+    #for every two lines crossing on a cell of the board. Lines are keyed like the threat index,
+    #indices are positions in the board representation of the line's angle (threat spans).
+    if size not in _INTERSECTION_TABLES:
+        line_stride = size + 2
+        to_index = {0 : cr_to_index, 90 : cr_to_index90, 45 : cr_to_index45, 315 : cr_to_index315}
+        table = {}
+        for c, r in itertools.product(range(size), repeat=2):
+            lines = [(angle, func(c, r, size)) for angle, func in to_index.items()]
+            for (a0, i0), (a1, i1) in itertools.permutations(lines, 2):
+                table[((a0, i0 // line_stride), (a1, i1 // line_stride))] = ((c, r), i0, i1)
+        _INTERSECTION_TABLES[size] = table
+    return _INTERSECTION_TABLES[size]
+
+#Quiet positions generate the empty cells within this (Chebyshev) distance of a stone
+FRONTIER_DISTANCE = 1
+_NEIGHBOUR_TABLES = {}
+
+def get_neighbour_table(size : int, distance : int = FRONTIER_DISTANCE) -> list:
+    #cell index (c * size + r) -> [(cell, cell index)] of the cells within distance of it, itself excluded
+    key = (size, distance)
+    if key not in _NEIGHBOUR_TABLES:
+        table = []
+        for c, r in itertools.product(range(size), repeat=2):
+            table.append([((c + j, r + i), (c + j) * size + r + i) 
+                for j, i in itertools.product(range(-distance, distance + 1), repeat=2)
+                if (j != 0 or i != 0) and 0 <= c + j < size and 0 <= r + i < size])
+        _NEIGHBOUR_TABLES[key] = table
+    return _NEIGHBOUR_TABLES[key]
+
 
 def get_threat_priority_from_type(type : tuple) -> str:
     if type[0] == 5:
@@ -25,6 +76,50 @@ def get_threat_priority_from_type(type : tuple) -> str:
         return 'nforcing'
 
 
+def iter_threats_in_repr(repr : str, black : bool, offset : int = 0, angle : int = 0):
+    rgx = BLACK_SEQUENCE_RGX if black else WHITE_SEQUENCE_RGX
+    t_data = B_THREAT_DATA if black else W_THREAT_DATA
+    for match in re.finditer(rgx, repr):
+        entry = t_data.get_entry(match.group())
+
+        if entry is not None:
+            group, info, t_class = entry
+            span = (match.span()[0] + offset, match.span()[1] - 1 + offset)
+            yield t_class, Threat(group,info,span,angle)
+
+
+def iter_threats_in_line(own : int, opp : int, black : bool, span : tuple, angle : int):
+    #Same result as iter_threats_in_repr without regex or strings: every run of at least 5
+    #cells free of opponent stones is looked up in the dense threat table by its bit pattern.
+    #Line bits are reversed (see BitBoardState), so the lowest bit of a run is its last cell.
+    t_data = B_THREAT_DATA if black else W_THREAT_DATA
+    t_table = t_data.table
+    max_slot = len(t_table)
+    free = ~opp & ((1 << (span[1] - span[0] + 1)) - 1)
+    while free:
+        low = free & -free
+        top = (free + low) & ~free
+        run = top - low
+        free ^= run
+        run_len = top.bit_length() - low.bit_length()
+        if run_len < 5:
+            continue
+
+        shift = low.bit_length() - 1
+        slot = get_threat_slot((own & run) >> shift, run_len)
+        if slot >= max_slot:
+            continue
+        entry = t_table[slot]
+        if entry is False:
+            entry = t_data.load_slot(slot)
+        if entry is None:
+            continue
+
+        group, info, t_class = entry
+        end = span[1] - shift
+        yield t_class, Threat(group, info, (end - run_len + 1, end), angle)
+
+
 #-----------------------------------------------------------------------------------------
 #////////////////////////////////////////////////////////////////////////////////////////
 #-----------------------------------------------------------------------------------------
@@ -47,57 +142,185 @@ class BoardState:
             board = np.full((self.size + 2, self.size + 2), 3, dtype='int8')
             board[1:self.size + 1,1:self.size + 1] = 0
             self.grid = board[1:self.size+1, 1:self.size+1]
+            self._init_boards(board)
 
-            board_45 = rot45(board)
-            board_45 = board_45[2:2 * self.size + 1,:]
-            board_315 = rot315(board)
-            board_315 = board_315[2:2 * self.size + 1,:]
-            board = board[1:self.size+1,:]
-
-            self.board = ''.join([str(el) for el in board.flatten()])
-            self.board_45 = ''.join([str(el) for el in board_45.flatten()])
-            self.board_90 = ''.join([str(el) for el in board.flatten()])
-            self.board_315 = ''.join([str(el) for el in board_315.flatten()])
+            self.zobrist_cells, self.zobrist_white_to_move = get_zobrist_table(self.size)
+            self.zobrist_key = 0
 
             self.w_threats = {'winning' : set(), 'forcing' : set(), 'nforcing' : set()}
             self.b_threats = {'winning' : set(), 'forcing' : set(), 'nforcing' : set()}
-            self.threat_updates = {}
+            #one (added, removed) record of (black, bucket, threat) entries per move
+            self.threat_updates = []
+            #(angle, line) -> [(bucket, threat)] for the threats lying on that line
+            self.b_threat_index = {}
+            self.w_threat_index = {}
+            #sums of the priorities of the forcing and non forcing threats by evaluation weight
+            #(see threats.get_threat_eval_terms), updated whenever a threat is added or removed
+            self.b_eval = [0, 0, 0]
+            self.w_eval = [0, 0, 0]
+            #forcing threat -> the forcing threats it forms a hook with (they cross on one of
+            #our stones), kept up to date together with the threats
+            self.b_hooks = {}
+            self.w_hooks = {}
+            #sums of the products of the two threat priorities of each hook, by pair of evaluation
+            #weights ([i][j] with i <= j)
+            self.b_hook_eval = [[0, 0, 0] for _ in range(3)]
+            self.w_hook_eval = [[0, 0, 0] for _ in range(3)]
+            self.intersections = get_line_intersection_table(self.size)
+            #empty cells within FRONTIER_DISTANCE of a stone, and the number of stones near each cell
+            self.n_stones = 0
+            self.frontier = set()
+            self.near_stones = [0] * (self.size * self.size)
+            self.neighbours = get_neighbour_table(self.size)
     
+    def _init_boards(self, board : np.array):
+        board_45 = rot45(board)
+        board_45 = board_45[2:2 * self.size + 1,:]
+        board_315 = rot315(board)
+        board_315 = board_315[2:2 * self.size + 1,:]
+        board = board[1:self.size+1,:]
+
+        self.board = ''.join([str(el) for el in board.flatten()])
+        self.board_45 = ''.join([str(el) for el in board_45.flatten()])
+        self.board_90 = ''.join([str(el) for el in board.flatten()])
+        self.board_315 = ''.join([str(el) for el in board_315.flatten()])
+
     def make_move(self,move,is_black):
         self.grid[move[0], move[1]] = 1 if is_black else 2 
         stone = '1' if is_black else '2' 
+        self.zobrist_key ^= self.zobrist_cells[move[0] * self.size + move[1]][0 if is_black else 1]
         self._update_boards(move, stone)
-        #self._update_threats(move, is_black)
-        self._update_threats(move)
+        self.threat_updates.append(self._update_threats(move))
         self.moves.append((*move,is_black))
 
+        self.n_stones += 1
+        self.frontier.discard((move[0], move[1]))
+        near_stones = self.near_stones
+        for cell, i in self.neighbours[move[0] * self.size + move[1]]:
+            near_stones[i] += 1
+            if near_stones[i] == 1 and self.grid[cell] == 0:
+                self.frontier.add(cell)
+
+    def is_full(self) -> bool:
+        return self.n_stones >= self.size * self.size
+
     def get_hooks(self,
                 maximize : bool):
+        hooks = self.b_hooks if maximize else self.w_hooks
+        pairs = []
+        seen = set()
+        for t0, partners in hooks.items():
+            seen.add(t0)
+            pairs.extend([(t0, t1) for t1 in partners if t1 not in seen])
+        return pairs
+
+    def find_hooks(self, maximize : bool) -> list:
+        #same hooks as get_hooks, found by checking every pair of forcing threats
         p_threats = self.b_threats if maximize else self.w_threats
-        #p_threat_list = [t for t in p_threats['nforcing'] if t.info['type'][0] >= 2]
-        p_threat_list = [t for t in p_threats['forcing']]
-        hooks = []
-        for t0, t1 in itertools.combinations(p_threat_list,r=2):
-            p0,p1 = t0.get_grid_span()
-            q0,q1 = t1.get_grid_span()
-            intersect = line_intersect(p0,p1,q0,q1)
-            if intersect is not None:
-                intersect = (int(intersect[0]),int(intersect[1]))
-                if intersect[0] > 14 or intersect[1] > 14:
-                    raise Exception(f'Intersection point out of bounds {intersect}')
-                if maximize and self.grid[intersect[0], intersect[1]] == 1:
-                    hooks.append((t0,t1))
-                elif not maximize and self.grid[intersect[0], intersect[1]] == 2:
-                    hooks.append((t0,t1))
-        return hooks
-
+        return [(t0, t1) for t0, t1 in itertools.combinations(p_threats['forcing'], r=2) 
+                if self._is_hook(t0, t1, maximize)]
+
+    def _is_hook(self, t0 : Threat, t1 : Threat, black : bool) -> bool:
+        line_stride = self.size + 2
+        crossing = self.intersections.get(((t0.angle, t0.span[0] // line_stride), (t1.angle, t1.span[0] // line_stride)))
+        if crossing is None:
+            return False
+        cell, i0, i1 = crossing
+        if i0 < t0.span[0] or i0 > t0.span[1] or i1 < t1.span[0] or i1 > t1.span[1]:
+            return False
+        return self.grid[cell[0], cell[1]] == (1 if black else 2)
+
+    def _add_hooks(self, black : bool, t : Threat):
+        #t has just been added to the forcing threats of black (white)
+        hooks = self.b_hooks if black else self.w_hooks
+        for other in (self.b_threats if black else self.w_threats)['forcing']:
+            if other != t and self._is_hook(t, other, black):
+                hooks.setdefault(t, set()).add(other)
+                hooks.setdefault(other, set()).add(t)
+                self._update_hook_eval(black, t, other, 1)
+
+    def _remove_hooks(self, black : bool, t : Threat):
+        hooks = self.b_hooks if black else self.w_hooks
+        for other in hooks.pop(t, ()):
+            partners = hooks[other]
+            partners.discard(t)
+            if len(partners) == 0:
+                del hooks[other]
+            self._update_hook_eval(black, t, other, -1)
+
+    def _update_hook_eval(self, black : bool, t0 : Threat, t1 : Threat, sign : int):
+        w0, p0 = t0.info['eval']
+        w1, p1 = t1.info['eval']
+        hook_eval = self.b_hook_eval if black else self.w_hook_eval
+        hook_eval[min(w0, w1)][max(w0, w1)] += sign * p0 * p1
+
+    def _build_hooks(self):
+        for black in (True, False):
+            hooks = self.b_hooks if black else self.w_hooks
+            hooks.clear()
+            for row in (self.b_hook_eval if black else self.w_hook_eval):
+                row[:] = [0, 0, 0]
+            for t0, t1 in self.find_hooks(black):
+                hooks.setdefault(t0, set()).add(t1)
+                hooks.setdefault(t1, set()).add(t0)
+                self._update_hook_eval(black, t0, t1, 1)
+
+    def hash(self, black_to_move : bool = None) -> int:
+        #By default the side to move is the opposite of the last stone placed (black on an empty board).
+        #Search code that alternates colors on its own passes the side explicitly.
+        if black_to_move is None:
+            black_to_move = len(self.moves) == 0 or not self.moves[-1][2]
+        if black_to_move:
+            return self.zobrist_key
+        return self.zobrist_key ^ self.zobrist_white_to_move
 
     def unmake_last_move(self):
-        c,r,_ = self.moves.pop()
+        c,r,is_black = self.moves.pop()
 
+        self.zobrist_key ^= self.zobrist_cells[c * self.size + r][0 if is_black else 1]
         self.grid[c, r] = 0
         self._update_boards((c,r), '0')
-        self._update_threats((c,r))
+        self._restore_threats(self.threat_updates.pop())
+
+        self.n_stones -= 1
+        near_stones = self.near_stones
+        for cell, i in self.neighbours[c * self.size + r]:
+            near_stones[i] -= 1
+            if near_stones[i] == 0:
+                self.frontier.discard(cell)
+        if near_stones[c * self.size + r] > 0:
+            self.frontier.add((c, r))
+
+    def _restore_threats(self, update : tuple):
+        #make_move replaces all the threats on the four lines through the move,
+        #so dropping the lines of the added threats empties their index entries
+        added, removed = update
+        line_stride = self.size + 2
+        for black, bucket, t in added:
+            (self.b_threats if black else self.w_threats)[bucket].discard(t)
+            (self.b_threat_index if black else self.w_threat_index).pop((t.angle, t.span[0] // line_stride), None)
+            if bucket != 'winning':
+                weight, priority = t.info['eval']
+                (self.b_eval if black else self.w_eval)[weight] -= priority
+            if bucket == 'forcing':
+                self._remove_hooks(black, t)
+        for black, bucket, t in removed:
+            (self.b_threats if black else self.w_threats)[bucket].add(t)
+            index = self.b_threat_index if black else self.w_threat_index
+            index.setdefault((t.angle, t.span[0] // line_stride), []).append((bucket, t))
+            if bucket != 'winning':
+                weight, priority = t.info['eval']
+                (self.b_eval if black else self.w_eval)[weight] += priority
+            if bucket == 'forcing':
+                self._add_hooks(black, t)
+
+    def _build_threat_index(self):
+        line_stride = self.size + 2
+        for threats, index in ((self.b_threats, self.b_threat_index), (self.w_threats, self.w_threat_index)):
+            index.clear()
+            for bucket, ts in threats.items():
+                for t in ts:
+                    index.setdefault((t.angle, t.span[0] // line_stride), []).append((bucket, t))
 
     # def get_all_threats(self, black : bool) -> tuple:         
     #     raise NotImplementedError()
@@ -114,62 +337,72 @@ class BoardState:
         else:
             raise Exception('invalid angle value %d' % (angle))
 
-    def _prune_old_threats(self, spans : tuple, black : bool):
+    def _prune_old_threats(self, spans : tuple, black : bool, removed : list):
+        #only the threats indexed on the lines through the move are touched
         pthreats = self.b_threats if black else self.w_threats
-        to_remove = set()
-        removed = set()
-        for type, ts in pthreats.items():
-            for t in ts:
-                s = spans[t.angle]
-                if t.span[0] >= s[0] and t.span[0] < s[1]:
-                    to_remove.add(t)
-                if t.span[1] > s[0] and t.span[1] <= s[1]:
-                    to_remove.add(t)                    
-            ts.difference_update(to_remove)
-            removed.update([(tr,type) for tr in to_remove])   
-        
-        return removed
-
-    def _find_threats_intersecting(self, lines : dict,  spans : dict, black : bool):
+        index = self.b_threat_index if black else self.w_threat_index
+        t_eval = self.b_eval if black else self.w_eval
+        line_stride = self.size + 2
+        for angle, s in spans.items():
+            entries = index.pop((angle, s[0] // line_stride), None)
+            if entries is None:
+                continue
+            for type, t in entries:
+                pthreats[type].discard(t)
+                removed.append((black,type,t))
+                if type != 'winning':
+                    weight, priority = t.info['eval']
+                    t_eval[weight] -= priority
+                if type == 'forcing':
+                    self._remove_hooks(black, t)
+
+    def _find_threats_intersecting(self, lines : dict,  spans : dict, black : bool, added : list):
         ts = self.b_threats if black else self.w_threats
         for angle, line in lines.items():
-            self._get_threats_in_repr(ts, line, black, spans[angle][0], angle)
+            self._get_threats_in_repr(ts, line, black, spans[angle][0], angle, added)
 
-    def _update_threats(self,last_move):
-        #check new threats in intersecting lines
-        span, line = self._get_line(last_move)
-        span90, line90 = self._get_line90(last_move)
-        span45, line45 = self._get_line45(last_move)
-        span315, line315 = self._get_line315(last_move)
+    def _get_lines_through(self, pos : tuple) -> tuple:
+        span, line = self._get_line(pos)
+        span90, line90 = self._get_line90(pos)
+        span45, line45 = self._get_line45(pos)
+        span315, line315 = self._get_line315(pos)
 
         spans = {0 : span, 45 : span45, 90 : span90, 315 : span315}
         lines = {0 : line, 45 : line45, 90 : line90, 315 : line315}
-
-        self._prune_old_threats(spans, True)
-        self._prune_old_threats(spans, False)   
-
-        self._find_threats_intersecting(lines,spans,True)
-        self._find_threats_intersecting(lines,spans,False)
-
-
-    def _get_threats_in_repr(self, dst : dict,  repr : str, black : bool, offset : int = 0, angle : int = 0):
-        rgx = BLACK_SEQUENCE_RGX if black else WHITE_SEQUENCE_RGX
-        t_info = B_THREAT_DATA if black else W_THREAT_DATA
-        for match in re.finditer(rgx, repr):
-            group = match.group()
-            l = len(group)            
-
-            if group in t_info:
-                info = t_info[group]                
-                span = (match.span()[0] + offset, match.span()[1] - 1 + offset)
-                threat = Threat(group,info,span,angle)
-                t_class = _get_threat_class_from_info(info)
-                if t_class == 'winning':
-                    dst['winning'].add(threat)
-                elif t_class == 'forcing':
-                    dst['forcing'].add(threat)
-                else:
-                    dst['nforcing'].add(threat)    
+        return spans, lines
+
+    def _update_threats(self,last_move) -> tuple:
+        #check new threats in intersecting lines and return what changed so that
+        #unmake_last_move can restore it without scanning
+        spans, lines = self._get_lines_through(last_move)
+        added = []
+        removed = []
+
+        self._prune_old_threats(spans, True, removed)
+        self._prune_old_threats(spans, False, removed)   
+
+        self._find_threats_intersecting(lines,spans,True,added)
+        self._find_threats_intersecting(lines,spans,False,added)
+        return added, removed
+
+
+    def _get_threats_in_repr(self, dst : dict,  repr : str, black : bool, offset : int = 0, angle : int = 0, added : list = None):
+        index = self.b_threat_index if black else self.w_threat_index
+        line_key = (angle, offset // (self.size + 2))
+        t_eval = self.b_eval if black else self.w_eval
+        for t_class, threat in iter_threats_in_repr(repr, black, offset, angle):
+            ts = dst[t_class]
+            n_threats = len(ts)
+            ts.add(threat)
+            if len(ts) > n_threats:
+                index.setdefault(line_key, []).append((t_class, threat))
+                if t_class != 'winning':
+                    weight, priority = threat.info['eval']
+                    t_eval[weight] += priority
+                if t_class == 'forcing':
+                    self._add_hooks(black, threat)
+                if added is not None:
+                    added.append((black, t_class, threat))
 
     def _get_threats(self, black : bool):
         threats = self.b_threats if black else self.w_threats
@@ -233,36 +466,260 @@ class BoardState:
         self.board_45 = replace_char(self.board_45, cr_to_index45(c,r, self.size), stone)
         self.board_315 = replace_char(self.board_315, cr_to_index315(c,r, self.size), stone)
 
+    def _copy_boards(self, bcopy):
+        bcopy.board = self.board[:]
+        bcopy.board_45 = self.board_45[:]
+        bcopy.board_90 = self.board_90[:]
+        bcopy.board_315 = self.board_315[:]
+
+#-----------------------------------------------------------------------------------------
+#////////////////////////////////////////////////////////////////////////////////////////
+#-----------------------------------------------------------------------------------------
+#BITBOARD STATE CLASS
+#-----------------------------------------------------------------------------------------
+#////////////////////////////////////////////////////////////////////////////////////////
+#-----------------------------------------------------------------------------------------
+
+ANGLES = (0, 45, 90, 315)
+_BITBOARD_TABLES = {}
+
+def _get_bitboard_tables(size : int) -> tuple:
+    #Every line of every angle gets a key in a flat list of bitmasks. Lines are the rows
+    #of the string representations, so spans and threat offsets are the same as in BoardState.
+    #Bits are stored in reverse order so that formatting a line as hex gives back
+    #its string representation directly.
+    if size in _BITBOARD_TABLES:
+        return _BITBOARD_TABLES[size]
+
+    index_funcs = {0 : cr_to_index, 45 : cr_to_index45, 90 : cr_to_index90, 315 : cr_to_index315}
+    bounds = {}
+    for slot, angle in enumerate(ANGLES):
+        for c,r in itertools.product(range(size), repeat=2):
+            index = index_funcs[angle](c, r, size)
+            key = slot * 2 * size + index // (size + 2)
+            start, end = bounds.get(key, (index, index))
+            bounds[key] = (min(start, index), max(end, index))
+
+    line_info = {key : (ANGLES[key // (2 * size)], span, '0%dx' % (span[1] - span[0] + 1)) 
+                for key, span in bounds.items()}
+
+    cell_lines = {}
+    for c,r in itertools.product(range(size), repeat=2):
+        entries = []
+        for slot, angle in enumerate(ANGLES):
+            index = index_funcs[angle](c, r, size)
+            key = slot * 2 * size + index // (size + 2)
+            _, span, fmt = line_info[key]
+            entries.append((angle, key, 1 << (span[1] - index), span, fmt))
+        cell_lines[(c,r)] = tuple(entries)
+
+    #spread[m] places bit i of m in the lowest bit of nibble i
+    spread = [0] * (1 << size)
+    for m in range(1, 1 << size):
+        spread[m] = (spread[m >> 1] << 4) | (m & 1)
+
+    _BITBOARD_TABLES[size] = (line_info, cell_lines, spread)
+    return _BITBOARD_TABLES[size]
+
+class BitBoardState(BoardState):
+    def _init_boards(self, board : np.array):
+        self.line_info, self.cell_lines, self.spread = _get_bitboard_tables(self.size)
+        self.b_lines = [0] * (8 * self.size)
+        self.w_lines = [0] * (8 * self.size)
+
+    def print_boards(self):
+        for angle in ANGLES:
+            print(np.array([list(self._get_line_repr(key)) 
+            for key in sorted(self.line_info) if self.line_info[key][0] == angle]))
+
+    def _get_line_repr(self, key : int) -> str:
+        spread = self.spread
+        return format(spread[self.b_lines[key]] | (spread[self.w_lines[key]] << 1), self.line_info[key][2])
+
+    def _get_line_from_angle(self, pos : tuple, angle : int) -> tuple:
+        for a, key, _, span, _ in self.cell_lines[tuple(pos)]:
+            if a == angle:
+                return span, self._get_line_repr(key)
+
+    def _get_line(self, pos:tuple) -> tuple:
+        return self._get_line_from_angle(pos, 0)
+
+    def _get_line90(self, pos:tuple) -> tuple:
+        return self._get_line_from_angle(pos, 90)
+
+    def _get_line45(self, pos : tuple) -> tuple:
+        return self._get_line_from_angle(pos, 45)
+
+    def _get_line315(self, pos : tuple) -> tuple:
+        return self._get_line_from_angle(pos, 315)
+
+    def _get_lines_through(self, pos : tuple) -> tuple:
+        spread = self.spread
+        b_lines = self.b_lines
+        w_lines = self.w_lines
+        spans = {}
+        lines = {}
+        for angle, key, _, span, fmt in self.cell_lines[tuple(pos)]:
+            spans[angle] = span
+            lines[angle] = format(spread[b_lines[key]] | (spread[w_lines[key]] << 1), fmt)
+        return spans, lines
+
+    def _update_threats(self, last_move) -> tuple:
+        entries = self.cell_lines[tuple(last_move)]
+        spans = {angle : span for angle, _, _, span, _ in entries}
+        added = []
+        removed = []
+
+        self._prune_old_threats(spans, True, removed)
+        self._prune_old_threats(spans, False, removed)
+
+        for angle, key, _, span, _ in entries:
+            b_line = self.b_lines[key]
+            w_line = self.w_lines[key]
+            self._get_threats_in_line(b_line, w_line, True, span, angle, added)
+            self._get_threats_in_line(w_line, b_line, False, span, angle, added)
+
+        if THREAT_CROSS_CHECK:
+            self._cross_check_threats(entries)
+        return added, removed
+
+    def _get_threats_in_line(self, own : int, opp : int, black : bool, span : tuple, angle : int, added : list = None):
+        dst = self.b_threats if black else self.w_threats
+        index = self.b_threat_index if black else self.w_threat_index
+        line_key = (angle, span[0] // (self.size + 2))
+        t_eval = self.b_eval if black else self.w_eval
+        for t_class, threat in iter_threats_in_line(own, opp, black, span, angle):
+            ts = dst[t_class]
+            n_threats = len(ts)
+            ts.add(threat)
+            if len(ts) > n_threats:
+                index.setdefault(line_key, []).append((t_class, threat))
+                if t_class != 'winning':
+                    weight, priority = threat.info['eval']
+                    t_eval[weight] += priority
+                if t_class == 'forcing':
+                    self._add_hooks(black, threat)
+                if added is not None:
+                    added.append((black, t_class, threat))
+
+    def _cross_check_threats(self, entries : tuple):
+        line_stride = self.size + 2
+        for black in (True, False):
+            index = self.b_threat_index if black else self.w_threat_index
+            for angle, key, _, span, _ in entries:
+                line = self._get_line_repr(key)
+                expected = {(t_class, str(t)) for t_class, t in iter_threats_in_repr(line, black, span[0], angle)}
+                found = {(t_class, str(t)) for t_class, t in index.get((angle, span[0] // line_stride), [])}
+                assert found == expected, 'integer threat detection differs from regex on line %s: %s != %s' % (
+                    line, found, expected)
+
+    def _update_boards(self, move, stone):
+        b_lines = self.b_lines
+        w_lines = self.w_lines
+        if stone == '1':
+            for _, key, bit, _, _ in self.cell_lines[tuple(move)]:
+                b_lines[key] |= bit
+        elif stone == '2':
+            for _, key, bit, _, _ in self.cell_lines[tuple(move)]:
+                w_lines[key] |= bit
+        else:
+            for _, key, bit, _, _ in self.cell_lines[tuple(move)]:
+                b_lines[key] &= ~bit
+                w_lines[key] &= ~bit
+
+    def _copy_boards(self, bcopy):
+        bcopy.line_info = self.line_info
+        bcopy.cell_lines = self.cell_lines
+        bcopy.spread = self.spread
+        bcopy.b_lines = self.b_lines[:]
+        bcopy.w_lines = self.w_lines[:]
+
 def deepcopy_boardstate(bstate: BoardState) -> BoardState:
-    bcopy = BoardState(copy_instance=True)
+    bcopy = bstate.__class__(copy_instance=True)
     
     bcopy.size = bstate.size
     bcopy.moves = bstate.moves[:]
 
     bcopy.grid = np.copy(bstate.grid)
-    bcopy.board = bstate.board[:]
-    bcopy.board_45 = bstate.board_45[:]
-    bcopy.board_90 = bstate.board_90[:]
-    bcopy.board_315 = bstate.board_315[:]
+    bstate._copy_boards(bcopy)
+
+    bcopy.zobrist_cells = bstate.zobrist_cells
+    bcopy.zobrist_white_to_move = bstate.zobrist_white_to_move
+    bcopy.zobrist_key = bstate.zobrist_key
 
     bcopy.b_threats = deepcopy(bstate.b_threats)
     bcopy.w_threats = deepcopy(bstate.w_threats)
+    bcopy.threat_updates = bstate.threat_updates[:]
+    bcopy.b_eval = bstate.b_eval[:]
+    bcopy.w_eval = bstate.w_eval[:]
+    bcopy.b_hooks = {}
+    bcopy.w_hooks = {}
+    bcopy.b_hook_eval = [[0, 0, 0] for _ in range(3)]
+    bcopy.w_hook_eval = [[0, 0, 0] for _ in range(3)]
+    bcopy.intersections = bstate.intersections
+    bcopy.n_stones = bstate.n_stones
+    bcopy.frontier = set(bstate.frontier)
+    bcopy.near_stones = bstate.near_stones[:]
+    bcopy.neighbours = bstate.neighbours
+    bcopy.b_threat_index = {}
+    bcopy.w_threat_index = {}
+    bcopy._build_threat_index()
+    bcopy._build_hooks()
     return bcopy
 
 
 if __name__ == '__main__':
     from time import time
     
-    def test_time_make_unmake():
-        bstate = BoardState(15)
+    def test_time_make_unmake(state_type = BoardState, iterations : int = 1000000) -> float:
+        bstate = state_type(15)
         moves = [(i + 2,i)  for i in range(10)]    
         start = time()
-        for _ in tqdm(range(1000000)):
+        for _ in tqdm(range(iterations)):
             for m in moves:
                 bstate.make_move(m, True)
             for _ in range(len(moves)):
                 bstate.unmake_last_move()
-        print('elapsed time:', round(time() - start,4))
+        elapsed = time() - start
+        print('elapsed time:', round(elapsed,4))
+        return elapsed
+
+    def benchmark_make_unmake(iterations : int = 2000):
+        before = test_time_make_unmake(BoardState, iterations)
+        after = test_time_make_unmake(BitBoardState, iterations)
+        print('BoardState: %.2f us per make/unmake' % (before / (iterations * 10) * 1e6))
+        print('BitBoardState: %.2f us per make/unmake' % (after / (iterations * 10) * 1e6))
+        print('speedup: %.2fx' % (before / after))
+
+    def threat_strings(bstate : BoardState) -> tuple:
+        return tuple({k : {str(t) for t in ts} for k,ts in threats.items()} 
+                    for threats in (bstate.b_threats, bstate.w_threats))
+
+    def index_strings(bstate : BoardState) -> tuple:
+        return tuple({k : {(b, str(t)) for b,t in entries} for k,entries in index.items()} 
+                    for index in (bstate.b_threat_index, bstate.w_threat_index))
+
+    def hook_strings(hooks : list) -> set:
+        return {frozenset((str(t0), str(t1))) for t0, t1 in hooks}
+
+    def test_bitboard_threats():
+        import random
+        random.seed(0)
+        for _ in range(20):
+            bstate = BoardState(15)
+            bbstate = BitBoardState(15)
+            cells = list(itertools.product(range(15), repeat=2))
+            random.shuffle(cells)
+            for i,m in enumerate(cells[:60]):
+                bstate.make_move(m, i % 2 == 0)
+                bbstate.make_move(m, i % 2 == 0)
+                assert threat_strings(bstate) == threat_strings(bbstate)
+                for key, (angle, span, _) in bbstate.line_info.items():
+                    assert bbstate._get_line_repr(key) == bstate._get_repr_from_angle(angle)[span[0] : span[1] + 1]
+            for _ in range(60):
+                bstate.unmake_last_move()
+                bbstate.unmake_last_move()
+                assert threat_strings(bstate) == threat_strings(bbstate)
 
     def test_deep_copy():
         start = time()
@@ -296,81 +753,186 @@ if __name__ == '__main__':
         assert bstate.b_threats != bcopy.b_threats
         assert bstate.w_threats == bcopy.w_threats
 
+    def test_zobrist_hash():
+        bstate = BitBoardState(15)
+        empty_hash = bstate.hash()
+        bstate.make_move((7,7), True)
+        bstate.make_move((7,8), False)
+        bstate.make_move((8,8), True)
+        h = bstate.hash()
+        assert h != empty_hash
+        assert bstate.hash(True) != bstate.hash(False)
+
+        #same position reached through a different move order
+        other = BoardState(15)
+        other.make_move((8,8), True)
+        other.make_move((7,8), False)
+        other.make_move((7,7), True)
+        assert other.hash() == h
+        assert deepcopy_boardstate(other).hash() == h
+
+        for _ in range(3):
+            bstate.unmake_last_move()
+        assert bstate.hash() == empty_hash
+        assert bstate.zobrist_key == 0
+
+    def test_unmake_restores_threats():
+        import random
+        random.seed(1)
+        cells = list(itertools.product(range(15), repeat=2))
+        random.shuffle(cells)
+        bstate = BoardState(15)
+        for i,m in enumerate(cells[:50]):
+            bstate.make_move(m, i % 3 != 0)
+        while len(bstate.moves) > 0:
+            bstate.unmake_last_move()
+            replayed = BoardState(15)
+            for c,r,is_black in bstate.moves:
+                replayed.make_move((c,r), is_black)
+            assert threat_strings(bstate) == threat_strings(replayed)
+            assert index_strings(bstate) == index_strings(replayed)
+            assert bstate.b_eval == replayed.b_eval and bstate.w_eval == replayed.w_eval
+            assert bstate.b_hook_eval == replayed.b_hook_eval and bstate.w_hook_eval == replayed.w_hook_eval
+            for black in (True, False):
+                assert hook_strings(bstate.get_hooks(black)) == hook_strings(replayed.get_hooks(black))
+                assert hook_strings(bstate.get_hooks(black)) == hook_strings(bstate.find_hooks(black))
+        assert len(bstate.threat_updates) == 0
+        assert len(bstate.b_threat_index) == 0 and len(bstate.w_threat_index) == 0
+        assert len(bstate.b_hooks) == 0 and len(bstate.w_hooks) == 0
+
+    def benchmark_make_unmake_by_stones(state_type = BoardState, 
+                                        stone_counts : tuple = (10, 30, 50, 70, 90, 110), 
+                                        repetitions : int = 200):
+        import random
+        random.seed(2)
+        cells = list(itertools.product(range(15), repeat=2))
+        random.shuffle(cells)
+        bstate = state_type(15)
+        placed = 0
+        for n_stones in stone_counts:
+            while placed < n_stones:
+                bstate.make_move(cells[placed], placed % 2 == 0)
+                placed += 1
+            empty = [m for m in itertools.product(range(15), repeat=2) if bstate.grid[m] == 0]
+            n_threats = sum([len(ts) for ts in bstate.b_threats.values()]) + sum([len(ts) for ts in bstate.w_threats.values()])
+            start = time()
+            for i in range(repetitions):
+                bstate.make_move(empty[i % len(empty)], True)
+                bstate.unmake_last_move()
+            elapsed = (time() - start) / repetitions
+            print('stones: %3d\tthreats: %3d\tmake/unmake: %.1f us' % (n_stones, n_threats, elapsed * 1e6))
+
+    def cross_check_threat_engine(n_games : int = 20, n_moves : int = 80):
+        global THREAT_CROSS_CHECK
+        import random
+        random.seed(3)
+        THREAT_CROSS_CHECK = True
+        for _ in range(n_games):
+            bbstate = BitBoardState(15)
+            bstate = BoardState(15)
+            cells = list(itertools.product(range(15), repeat=2))
+            random.shuffle(cells)
+            for i,m in enumerate(cells[:n_moves]):
+                bbstate.make_move(m, random.random() < 0.5)
+                bstate.make_move(m, bbstate.moves[-1][2])
+            assert threat_strings(bstate) == threat_strings(bbstate)
+        THREAT_CROSS_CHECK = False
+
+    def benchmark_threat_detection(repetitions : int = 200):
+        import random
+        random.seed(4)
+        bbstate = BitBoardState(15)
+        cells = list(itertools.product(range(15), repeat=2))
+        random.shuffle(cells)
+        for i,m in enumerate(cells[:60]):
+            bbstate.make_move(m, i % 2 == 0)
+        lines = [(angle, key, span) for key,(angle, span, _) in bbstate.line_info.items()]
+        reprs = [(angle, bbstate._get_line_repr(key), span) for angle, key, span in lines]
+
+        n_threats = sum([len(list(iter_threats_in_repr(line, black, span[0], angle))) 
+                        for angle, line, span in reprs for black in (True, False)])
+
+        #the regex path also pays for rendering each line as a string
+        start = time()
+        for _ in range(repetitions):
+            for angle, key, span in lines:
+                line = bbstate._get_line_repr(key)
+                for black in (True, False):
+                    for _ in iter_threats_in_repr(line, black, span[0], angle):
+                        pass
+        regex_time = time() - start
+
+        start = time()
+        for _ in range(repetitions):
+            for angle, key, span in lines:
+                b_line = bbstate.b_lines[key]
+                w_line = bbstate.w_lines[key]
+                for _ in iter_threats_in_line(b_line, w_line, True, span, angle):
+                    pass
+                for _ in iter_threats_in_line(w_line, b_line, False, span, angle):
+                    pass
+        int_time = time() - start
+        print('regex threat detection: %d lines/s, %d threats/s' % (
+            repetitions * len(lines) * 2 / regex_time, repetitions * n_threats / regex_time))
+        print('integer threat detection: %d lines/s, %d threats/s' % (
+            repetitions * len(lines) * 2 / int_time, repetitions * n_threats / int_time))
+
+    def test_frontier(state_type = BitBoardState):
+        def scan_frontier(bstate : BoardState) -> set:
+            stones = np.argwhere(bstate.grid != 0)
+            return {(c, r) for c, r in itertools.product(range(bstate.size), repeat=2)
+                    if bstate.grid[c, r] == 0 and any(max(abs(c - sc), abs(r - sr)) <= FRONTIER_DISTANCE for sc, sr in stones)}
+
+        rng = random.Random(5)
+        cells = list(itertools.product(range(9), repeat=2))
+        rng.shuffle(cells)
+        bstate = state_type(9)
+        assert len(bstate.frontier) == 0 and not bstate.is_full()
+        for i, m in enumerate(cells):
+            bstate.make_move(m, i % 2 == 0)
+            assert bstate.frontier == scan_frontier(bstate) and bstate.n_stones == i + 1
+            if i == 30:
+                bcopy = deepcopy_boardstate(bstate)
+        assert bstate.is_full() and len(bstate.frontier) == 0
+        while len(bstate.moves) > 31:
+            bstate.unmake_last_move()
+            assert bstate.frontier == scan_frontier(bstate)
+        assert bstate.frontier == bcopy.frontier and bstate.n_stones == bcopy.n_stones == 31
+        bcopy.make_move(next(iter(bcopy.frontier)), True)
+        assert bstate.frontier != bcopy.frontier and bstate.near_stones != bcopy.near_stones
+
+    def test_line_intersection_table():
+        for size in (9, 15, 19):
+            table = get_line_intersection_table(size)
+            #every cell lies on 4 lines, so on 12 ordered pairs of them
+            assert len(table) == 12 * size * size
+            for (line0, line1), (cell, i0, i1) in table.items():
+                assert table[(line1, line0)] == (cell, i1, i0)
+        #the crossing indices map back to the crossing cell (the transforms assume size 15)
+        for ((a0, _), (a1, _)), (cell, i0, i1) in get_line_intersection_table(15).items():
+            assert cell == get_index_transform_func(a0)(i0) == get_index_transform_func(a1)(i1)
+
+        #a hook found on copies too: two open threes crossing on (7, 7)
+        bstate = BitBoardState(15)
+        for i, m in enumerate([(7, 7), (0, 0), (7, 6), (0, 14), (6, 7), (14, 0), (7, 8), (14, 14), (8, 7)]):
+            bstate.make_move(m, i % 2 == 0)
+        assert len(bstate.get_hooks(True)) == 1 and len(bstate.get_hooks(False)) == 0
+        bcopy = deepcopy_boardstate(bstate)
+        assert hook_strings(bcopy.get_hooks(True)) == hook_strings(bstate.get_hooks(True))
+        assert bcopy.b_hook_eval == bstate.b_hook_eval
+
     def test_get_threat_priority_from_type():
         pass
 
     test_deep_copy()
     test_deep_copy2()
-
-
-
-
-
-            
-
-
-    # def _update_threats(self, last_move : tuple, black : bool):                
-    #     #check new threats in intersecting lines
-    #     span, line = self._get_line(last_move)
-    #     span90, line90 = self._get_line90(last_move)
-    #     span45, line45 = self._get_line45(last_move)
-    #     span315, line315 = self._get_line315(last_move)
-
-    #     spans = {0 : span, 45 : span45, 90 : span90, 315 : span315}
-    #     self.threat_updates[str(last_move)] = {
-    #         'black': {
-    #             'added' : set(),
-    #             'removed' : self._prune_old_threats(spans, True)
-    #         },  
-    #         'white' : {
-    #             'added' : set(),
-    #             'removed' :self._prune_old_threats(spans, False) 
-    #         }
-    #     }
-
-    #     # self._prune_old_threats(spans, True)
-    #     # self._prune_old_threats(spans, False)   
-        
-    #     ts = self.b_threats if black else self.w_threats
-
-    #     added_threats = set()
-    #     added_threats.update(self._get_threats_in_repr(ts, line, black, span[0], 0))
-    #     added_threats.update(self._get_threats_in_repr(ts, line90, black, span90[0], 90))
-    #     added_threats.update(self._get_threats_in_repr(ts, line45, black, span45[0], 45))
-    #     added_threats.update(self._get_threats_in_repr(ts, line315, black, span315[0], 315))
-
-    #     self.threat_updates[str(last_move)]['black' if black else 'white']['added'] = added_threats
-
-    
-# def check_correctness(threat : Threat, bucket : str):
-#     type = threat.info['type']
-#     if type in WINNING_THREAT_TYPES:
-#         if bucket != 'winning':
-#             raise Exception('wrong threat identification (%s != %s)' % (bucket,'winning'))
-#     elif type in FORCING_THREAT_TYPES:
-#         if bucket != 'forcing':
-#             raise Exception('wrong threat identification (%s != %s)' % (bucket,'forcing'))
-#     else:
-#         if bucket != 'nforcing':
-#             raise Exception('wrong threat identification (%s != %s)' % (bucket,'nforcing'))
-
-
-        #updt = self.threat_updates[str((c,r))]
-
-        #print(c,r,is_black)
-        #print(updt)
-        # try:
-        #     for add in updt['white']['added']:
-        #         self.w_threats[add[1]].remove(add[0])
-        #     for rem in updt['white']['removed']:
-        #         self.w_threats[rem[1]].add(rem[0])
-        # except KeyError:        
-        #     pass
-
-        # try:
-        #     for add in updt['black']['added']:
-        #         self.b_threats[add[1]].remove(add[0])
-        #     for rem in updt['black']['removed']:
-        #         self.b_threats[rem[1]].add(rem[0])
-        # except KeyError:
-        #     pass
\ No newline at end of file
+    test_bitboard_threats()
+    test_zobrist_hash()
+    test_unmake_restores_threats()
+    test_line_intersection_table()
+    test_frontier()
+    test_frontier(BoardState)
+    cross_check_threat_engine()
+    benchmark_threat_detection()
+    benchmark_make_unmake()
+    benchmark_make_unmake_by_stones()
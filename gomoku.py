@@ -8,13 +8,15 @@ class Game:
     def __init__(self, 
                 whitePlayer : Player,
                 blackPlayer : Player,
-                size : int = DEFAULT_BOARD_SIZE):
+                size : int = DEFAULT_BOARD_SIZE,
+                board_state_type : type = BoardState):
                 
-        self.board_state = BoardState(size) 
+        self.board_state = board_state_type(size) 
         self.size = size
 
         self.on_turn_change_callbacks = []
         self.on_game_end_callbacks = []
+        self.on_revert_callbacks = []
 
         self.black_turn = True          
         self.winning_player = None        
@@ -42,6 +44,9 @@ class Game:
     def add_game_end_callback(self, func):
         self.on_game_end_callbacks.append(func)
 
+    def add_revert_callback(self, func):
+        self.on_revert_callbacks.append(func)
+
     def gui_draw(self):
         if self.gui is not None:
             self.gui.draw()
@@ -182,6 +187,8 @@ class Game:
     def revert_turn(self):
         self.board_state.unmake_last_move()
         self.winning_player = None
+        for cback in self.on_revert_callbacks:
+            cback()
         self.new_turn()
         self.gui_draw()   
 
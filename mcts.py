@@ -0,0 +1,354 @@
+import atexit
+import math
+import multiprocessing as mp
+import random
+import time
+from threading import Event
+
+from boardstate import BoardState, deepcopy_boardstate
+from minimax import gomoku_check_winner
+from parallel_search import decode_moves, encode_moves, get_default_n_workers
+from threat_space import get_four_cells
+
+#Exploration constant of the UCT formula
+MCTS_EXPLORATION = 1.0
+#Rollouts played from every leaf reached by the tree policy
+MCTS_BATCH_SIZE = 4
+#Rollouts still going after this many moves are scored as draws
+MCTS_MAX_ROLLOUT_MOVES = 60
+#Seconds per move when neither a time limit nor a playout count is given
+DEFAULT_MCTS_TIME_LIMIT = 1.0
+
+#Root parallel pools, one per worker count
+_MCTS_POOLS = {}
+
+def get_candidate_moves(state : BoardState, black : bool) -> list:
+    #A five ends the game and a four of the opponent has to be blocked, otherwise any cell of the
+    #frontier can be played (the center on an empty board, like gomoku_get_state_children)
+    own_fours = get_four_cells(state, black)
+    if len(own_fours) > 0:
+        return [min(own_fours)]
+    opp_fours = get_four_cells(state, not black)
+    if len(opp_fours) > 0:
+        return sorted(opp_fours)
+    if len(state.moves) == 0:
+        return [(state.size // 2, state.size // 2)]
+    return sorted(state.frontier)
+
+def rollout(state : BoardState, black : bool, rng : random.Random, max_moves : int = MCTS_MAX_ROLLOUT_MOVES) -> float:
+    #Plays the game out from state with black (white) to move and returns the result for black:
+    #a five is completed as soon as there is one, a four of the opponent is blocked (two of them lose),
+    #and the other moves are drawn at random from the frontier. The state is restored before returning.
+    played = 0
+    result = 0.5
+    while played < max_moves:
+        if len(get_four_cells(state, black)) > 0:
+            result = 1.0 if black else 0.0
+            break
+        opp_fours = get_four_cells(state, not black)
+        if len(opp_fours) > 1:
+            result = 0.0 if black else 1.0
+            break
+        if len(opp_fours) == 1:
+            move = next(iter(opp_fours))
+        elif len(state.frontier) > 0:
+            move = rng.choice(tuple(state.frontier))
+        else:
+            break
+        state.make_move(move, black)
+        played += 1
+        win, winner = gomoku_check_winner(state)
+        if win:
+            result = 1.0 if winner == 'black' else 0.0
+            break
+        black = not black
+    for _ in range(played):
+        state.unmake_last_move()
+    return result
+
+class MCTSNode:
+    #wins are those of the side that played move, a draw counts half
+    __slots__ = ('move', 'black', 'parent', 'children', 'untried', 'visits', 'wins', 'result')
+
+    def __init__(self, move : tuple, black : bool, parent : 'MCTSNode' = None):
+        self.move = move
+        self.black = black
+        self.parent = parent
+        self.children = []
+        #moves not expanded yet, listed on the first visit
+        self.untried = None
+        self.visits = 0
+        self.wins = 0.0
+        #result for black if the game is over after move
+        self.result = None
+
+    def uct_child(self, exploration : float) -> 'MCTSNode':
+        log_visits = math.log(self.visits)
+        return max(self.children, key=lambda c: c.wins / c.visits + exploration * math.sqrt(log_visits / c.visits))
+
+    def best_child(self) -> 'MCTSNode':
+        return max(self.children, key=lambda c: (c.visits, c.wins))
+
+class MCTSSearch:
+    #UCT search on one tree. Every iteration walks down the tree by UCT, adds one child to the leaf
+    #it reaches and plays batch_size rollouts from there, so the moves along the path are made and
+    #unmade once per batch instead of once per rollout.
+    def __init__(self,
+                exploration : float = MCTS_EXPLORATION,
+                batch_size : int = MCTS_BATCH_SIZE,
+                max_rollout_moves : int = MCTS_MAX_ROLLOUT_MOVES,
+                seed : int = None):
+        self.exploration = exploration
+        self.batch_size = batch_size
+        self.max_rollout_moves = max_rollout_moves
+        self.rng = random.Random(seed)
+        self.playouts = 0
+        self.max_depth = 0
+
+    def search(self, state : BoardState, black : bool, deadline : float = None, n_playouts : int = None, stop_flag : Event = None) -> MCTSNode:
+        #Searches with black (white) to move until deadline, n_playouts or stop_flag.
+        #The state is searched in place and restored before returning.
+        root = MCTSNode(None, not black)
+        while n_playouts is None or self.playouts < n_playouts:
+            self._iterate(state, root)
+            if deadline is not None and time.time() >= deadline:
+                break
+            if stop_flag is not None and stop_flag.is_set():
+                break
+            if root.untried is not None and len(root.untried) + len(root.children) <= 1:
+                break
+        return root
+
+    def _iterate(self, state : BoardState, root : MCTSNode):
+        node = root
+        depth = 0
+        while node.result is None and node.untried is not None and len(node.untried) == 0 and len(node.children) > 0:
+            node = node.uct_child(self.exploration)
+            state.make_move(node.move, node.black)
+            depth += 1
+
+        if node.result is None:
+            to_move = not node.black
+            if node.untried is None:
+                node.untried = get_candidate_moves(state, to_move)
+                self.rng.shuffle(node.untried)
+            if len(node.untried) > 0:
+                child = MCTSNode(node.untried.pop(), to_move, node)
+                node.children.append(child)
+                state.make_move(child.move, to_move)
+                depth += 1
+                node = child
+                win, winner = gomoku_check_winner(state)
+                if win:
+                    node.result = 1.0 if winner == 'black' else 0.0
+                elif len(state.frontier) == 0:
+                    node.result = 0.5
+            else:
+                node.result = 0.5
+
+        if node.result is not None:
+            n = 1
+            black_score = node.result
+        else:
+            n = self.batch_size
+            black_score = sum([rollout(state, not node.black, self.rng, self.max_rollout_moves) for _ in range(n)])
+        self.playouts += n
+        self.max_depth = max(self.max_depth, depth)
+
+        while node is not None:
+            node.visits += n
+            node.wins += black_score if node.black else n - black_score
+            node = node.parent
+        for _ in range(depth):
+            state.unmake_last_move()
+
+def _get_root_stats(root : MCTSNode) -> dict:
+    return {child.move : (child.visits, child.wins) for child in root.children}
+
+def _get_pv(root : MCTSNode) -> list:
+    pv = []
+    node = root
+    while len(node.children) > 0:
+        node = node.best_child()
+        pv.append(node.move)
+    return pv
+
+def _mcts_worker_task(task : tuple) -> tuple:
+    state_type, size, encoded, black, deadline, n_playouts, exploration, batch_size, max_rollout_moves, seed = task
+    state = state_type(size)
+    for c,r,b in decode_moves(encoded, size):
+        state.make_move((c,r), b)
+    searcher = MCTSSearch(exploration, batch_size, max_rollout_moves, seed)
+    root = searcher.search(state, black, deadline, n_playouts)
+    return _get_root_stats(root), searcher.playouts, searcher.max_depth
+
+class MCTSRootPool:
+    #Root parallelism: every worker grows its own tree from the same position with a different seed
+    #and the visits and wins of the root children are added up at the end
+    def __init__(self, n_workers : int):
+        self.n_workers = n_workers
+        self.pool = mp.Pool(n_workers)
+
+    def start(self, state : BoardState, black : bool, deadline : float, n_playouts : int,
+            exploration : float, batch_size : int, max_rollout_moves : int, seed : int) -> list:
+        encoded = encode_moves(state.moves, state.size)
+        return [self.pool.apply_async(_mcts_worker_task,
+            ((type(state), state.size, encoded, black, deadline, n_playouts, exploration, batch_size, max_rollout_moves, seed + i + 1),))
+            for i in range(self.n_workers)]
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+def get_mcts_pool(n_workers : int) -> MCTSRootPool:
+    if n_workers not in _MCTS_POOLS:
+        _MCTS_POOLS[n_workers] = MCTSRootPool(n_workers)
+    return _MCTS_POOLS[n_workers]
+
+def close_mcts_pools():
+    for pool in _MCTS_POOLS.values():
+        pool.close()
+    _MCTS_POOLS.clear()
+
+atexit.register(close_mcts_pools)
+
+def mcts_get_best_move(state : BoardState,
+                    maximize : bool,
+                    time_limit : float = None,
+                    n_playouts : int = None,
+                    n_workers : int = 1,
+                    exploration : float = MCTS_EXPLORATION,
+                    batch_size : int = MCTS_BATCH_SIZE,
+                    max_rollout_moves : int = MCTS_MAX_ROLLOUT_MOVES,
+                    seed : int = None) -> tuple:
+    #(best move, search data) for black (maximize) or white, the most visited child of the root.
+    #The search runs for time_limit seconds or n_playouts playouts per tree, with n_workers trees
+    #grown in parallel (the calling process grows one of them), all the available cores if None.
+    start_time = time.time()
+    if time_limit is None and n_playouts is None:
+        time_limit = DEFAULT_MCTS_TIME_LIMIT
+    deadline = None if time_limit is None else start_time + time_limit
+    n_workers = get_default_n_workers() if n_workers is None else n_workers
+    seed = random.randrange(1 << 30) if seed is None else seed
+
+    pending = []
+    if n_workers > 1:
+        pending = get_mcts_pool(n_workers - 1).start(state, maximize, deadline, n_playouts,
+            exploration, batch_size, max_rollout_moves, seed)
+    searcher = MCTSSearch(exploration, batch_size, max_rollout_moves, seed)
+    root = searcher.search(deepcopy_boardstate(state), maximize, deadline, n_playouts)
+
+    stats = _get_root_stats(root)
+    playouts = searcher.playouts
+    max_depth = searcher.max_depth
+    for r in pending:
+        w_stats, w_playouts, w_depth = r.get()
+        for move, (visits, wins) in w_stats.items():
+            m_visits, m_wins = stats.get(move, (0, 0.0))
+            stats[move] = (m_visits + visits, m_wins + wins)
+        playouts += w_playouts
+        max_depth = max(max_depth, w_depth)
+
+    best = max(stats, key=lambda m: stats[m])
+    visits, wins = stats[best]
+    pv = _get_pv(root)
+    if len(pv) == 0 or pv[0] != best:
+        pv = [best]
+    elapsed = time.time() - start_time
+    agg_sdata = {
+    'branching' : len(stats),
+    'visited' : sum([1 for v, _ in stats.values() if v > 0]),
+    'depth' : max_depth,
+    'playouts' : playouts,
+    'playouts_per_s' : playouts / elapsed if elapsed > 0 else 0,
+    'score' : wins / visits,
+    'pv' : pv,
+    'time' : elapsed
+    }
+    return best, agg_sdata
+
+
+if __name__ == '__main__':
+    from boardstate import BitBoardState
+
+    def play(state : BoardState, moves : list) -> BoardState:
+        for i, move in enumerate(moves):
+            state.make_move(move, i % 2 == 0)
+        return state
+
+    def test_rollout_restores_state():
+        state = play(BitBoardState(15), [(7, 7), (8, 8), (7, 8), (9, 7)])
+        key = state.hash(True)
+        rng = random.Random(0)
+        results = [rollout(state, True, rng) for _ in range(20)]
+        assert all(r in (0.0, 0.5, 1.0) for r in results)
+        assert state.hash(True) == key and len(state.moves) == 4
+
+    def test_completes_five():
+        #black has four in a row, white a four of its own
+        state = play(BitBoardState(15), [(7, 3), (0, 0), (7, 4), (0, 1), (7, 5), (0, 2), (7, 6), (0, 3)])
+        move, sdata = mcts_get_best_move(state, True, n_playouts=50, seed=1)
+        assert move in {(7, 2), (7, 7)} and sdata['score'] == 1.0
+
+    def test_blocks_four():
+        #white has to stop the black four
+        state = play(BitBoardState(15), [(7, 3), (9, 9), (7, 4), (10, 10), (7, 5), (3, 12), (7, 6)])
+        move, sdata = mcts_get_best_move(state, False, n_playouts=50, seed=1)
+        assert move in {(7, 2), (7, 7)}
+
+    def test_empty_board():
+        move, sdata = mcts_get_best_move(BitBoardState(15), True, time_limit=0.2)
+        assert move == (7, 7)
+
+    def test_root_parallel():
+        state = play(BitBoardState(15), [(7, 7), (8, 8), (7, 8), (9, 7)])
+        key = state.hash(True)
+        move, sdata = mcts_get_best_move(state, True, n_playouts=40, n_workers=2, seed=3)
+        assert state.grid[move] == 0 and state.hash(True) == key
+        #each tree runs its own playouts
+        assert sdata['playouts'] >= 80
+
+    def benchmark_playouts(time_limit : float = 3.0):
+        #playouts per second of a single tree by batch size
+        state = play(BitBoardState(15), [(7, 7), (8, 8), (7, 8), (9, 7), (6, 9), (8, 6)])
+        for batch_size in (1, 4, 16):
+            _, sdata = mcts_get_best_move(state, True, time_limit, batch_size=batch_size, seed=0)
+            print('batch size: %d\t%.0f playouts/s\tdepth %d' % (batch_size, sdata['playouts_per_s'], sdata['depth']))
+
+    def benchmark_vs_alphabeta(n_games : int = 4, time_limit : float = 1.0):
+        #games between MCTS and the alpha-beta search at equal time from random openings, both colours
+        import contextlib
+        import io
+        from minimax import gomoku_get_best_move
+        rng = random.Random(11)
+        results = {'mcts' : 0, 'alphabeta' : 0, 'draw' : 0}
+        for game in range(n_games):
+            mcts_black = game % 2 == 0
+            cells = [(c, r) for c in range(5, 10) for r in range(5, 10)]
+            rng.shuffle(cells)
+            state = play(BitBoardState(15), cells[:4])
+            black = True
+            winner = 'draw'
+            while len(state.frontier) > 0:
+                if black == mcts_black:
+                    move, _ = mcts_get_best_move(state, black, time_limit, n_workers=1, seed=game)
+                else:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        move, _ = gomoku_get_best_move(state, black, {'forcing' : 100, 'nforcing' : 1}, None,
+                            time_limit=time_limit, search_version=2, n_workers=1)
+                state.make_move(move, black)
+                win, color = gomoku_check_winner(state)
+                if win:
+                    winner = 'mcts' if (color == 'black') == mcts_black else 'alphabeta'
+                    break
+                black = not black
+            results[winner] += 1
+        print('mcts vs alpha-beta at %.1f s per move: %s' % (time_limit, results))
+
+    test_rollout_restores_state()
+    test_completes_five()
+    test_blocks_four()
+    test_empty_board()
+    test_root_parallel()
+    benchmark_playouts()
+    benchmark_vs_alphabeta()
@@ -1,22 +1,143 @@
 from typing import List, Tuple
 
 from boardstate import BoardState,deepcopy_boardstate
-from threats import FORCING_THREAT_TYPES, NON_FORCING_THREAT_TYPES
-from utils import no_moves_possible
-from joblib import Parallel,delayed
+from move_ordering import MoveOrdering
+from threat_space import THREAT_SPACE_WIN, find_forced_win
+from threats import get_threat_eval_terms
+from ttable import DEFAULT_TT_SIZE_MB, TT_EXACT, TT_LOWER_BOUND, TT_UPPER_BOUND, SharedTranspositionTable, TranspositionTable
 
 import math
 import numpy as np
 import time
 
 DEFAULT_SEARCH_DEPTH = 2
-THREAT_PRIORITY = [
-    [1,1,1,1,1],
-    [2,2,2,2],
-    [3,6,6],
-    [7,8],
-    [8]
-]
+#Deepest iteration tried by a time or node limited search when search_depth is None
+MAX_SEARCH_DEPTH = 30
+WIN_SCORE = 100000000000
+#The clock is read once every (TIME_CHECK_INTERVAL + 1) nodes
+TIME_CHECK_INTERVAL = 63
+#Half width of the window around the previous iteration's score (search_version 2)
+ASPIRATION_WINDOW = 50
+#Quiescence search limits, per horizon node
+QUIESCENCE_MAX_PLY = 8
+QUIESCENCE_NODE_LIMIT = 200
+#Smallest score of a won position, including wins found by the quiescence search
+MIN_WIN_SCORE = WIN_SCORE / (100 + QUIESCENCE_MAX_PLY + 1)
+#When True every static evaluation is checked against a full recompute over the threats
+STATIC_EVAL_CROSS_CHECK = False
+#Late move reductions: in quiet nodes (no forcing threats on the board) the moves after the first
+#LMR_FULL_DEPTH_MOVES that don't make a forcing threat are searched LMR_REDUCTION plies shallower
+#(LMR_LATE_REDUCTION from the LMR_LATE_MOVES-th move on) and searched again in full if they fail high.
+#Reductions are even so the reduced search ends with the same side to move, the threat scores
+#swinging between odd and even depths.
+LMR_MIN_DEPTH = 3
+LMR_FULL_DEPTH_MOVES = 2
+LMR_REDUCTION = 2
+LMR_LATE_MIN_DEPTH = 5
+LMR_LATE_MOVES = 8
+LMR_LATE_REDUCTION = 4
+#Null-move pruning: a node whose static score beats beta and where the side to move faces no forcing
+#threat is cut if passing, searched NULL_MOVE_REDUCTION plies shallower, still beats beta
+NULL_MOVE_MIN_DEPTH = 3
+NULL_MOVE_REDUCTION = 2
+
+class SearchTimeout(Exception):
+    pass
+
+class SearchContext:
+    #State shared by every node of one gomoku_get_best_move call: the transposition table
+    #and the time/node budget. When the budget runs out minimax raises SearchTimeout and
+    #the partial iteration is thrown away.
+    def __init__(self,
+                tt : TranspositionTable = None,
+                time_limit : float = None,
+                node_limit : int = None,
+                ordering : MoveOrdering = None,
+                root_ply : int = 0):
+        self.tt = tt
+        self.ordering = ordering
+        #number of stones on the board at the root, plies are counted from there
+        self.root_ply = root_ply
+        self.time_limit = time_limit
+        self.node_limit = node_limit
+        self.start_time = time.time()
+        self.deadline = None if time_limit is None else self.start_time + time_limit
+        self.nodes = 0
+        #limits are only enforced once an iteration has completed, so there is always a move to play
+        self.enforce_limits = False
+        #shared flag set by another process to stop this search (Lazy SMP helpers)
+        self.stop_flag = None
+        #extend the horizon nodes with a quiescence search over forcing moves
+        self.quiescence = False
+        self.q_nodes = 0
+        #selective search: late move reductions and null-move pruning
+        self.lmr = False
+        self.null_move = False
+        self.reductions = 0
+        self.null_cutoffs = 0
+
+    def is_limited(self) -> bool:
+        return self.deadline is not None or self.node_limit is not None or self.stop_flag is not None
+
+    def elapsed(self) -> float:
+        return time.time() - self.start_time
+
+    def count_node(self):
+        self.nodes += 1
+        if not self.enforce_limits:
+            return
+        if self.node_limit is not None and self.nodes > self.node_limit:
+            raise SearchTimeout()
+        if (self.nodes & TIME_CHECK_INTERVAL) == 0:
+            if self.deadline is not None and time.time() > self.deadline:
+                raise SearchTimeout()
+            if self.stop_flag is not None and self.stop_flag.is_set():
+                raise SearchTimeout()
+
+class PersistentSearchContext:
+    #What the searches of one player keep from move to move: the transposition table, the move
+    #ordering tables (carried over to the next root by MoveOrdering.new_search) and the result of
+    #each search, so a position searched again with the same settings is answered at once (the
+    #first turn of the player that chose white in swap2 is the search made to choose it).
+    #Storing a result drops those of the roots the game can no longer reach (behind it or off its
+    #line). invalidate() is called when turns are reverted and new_game() when the player joins
+    #another game. Only one search may use the context at a time: the Ponderer stops its search
+    #before the player searches.
+    def __init__(self, tt : TranspositionTable = None):
+        self.tt = tt if tt is not None else TranspositionTable(DEFAULT_TT_SIZE_MB)
+        self.ordering = MoveOrdering()
+        #number of stones on the board at the root of the last search
+        self.root_ply = None
+        #(position hash, side to move, search settings) -> (moves to the root, best move, search data)
+        self.results = {}
+
+    def begin_search(self, state : BoardState) -> MoveOrdering:
+        root_ply = len(state.moves)
+        self.ordering.new_search(-1 if self.root_ply is None else root_ply - self.root_ply)
+        self.root_ply = root_ply
+        return self.ordering
+
+    def get_result(self, key : tuple) -> tuple:
+        result = self.results.get(key)
+        if result is None:
+            return None
+        _, move, agg_sdata = result
+        return move, dict(agg_sdata, cached=True)
+
+    def store_result(self, key : tuple, state : BoardState, move : tuple, agg_sdata : dict):
+        moves = tuple(state.moves)
+        for k in [k for k, r in self.results.items() if r[0][:len(moves)] != moves]:
+            del self.results[k]
+        self.results[key] = (moves, move, dict(agg_sdata))
+
+    def invalidate(self):
+        #Entries keyed by position stay valid, what depends on the moves played is dropped
+        self.results.clear()
+        self.root_ply = None
+
+    def new_game(self):
+        self.invalidate()
+        self.ordering = MoveOrdering()
 
 def gomoku_check_winner(state : BoardState) -> tuple:
     if len(state.b_threats['winning']) > 0:
@@ -26,19 +147,6 @@ def gomoku_check_winner(state : BoardState) -> tuple:
     else:
         return False,''
 
-def check_neighbours(board:np.array, pos: tuple):
-    for j in range(-1,2):
-        for i in range(-1,2):
-            if pos[0] + j < 0 or pos[0] + j > board.shape[1] - 1:
-                continue
-            if pos[1] + i < 0 or pos[1] + i > board.shape[0] - 1:
-                continue
-            if i == 0 and j == 0:
-                continue
-            if board[pos[0] + j, pos[1] + i] != 0:
-                return True
-    return False
-
 def gomoku_get_state_children(state : BoardState, maximize : bool) -> list:
     children = set()
     f_t, opp_f_t = (state.b_threats['forcing'],state.w_threats['forcing']) if maximize else (state.w_threats['forcing'],state.b_threats['forcing'])
@@ -64,12 +172,9 @@ def gomoku_get_state_children(state : BoardState, maximize : bool) -> list:
         if nft.info['type'][0] >= 2:
             children.update([(m, maximize) for m in nft.get_counter_moves()])
 
-    #If no threats are found just return one of the cells with an adjacent stone
+    #If no threats are found just return the cells with an adjacent stone
     if len(children) == 0:
-        for j in range(state.size):
-            for i in range(state.size):
-                if state.grid[j,i] == 0 and check_neighbours(state.grid,(j,i)):
-                    children.add(((j, i), maximize))
+        children.update([(m, maximize) for m in state.frontier])
     
     #If the board doesn't have a stone yet, then pick the central intersection
     if len(children) == 0:
@@ -79,56 +184,72 @@ def gomoku_get_state_children(state : BoardState, maximize : bool) -> list:
 
 
 def _get_threat_score(t_info : dict, t_weights : dict):
-    n = t_info['type'][0] - 1
-    w = t_info['type'][1] - 1
-    n = n if n <= 4 else 4
-    w = w if w <= 6 - n - 2 else 6 - n - 2
-
-    score = THREAT_PRIORITY[n][w]
-    if t_info['type'] in FORCING_THREAT_TYPES:
-        score *= t_weights['forcing']
-    if t_info['type'] in NON_FORCING_THREAT_TYPES:
-        score *= t_weights['nforcing']
-    return score
+    weight, priority = get_threat_eval_terms(t_info['type'])
+    return priority * (t_weights['forcing'], t_weights['nforcing'], 1)[weight]
+
+def _get_hook_score(hooks : list, t_weights : dict):
+    return sum([
+        _get_threat_score(hook[0].info, t_weights)*_get_threat_score(hook[1].info,t_weights)
+        for hook in hooks])
+
+def _get_hook_eval_score(hook_eval : list, t_weights : dict):
+    #hook_eval[i][j] weighs t_weights[i] * t_weights[j], the third weight being 1
+    f = t_weights['forcing']
+    nf = t_weights['nforcing']
+    forcing, nforcing, unweighted = hook_eval
+    return ((forcing[0] * f + forcing[1] * nf + forcing[2]) * f 
+            + (nforcing[1] * nf + nforcing[2]) * nf + unweighted[2])
 
 def gomoku_state_static_eval(state : BoardState, t_weights : dict, version : int = 1):
+    #The threat and hook scores are summed by make_move/unmake_last_move (BoardState.b_eval,
+    #w_eval, b_hook_eval and w_hook_eval), so evaluating a leaf only weighs the sums
+    b_eval = state.b_eval
+    w_eval = state.w_eval
+    score = ((b_eval[0] - w_eval[0]) * t_weights['forcing'] 
+            + (b_eval[1] - w_eval[1]) * t_weights['nforcing'] 
+            + b_eval[2] - w_eval[2])
+    if version == 2:
+        score += _get_hook_eval_score(state.b_hook_eval, t_weights) - _get_hook_eval_score(state.w_hook_eval, t_weights)
+
+    if STATIC_EVAL_CROSS_CHECK:
+        expected = gomoku_state_full_eval(state, t_weights, version)
+        assert abs(score - expected) <= 1e-9 * max(1, abs(expected)), 'incremental evaluation %s != %s' % (score, expected)
+    return score
+
+def gomoku_state_full_eval(state : BoardState, t_weights : dict, version : int = 1):
+    #Same score as gomoku_state_static_eval, summed over every threat and pair of forcing threats
     score = 0
+    for threats, sign in ((state.b_threats, 1), (state.w_threats, -1)):
+        score += sign * sum([_get_threat_score(t.info,t_weights) for t in threats['forcing']])
+        score += sign * sum([_get_threat_score(t.info,t_weights) for t in threats['nforcing']])
+    if version == 2:
+        score += _get_hook_score(state.find_hooks(True), t_weights) - _get_hook_score(state.find_hooks(False), t_weights)
+    return score
 
-    bl_f_t = state.b_threats['forcing']
-    wh_f_t = state.w_threats['forcing']
+def _get_reduction(depth : int, move_index : int) -> int:
+    if depth < LMR_MIN_DEPTH or move_index < LMR_FULL_DEPTH_MOVES:
+        return 0
+    if depth >= LMR_LATE_MIN_DEPTH and move_index >= LMR_LATE_MOVES:
+        return LMR_LATE_REDUCTION
+    return LMR_REDUCTION
 
-    bl_nf_t = state.b_threats['nforcing']
-    wh_nf_t = state.w_threats['nforcing']
+def _score_above(score : float) -> float:
+    #The scores are floats: the null window above score is (score, _score_above(score)), no score
+    #falls strictly inside it
+    return math.nextafter(score, math.inf)
 
-    bft_score = sum([_get_threat_score(t.info,t_weights) for t in bl_f_t])
-    bnft_score = sum([_get_threat_score(nft.info,t_weights) for nft in bl_nf_t])
-    if version == 2:
-        bhook_score = 0
-        bhooks = state.get_hooks(True)
-        if bhooks is not None:            
-            bhook_score = sum([
-            _get_threat_score(hook[0].info, t_weights)*_get_threat_score(hook[1].info,t_weights)
-            for hook in bhooks])
- 
-    wft_score = sum([_get_threat_score(t.info,t_weights) for t in wh_f_t])
-    wnft_score = sum([_get_threat_score(nft.info,t_weights) for nft in wh_nf_t])
-    if version == 2:
-        whook_score = 0
-        whooks = state.get_hooks(False)
-        if whooks is not None:
-            whook_score = sum([
-            _get_threat_score(hook[0].info, t_weights)*_get_threat_score(hook[1].info,t_weights)
-            for hook in whooks])
-     
-    score += bft_score + bnft_score
-    if version == 2:
-        score += bhook_score
+def _score_below(score : float) -> float:
+    return math.nextafter(score, -math.inf)
 
-    score -= wft_score + wnft_score
-    if version == 2:
-        score -= whook_score
+def _is_quiet(state : BoardState) -> bool:
+    return len(state.b_threats['forcing']) == 0 and len(state.w_threats['forcing']) == 0
 
-    return score
+def _try_null_move(state : BoardState, maximize : bool, depth : int, ctx : SearchContext, allow_null : bool) -> bool:
+    #Passing is never better than the best move in gomoku (an extra stone can't hurt), but it
+    #ignores the opponent's forcing threats, so those positions are left out
+    if not allow_null or ctx is None or not ctx.null_move or depth < NULL_MOVE_MIN_DEPTH:
+        return False
+    return len((state.w_threats if maximize else state.b_threats)['forcing']) == 0
 
 def minimax(state : BoardState,
             depth : int,
@@ -137,108 +258,583 @@ def minimax(state : BoardState,
             alpha : float = -math.inf,
             beta : float = math.inf,
             version : int = 1,
-            search_data : dict = None) -> float:
+            search_data : dict = None,
+            ctx : SearchContext = None,
+            allow_null : bool = True) -> float:
+
+    tt = None
+    if ctx is not None:
+        ctx.count_node()
+        tt = ctx.tt
 
     win,winner = gomoku_check_winner(state)
     if win:
-        return 100000000000 / (100 - depth) if winner == 'black' else -100000000000 / (100 - depth)
+        return WIN_SCORE / (100 - depth) if winner == 'black' else -WIN_SCORE / (100 - depth)
     
-    if no_moves_possible(state.grid):        
+    if state.is_full():
         return 0
     
     if depth == 0:
+        if ctx is not None and ctx.quiescence:
+            if maximize:
+                return quiescence(state, maximize, t_weights, alpha, beta, version, ctx)
+            return -quiescence(state, maximize, t_weights, -beta, -alpha, version, ctx)
         return gomoku_state_static_eval(state, t_weights,version=version)
 
+    #the flag of the stored result is decided on the window of the caller, not the one narrowed by the table
+    alpha_orig, beta_orig = alpha, beta
+    hash_move = None
+    if tt is not None:
+        key = state.hash(maximize)
+        entry = tt.probe(key)
+        if entry is not None:
+            e_depth, e_score, e_flag, hash_move = entry
+            if e_depth >= depth:
+                if e_flag == TT_EXACT:
+                    return e_score
+                elif e_flag == TT_LOWER_BOUND:
+                    alpha = max(alpha, e_score)
+                else:
+                    beta = min(beta, e_score)
+                if beta <= alpha:
+                    return e_score
+
+    if _try_null_move(state, maximize, depth, ctx, allow_null):
+        static_eval = gomoku_state_static_eval(state, t_weights, version=version)
+        null_depth = depth - 1 - NULL_MOVE_REDUCTION
+        if maximize and static_eval >= beta:
+            if minimax(state, null_depth, False, t_weights, _score_below(beta), beta, version, search_data, ctx, False) >= beta:
+                ctx.null_cutoffs += 1
+                return beta
+        elif not maximize and static_eval <= alpha:
+            if minimax(state, null_depth, True, t_weights, alpha, _score_above(alpha), version, search_data, ctx, False) <= alpha:
+                ctx.null_cutoffs += 1
+                return alpha
+
     visited = 0
+    best_move = None
+    quiet = ctx is not None and ctx.lmr and _is_quiet(state)
 
     if maximize:
         maxEval = -math.inf
-        children = gomoku_get_state_children(state,maximize)
+        children = _get_ordered_children(state, maximize, hash_move, ctx)
         search_data['branching'].append(len(children))        
         for child in children:
             move,_ = child        
             state.make_move(move, maximize)
             visited+=1   
-            eval = minimax(
-                state=state,
-                depth=depth - 1,
-                maximize=False,
-                t_weights=t_weights,
-                alpha=alpha,
-                beta=beta,
-                version=version,
-                search_data=search_data
-                )
+            #a reduced search that fails high is repeated at full depth
+            reduction = _get_reduction(depth, visited - 1) if quiet and len(state.b_threats['forcing']) == 0 else 0
+            if reduction > 0:
+                ctx.reductions += 1
+                eval = minimax(state, depth - 1 - reduction, False, t_weights, alpha, _score_above(alpha), version, search_data, ctx)
+            if reduction == 0 or eval > alpha:
+                eval = minimax(
+                    state=state,
+                    depth=depth - 1,
+                    maximize=False,
+                    t_weights=t_weights,
+                    alpha=alpha,
+                    beta=beta,
+                    version=version,
+                    search_data=search_data,
+                    ctx=ctx
+                    )
             state.unmake_last_move()
 
-            maxEval = max(maxEval,eval)
+            if eval > maxEval:
+                maxEval = eval
+                best_move = move
             alpha = max(alpha,eval)
             if beta <= alpha:
+                _record_cutoff(state, move, maximize, depth, visited - 1, ctx)
                 break 
         search_data['visited'].append(visited)
-        return maxEval
+        best_eval = maxEval
     else:
         minEval = math.inf
-        children = gomoku_get_state_children(state,maximize)
+        children = _get_ordered_children(state, maximize, hash_move, ctx)
         search_data['branching'].append(len(children))
 
         for child in children:
             move,_ = child
             state.make_move(move, maximize)            
             visited += 1
-            eval = minimax(
-                state=state,
-                depth=depth - 1,
-                maximize=True,
-                t_weights=t_weights,
-                alpha=alpha,
-                beta=beta,
-                version=version,
-                search_data=search_data
-                )
+            reduction = _get_reduction(depth, visited - 1) if quiet and len(state.w_threats['forcing']) == 0 else 0
+            if reduction > 0:
+                ctx.reductions += 1
+                eval = minimax(state, depth - 1 - reduction, True, t_weights, _score_below(beta), beta, version, search_data, ctx)
+            if reduction == 0 or eval < beta:
+                eval = minimax(
+                    state=state,
+                    depth=depth - 1,
+                    maximize=True,
+                    t_weights=t_weights,
+                    alpha=alpha,
+                    beta=beta,
+                    version=version,
+                    search_data=search_data,
+                    ctx=ctx
+                    )
             state.unmake_last_move()
 
-            minEval = min(minEval,eval)
+            if eval < minEval:
+                minEval = eval
+                best_move = move
             beta = min(beta,eval)
             if beta <= alpha:
+                _record_cutoff(state, move, maximize, depth, visited - 1, ctx)
                 break
         search_data['visited'].append(visited)
-        return minEval    
+        best_eval = minEval
+
+    if tt is not None:
+        if best_eval <= alpha_orig:
+            flag = TT_UPPER_BOUND
+        elif best_eval >= beta_orig:
+            flag = TT_LOWER_BOUND
+        else:
+            flag = TT_EXACT
+        tt.store(key, depth, best_eval, flag, best_move)
+    return best_eval
+
+def negamax_pvs(state : BoardState,
+            depth : int,
+            maximize : bool,
+            t_weights : dict,
+            alpha : float = -math.inf,
+            beta : float = math.inf,
+            version : int = 1,
+            search_data : dict = None,
+            ctx : SearchContext = None,
+            pv : list = None,
+            allow_null : bool = True) -> float:
+    #Principal variation search on the negamax form of minimax: scores are seen from the side
+    #to move (maximize is still the color to move). Every child after the first one is searched
+    #with a null window and re-searched with the full window only if it might improve alpha.
+    #The best line found is written into pv.
+    tt = None
+    if ctx is not None:
+        ctx.count_node()
+        tt = ctx.tt
+
+    win,winner = gomoku_check_winner(state)
+    if win:
+        score = WIN_SCORE / (100 - depth)
+        return score if (winner == 'black') == maximize else -score
+
+    if state.is_full():
+        return 0
+
+    if depth == 0:
+        if ctx is not None and ctx.quiescence:
+            return quiescence(state, maximize, t_weights, alpha, beta, version, ctx)
+        score = gomoku_state_static_eval(state, t_weights, version=version)
+        return score if maximize else -score
+
+    pv_node = beta > _score_above(alpha)
+    alpha_orig, beta_orig = alpha, beta
+    hash_move = None
+    if tt is not None:
+        key = state.hash(maximize)
+        entry = tt.probe(key)
+        if entry is not None:
+            e_depth, e_score, e_flag, hash_move = entry
+            #exact hits are not taken on pv nodes so that the principal variation stays complete
+            if e_depth >= depth and not pv_node:
+                if e_flag == TT_EXACT:
+                    return e_score
+                elif e_flag == TT_LOWER_BOUND:
+                    alpha = max(alpha, e_score)
+                else:
+                    beta = min(beta, e_score)
+                if beta <= alpha:
+                    return e_score
+
+    if not pv_node and _try_null_move(state, maximize, depth, ctx, allow_null):
+        static_eval = gomoku_state_static_eval(state, t_weights, version=version)
+        if (static_eval if maximize else -static_eval) >= beta:
+            if -negamax_pvs(state, depth - 1 - NULL_MOVE_REDUCTION, not maximize, t_weights, -beta, -_score_below(beta), version, search_data, ctx, None, False) >= beta:
+                ctx.null_cutoffs += 1
+                return beta
+
+    children = _get_ordered_children(state, maximize, hash_move, ctx)
+    search_data['branching'].append(len(children))
+    visited = 0
+    best_eval = -math.inf
+    best_move = None
+    quiet = ctx is not None and ctx.lmr and _is_quiet(state)
+    for child in children:
+        move,_ = child
+        child_pv = []
+        state.make_move(move, maximize)
+        visited += 1
+        if visited == 1:
+            eval = -negamax_pvs(state, depth - 1, not maximize, t_weights, -beta, -alpha, version, search_data, ctx, child_pv)
+        else:
+            #late quiet moves get a reduced null window search first, repeated at full depth if it fails high
+            reduction = 0
+            if quiet and len((state.b_threats if maximize else state.w_threats)['forcing']) == 0:
+                reduction = _get_reduction(depth, visited - 1)
+            if reduction > 0:
+                ctx.reductions += 1
+                eval = -negamax_pvs(state, depth - 1 - reduction, not maximize, t_weights, -_score_above(alpha), -alpha, version, search_data, ctx, child_pv)
+            if reduction == 0 or eval > alpha:
+                child_pv = []
+                eval = -negamax_pvs(state, depth - 1, not maximize, t_weights, -_score_above(alpha), -alpha, version, search_data, ctx, child_pv)
+            if alpha < eval < beta:
+                child_pv = []
+                eval = -negamax_pvs(state, depth - 1, not maximize, t_weights, -beta, -alpha, version, search_data, ctx, child_pv)
+        state.unmake_last_move()
+
+        if eval > best_eval:
+            best_eval = eval
+            best_move = move
+            if eval > alpha:
+                alpha = eval
+                if pv is not None:
+                    pv[:] = [move] + child_pv
+        if alpha >= beta:
+            _record_cutoff(state, move, maximize, depth, visited - 1, ctx)
+            break
+    search_data['visited'].append(visited)
+
+    if tt is not None:
+        if best_eval <= alpha_orig:
+            flag = TT_UPPER_BOUND
+        elif best_eval >= beta_orig:
+            flag = TT_LOWER_BOUND
+        else:
+            flag = TT_EXACT
+        tt.store(key, depth, best_eval, flag, best_move)
+    return best_eval
+
+def quiescence(state : BoardState,
+            maximize : bool,
+            t_weights : dict,
+            alpha : float,
+            beta : float,
+            version : int = 1,
+            ctx : SearchContext = None,
+            ply : int = 0,
+            budget : list = None) -> float:
+    #Search past the horizon over forcing moves only, with the score seen from the side to move
+    #(maximize is the color to move). A four of the side to move wins, a four of the opponent
+    #must be blocked, otherwise the side to move can stand pat on the static evaluation or
+    #play a forcing move: turn a three into a four, or answer one of the opponent's open threes.
+    #budget holds the nodes left for the search started at the horizon.
+    if budget is None:
+        budget = [QUIESCENCE_NODE_LIMIT]
+    budget[0] -= 1
+    if ctx is not None:
+        ctx.count_node()
+        ctx.q_nodes += 1
+
+    win,winner = gomoku_check_winner(state)
+    if win:
+        score = WIN_SCORE / (100 + ply)
+        return score if (winner == 'black') == maximize else -score
+    if state.is_full():
+        return 0
+
+    own, opp = (state.b_threats, state.w_threats) if maximize else (state.w_threats, state.b_threats)
+    for t in own['forcing']:
+        if t.info['type'][0] == 4:
+            return WIN_SCORE / (100 + ply + 1)
+
+    stand_pat = gomoku_state_static_eval(state, t_weights, version=version)
+    stand_pat = stand_pat if maximize else -stand_pat
+    if budget[0] <= 0 or ply >= QUIESCENCE_MAX_PLY:
+        return stand_pat
+
+    moves = set()
+    for t in opp['forcing']:
+        if t.info['type'][0] == 4:
+            moves.update(t.get_counter_moves())
+    if len(moves) > 0:
+        #standing pat against a four would lose on the next move
+        best_eval = -math.inf
+    else:
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        best_eval = stand_pat
+        for bucket in ('forcing', 'nforcing'):
+            for t in own[bucket]:
+                if t.info['type'][0] == 3:
+                    moves.update(t.get_open_slots())
+        for t in opp['forcing']:
+            moves.update(t.get_counter_moves())
+
+    for move in moves:
+        state.make_move(move, maximize)
+        eval = -quiescence(state, not maximize, t_weights, -beta, -alpha, version, ctx, ply + 1, budget)
+        state.unmake_last_move()
+        if eval > best_eval:
+            best_eval = eval
+        alpha = max(alpha, eval)
+        if alpha >= beta:
+            break
+    return best_eval
+
+def _get_aspiration_center(iteration_scores : list) -> float:
+    #Threat scores swing between odd and even depths (the side that moved last gets its
+    #forcing threats counted), so the window is centered on the iteration two plies back
+    if len(iteration_scores) >= 2:
+        return iteration_scores[-2]
+    return None
+
+def _pvs_root(state : BoardState,
+            children : List[Tuple],
+            t_weights : dict,
+            maximize : bool,
+            depth : int,
+            alpha : float,
+            beta : float,
+            version : int,
+            ctx : SearchContext) -> tuple:
+    #Searches the root children in order, returns the score of the side to move, the index
+    #of the best child, the principal variation and the search data of every child
+    best_eval = -math.inf
+    best_index = 0
+    pv = []
+    collective_sdata = []
+    for i in range(len(children)):
+        move = children[i][0]
+        search_data = {'branching' : [1], 'visited' : [1]}
+        child_pv = []
+        state.make_move(move, maximize)
+        if i == 0:
+            eval = -negamax_pvs(state, depth - 1, not maximize, t_weights, -beta, -alpha, version, search_data, ctx, child_pv)
+        else:
+            eval = -negamax_pvs(state, depth - 1, not maximize, t_weights, -_score_above(alpha), -alpha, version, search_data, ctx, child_pv)
+            if alpha < eval < beta:
+                child_pv = []
+                eval = -negamax_pvs(state, depth - 1, not maximize, t_weights, -beta, -alpha, version, search_data, ctx, child_pv)
+        state.unmake_last_move()
+        collective_sdata.append(search_data)
+
+        if eval > best_eval:
+            best_eval = eval
+            best_index = i
+            pv = [move] + child_pv
+        alpha = max(alpha, eval)
+        if alpha >= beta:
+            break
+    return best_eval, best_index, pv, collective_sdata
+
+def _search_root_aspiration(state : BoardState,
+                            children : List[Tuple],
+                            t_weights : dict,
+                            maximize : bool,
+                            depth : int,
+                            version : int,
+                            ctx : SearchContext,
+                            prev_score : float = None) -> tuple:
+    #The first try uses a narrow window around the previous iteration's score, the side that
+    #fails is then opened up to infinity and the root searched again
+    alpha, beta = -math.inf, math.inf
+    if prev_score is not None and abs(prev_score) < MIN_WIN_SCORE:
+        alpha, beta = prev_score - ASPIRATION_WINDOW, prev_score + ASPIRATION_WINDOW
+
+    while True:
+        score, index, pv, collective_sdata = _pvs_root(state, children, t_weights, maximize, depth, alpha, beta, version, ctx)
+        if score <= alpha:
+            alpha = -math.inf
+        elif score >= beta:
+            beta = math.inf
+        else:
+            return score, index, pv, collective_sdata
+
+def _get_ordered_children(state : BoardState, maximize : bool, hash_move : tuple, ctx : SearchContext) -> list:
+    children = gomoku_get_state_children(state, maximize)
+    if ctx is None or ctx.ordering is None:
+        return _hash_move_first(children, hash_move)
+    return ctx.ordering.order(state, children, maximize, hash_move, len(state.moves) - ctx.root_ply)
+
+def _record_cutoff(state : BoardState, move : tuple, maximize : bool, depth : int, move_index : int, ctx : SearchContext):
+    if ctx is not None and ctx.ordering is not None:
+        ctx.ordering.record_cutoff(move, maximize, depth, len(state.moves) - ctx.root_ply, move_index)
+
+def _hash_move_first(children : list, hash_move : tuple) -> list:
+    if hash_move is None:
+        return children
+    for i in range(len(children)):
+        if children[i][0] == hash_move:
+            if i > 0:
+                children.insert(0, children.pop(i))
+            break
+    return children
     
 def gomoku_get_best_move(state : BoardState, 
                         maximize : bool,
                         t_weights : dict,
                         search_depth : int = DEFAULT_SEARCH_DEPTH,
-                        version : int = 1) -> Tuple[int,int]:     
+                        version : int = 1,
+                        tt : TranspositionTable = None,
+                        time_limit : float = None,
+                        node_limit : int = None,
+                        move_ordering : bool = True,
+                        search_version : int = 1,
+                        n_workers : int = None,
+                        quiescence : bool = False,
+                        threat_space : bool = False,
+                        lmr : bool = False,
+                        null_move : bool = False,
+                        stop_flag = None,
+                        persistent_ctx : PersistentSearchContext = None) -> Tuple[int,int]:
+    #Without limits the root is searched once at search_depth. With a time_limit (seconds) or
+    #a node_limit the search deepens one ply at a time up to search_depth (MAX_SEARCH_DEPTH if None)
+    #and returns the best move of the deepest iteration that completed within the budget.
+    #search_version 1 is the parallel minimax root (n_workers processes, all the cores if None),
+    #search_version 2 is principal variation search with aspiration windows, which always deepens
+    #iteratively, and search_version 3 is the same search with n_workers - 1 Lazy SMP helper
+    #processes filling a SharedTranspositionTable. The principal variation is returned in the
+    #search data. With threat_space a forced win by continuous fours or threats is played
+    #without searching (its line is returned as ts_sequence), and the time it takes comes out of
+    #time_limit otherwise. Setting stop_flag (an Event) from another thread stops the search like a
+    #time limit (the search deepens iteratively when it is given). lmr and null_move turn on late
+    #move reductions and null-move pruning below the root. A persistent_ctx carries the
+    #table, the move ordering and the results over to the next searches of the same player.
+    start_time = time.time()
+    if search_depth is None:
+        search_depth = MAX_SEARCH_DEPTH
     assert search_depth >= 1
     assert version >= 1 and version <= 2
+    assert search_version >= 1 and search_version <= 3
+
+    result_key = None
+    if persistent_ctx is not None:
+        result_key = (state.hash(maximize), maximize, tuple(sorted(t_weights.items())), search_depth, version,
+                    time_limit, node_limit, move_ordering, search_version, quiescence, threat_space, lmr, null_move)
+        cached = persistent_ctx.get_result(result_key)
+        if cached is not None:
+            return cached
+        if tt is None:
+            tt = persistent_ctx.tt
 
-    start_time = time.time() 
     threats = state.b_threats if maximize else state.w_threats
     for ft in threats['forcing']:
         if ft.info['type'][0] == 4:      
-            return list(ft.get_counter_moves())[0],{'branching' : 1, 'visited' : 1}
+            move = list(ft.get_counter_moves())[0]
+            return move,{'branching' : 1, 'visited' : 1, 'depth' : 0, 'pv' : [move]}
 
-    children = gomoku_get_state_children(state,maximize)
-    scores,collective_sdata = _eval_next_moves(state, children, t_weights, maximize, search_depth, version)
-    
-    if maximize:
-        index = np.argmax(scores)                
+    ts_nodes = 0
+    if threat_space:
+        forced_win = find_forced_win(state, maximize)
+        ts_nodes = forced_win['nodes']
+        if forced_win['result'] == THREAT_SPACE_WIN:
+            move = forced_win['sequence'][0]
+            agg_sdata = {'branching' : 1, 'visited' : 1, 'depth' : 0, 'pv' : forced_win['sequence'],
+                        'threat_space' : forced_win['type'], 'ts_sequence' : forced_win['sequence'], 'ts_nodes' : ts_nodes}
+            if persistent_ctx is not None:
+                persistent_ctx.store_result(result_key, state, move, agg_sdata)
+            return move,agg_sdata
+        if time_limit is not None:
+            time_limit = max(0.0, time_limit - (time.time() - start_time))
+
+    smp_pool = None
+    if search_version == 3:
+        import parallel_search
+        if tt is None:
+            tt = parallel_search.get_default_shared_tt()
+        assert isinstance(tt, SharedTranspositionTable), 'Lazy SMP needs a SharedTranspositionTable'
+        n_workers = parallel_search.get_default_n_workers() if n_workers is None else n_workers
+        if n_workers > 1:
+            smp_pool = parallel_search.get_smp_pool(n_workers - 1, tt)
+    if tt is None:
+        tt = TranspositionTable(DEFAULT_TT_SIZE_MB)
+    tt.new_search()
+    if not move_ordering:
+        ordering = None
+    elif persistent_ctx is not None:
+        ordering = persistent_ctx.begin_search(state)
+    else:
+        ordering = MoveOrdering()
+    ctx = SearchContext(tt, time_limit, node_limit, ordering, len(state.moves))
+    ctx.quiescence = quiescence
+    ctx.lmr = lmr
+    ctx.null_move = null_move
+    ctx.stop_flag = stop_flag
+    root_key = state.hash(maximize)
+
+    children = _get_ordered_children(state, maximize, tt.get_move(root_key), ctx)
+    if search_version >= 2:
+        #negamax_pvs works on the board directly, a copy keeps the caller's state intact on timeouts
+        search_state = deepcopy_boardstate(state)
+        depths = range(1, search_depth + 1)
     else:
-        index = np.argmin(scores)
+        depths = range(1, search_depth + 1) if ctx.is_limited() else [search_depth]
+    if smp_pool is not None and len(children) > 1:
+        smp_pool.start(state, maximize, t_weights, search_depth, version, ctx.deadline, quiescence, lmr, null_move)
+    completed_depth = 0
+    best_score = 0
+    #root scores (side to move) of the completed iterations
+    iteration_scores = []
+    pv = [children[0][0]]
+    collective_sdata = [{'branching' : [1], 'visited' : [1]}]
+    for depth in depths:
+        if len(children) == 1:
+            break
+        try:
+            if search_version >= 2:
+                score,index,pv,collective_sdata = _search_root_aspiration(
+                    search_state, children, t_weights, maximize, depth, version, ctx,
+                    _get_aspiration_center(iteration_scores))
+                iteration_scores.append(score)
+                children.insert(0, children.pop(index))
+                best_score = score if maximize else -score
+            else:
+                scores,collective_sdata,index = _eval_next_moves(state, children, t_weights, maximize, depth, version, ctx, n_workers)
+                #The next iteration searches the best move of this one first, then the others by score
+                order = sorted(range(len(children)), key=lambda i: scores[i], reverse=maximize)
+                order.remove(index)
+                order.insert(0, index)
+                children = [children[i] for i in order]
+                best_score = scores[index]
+                pv = [children[0][0]]
+        except SearchTimeout:
+            break
+        completed_depth = depth
+        ctx.enforce_limits = True
+
+        if abs(best_score) >= MIN_WIN_SCORE:
+            break
+        #The next iteration takes several times longer than this one, don't start it if it can't finish
+        if ctx.deadline is not None and ctx.elapsed() > ctx.time_limit / 2:
+            break
+
+    if smp_pool is not None:
+        ctx.nodes += smp_pool.stop()
 
     print('Black options:' if maximize else 'White options:')
-    print(children[index], scores[index])
-    best = children[index][0]  
+    print(children[0], best_score, 'depth', completed_depth)
+    best = children[0][0]
+    if len(children) > 1:
+        root_score = best_score if search_version == 1 or maximize else -best_score
+        tt.store(root_key, completed_depth, root_score, TT_EXACT, best)
 
-    print('elapsed time: ', time.time() - start_time)
+    print('elapsed time: ', ctx.elapsed())
 
     agg_sdata = { 
     'branching' : round(np.mean([sum(d['branching']) / len(d['branching'])
     for d in collective_sdata])),
     'visited' : round(np.mean([sum(d['visited']) / len(d['visited'])
-    for d in collective_sdata]))
+    for d in collective_sdata])),
+    'depth' : completed_depth,
+    'nodes' : ctx.nodes,
+    'q_nodes' : ctx.q_nodes,
+    'reductions' : ctx.reductions,
+    'null_cutoffs' : ctx.null_cutoffs,
+    'ts_nodes' : ts_nodes,
+    'score' : best_score,
+    'pv' : pv
     }
+    if ordering is not None:
+        agg_sdata['first_cutoff_rate'] = ordering.first_move_cutoff_rate()
+    #a search stopped from outside did not finish what its settings asked for
+    if persistent_ctx is not None and (stop_flag is None or not stop_flag.is_set()):
+        persistent_ctx.store_result(result_key, state, best, agg_sdata)
     return best,agg_sdata
         
 def _eval_next_moves(state : BoardState,
@@ -246,42 +842,21 @@ def _eval_next_moves(state : BoardState,
                         t_weights : dict,
                         maximize : bool,
                         search_depth : int = DEFAULT_SEARCH_DEPTH,
-                        version : int = 1) -> Tuple[int,int]:
+                        version : int = 1,
+                        ctx : SearchContext = None,
+                        n_workers : int = None) -> Tuple[list,list,int]:
+    #Returns the score of every child, their search data and the index of the best child.
+    #Children after the best one so far are searched with a window, so their score is only
+    #an upper bound (lower for white) when they can't improve on it.
+    import parallel_search
 
     if len(children) == 1:        
-        return [0],[{'branching' : [1], 'visited' : [1]}]
-    else:
-        n_jobs = 4
-        collective_results = []
-        lchild = len(children)
-        index = 0
-        alpha = -math.inf
-        beta = math.inf
-
-        with Parallel(n_jobs=n_jobs, backend='threading') as parallel:
-            while index < lchild:            
-                results = parallel(
-                delayed(_eval_move)(
-                    state=deepcopy_boardstate(state),
-                    child=child,
-                    t_weights=t_weights,
-                    maximize=maximize,
-                    search_depth=search_depth - 1,
-                    version=version,
-                    alpha=alpha,
-                    beta=beta
-                ) 
-                for child in children[index:min(index+n_jobs,lchild)])
-                
-                alpha = max([r[0] for r in results])
-                beta = min([r[0] for r in results])
-
-                collective_results.extend(results)
-                index = len(collective_results)            
-
-        scores = [r[0] for r in collective_results]
-        collective_sdata = [r[1] for r in collective_results]
-        return scores,collective_sdata
+        return [0],[{'branching' : [1], 'visited' : [1]}],0
+    n_workers = parallel_search.get_default_n_workers() if n_workers is None else n_workers
+    if n_workers <= 1:
+        return parallel_search.search_root_serial(state, children, t_weights, maximize, search_depth, version, ctx)
+    pool = parallel_search.get_root_pool(n_workers)
+    return pool.search(state, children, t_weights, maximize, search_depth, version, ctx)
 
 def _eval_move(state : BoardState,
                 child : tuple,
@@ -290,7 +865,8 @@ def _eval_move(state : BoardState,
                 search_depth : int,
                 alpha : float = -math.inf,
                 beta : float = math.inf,
-                version : int = 1
+                version : int = 1,
+                ctx : SearchContext = None
                 ):    
     
     search_data={
@@ -306,7 +882,8 @@ def _eval_move(state : BoardState,
     version=version,
     search_data=search_data,
     alpha=alpha,
-    beta=beta
+    beta=beta,
+    ctx=ctx
     )
     state.unmake_last_move()
     return score,search_data
@@ -349,3 +926,207 @@ def _eval_move(state : BoardState,
 
 #             pos_to_threat[k].append((nft,next_t))
 #         return pos_to_threat
+
+
+if __name__ == '__main__':
+    import itertools
+    import random
+    from boardstate import BitBoardState
+
+    T_WEIGHTS = {'forcing' : 100, 'nforcing' : 1}
+
+    def play_random_game(n_moves : int, seed : int) -> BoardState:
+        rng = random.Random(seed)
+        state = BitBoardState(15)
+        cells = list(itertools.product(range(15), repeat=2))
+        rng.shuffle(cells)
+        for i, m in enumerate(cells[:n_moves]):
+            state.make_move(m, i % 2 == 0)
+        return state
+
+    def test_incremental_eval():
+        global STATIC_EVAL_CROSS_CHECK
+        STATIC_EVAL_CROSS_CHECK = True
+        for seed in range(10):
+            state = play_random_game(0, seed)
+            cells = list(itertools.product(range(15), repeat=2))
+            random.Random(seed).shuffle(cells)
+            for i, m in enumerate(cells[:80]):
+                state.make_move(m, i % 3 != 0)
+                for version in (1, 2):
+                    gomoku_state_static_eval(state, T_WEIGHTS, version)
+            copy = deepcopy_boardstate(state)
+            while len(state.moves) > 0:
+                state.unmake_last_move()
+                gomoku_state_static_eval(state, {'forcing' : 7, 'nforcing' : 3})
+            assert state.b_eval == [0, 0, 0] and state.w_eval == [0, 0, 0]
+            gomoku_state_static_eval(copy, T_WEIGHTS)
+        STATIC_EVAL_CROSS_CHECK = False
+
+    def benchmark_static_eval(stone_counts : tuple = (10, 40, 80), repetitions : int = 20000):
+        for n_stones in stone_counts:
+            state = play_random_game(n_stones, n_stones)
+            for version in (1, 2):
+                times = []
+                for eval_func in (gomoku_state_full_eval, gomoku_state_static_eval):
+                    start = time.time()
+                    for _ in range(repetitions):
+                        eval_func(state, T_WEIGHTS, version)
+                    times.append(time.time() - start)
+                print('stones: %3d\tversion %d\tfull: %9d evals/s\tincremental: %9d evals/s' % (
+                    n_stones, version, repetitions / times[0], repetitions / times[1]))
+
+    def play_opening(state : BoardState) -> BoardState:
+        for i, m in enumerate([(7, 7), (8, 8), (7, 8), (9, 7), (6, 9)]):
+            state.make_move(m, i % 2 == 0)
+        return state
+
+    def test_persistent_context():
+        state = play_opening(BitBoardState(15))
+        p_ctx = PersistentSearchContext()
+        args = {'t_weights' : T_WEIGHTS, 'search_depth' : 3, 'search_version' : 2, 'threat_space' : False}
+        move, sdata = gomoku_get_best_move(state, False, persistent_ctx=p_ctx, **args)
+        assert 'cached' not in sdata and p_ctx.root_ply == 5
+        #the same search again is answered from the context, a different one is not
+        assert gomoku_get_best_move(state, False, persistent_ctx=p_ctx, **args) == (move, dict(sdata, cached=True))
+        assert 'cached' not in gomoku_get_best_move(state, False, persistent_ctx=p_ctx, **dict(args, search_depth=2))[1]
+
+        #two plies later the killers of the old ply 2 are those of ply 0
+        killers = [list(k) for k in p_ctx.ordering.killers]
+        state.make_move(move, False)
+        state.make_move(sdata['pv'][1] if len(sdata['pv']) > 1 else next(iter(state.frontier)), True)
+        p_ctx.begin_search(state)
+        assert p_ctx.ordering.killers == killers[2:] and p_ctx.root_ply == 7
+
+        #reverting a turn of a game drops what depends on the moves played
+        from gomoku import Game
+        from players import AIPlayer
+        black, white = AIPlayer(search_depth=2, threat_space=False, n_workers=1), AIPlayer(search_depth=2, threat_space=False, n_workers=1)
+        game = Game(white, black, board_state_type=BitBoardState)
+        game.skip_swap2()
+        play_opening(game.board_state)
+        game.black_turn = False
+        white.play_turn()
+        assert len(white.search_ctx.results) == 1 and white.search_ctx.root_ply == 5
+        game.revert_turn()
+        assert len(white.search_ctx.results) == 0 and white.search_ctx.root_ply is None
+
+        #the results of the roots the game went past are dropped, and a new game starts empty
+        white.play_turn()
+        black.play_turn()
+        white.play_turn()
+        assert len(white.search_ctx.results) == 1 and len(black.search_ctx.results) == 1
+        game = Game(black, white, board_state_type=BitBoardState)
+        game.skip_swap2()
+        assert len(white.search_ctx.results) == 0 and white.search_ctx.root_ply is None
+
+        #the search of the player choosing white in swap2 answers its first turn
+        import random
+        random.seed(0)
+        game = Game(white, black, board_state_type=BitBoardState)
+        game.swap2_init()
+        assert 'second_placement' not in game.swap2_data and not game.black_turn
+        game.whitePlayer.play_turn()
+        assert list(game.whitePlayer.agg_sdata_coll.values())[-1]['cached']
+
+    def benchmark_persistent_context(n_moves : int = 16, search_depth : int = 4):
+        #time per move of a game between two players searching with a fresh move ordering
+        #(their tables are always kept) or with a persistent context
+        for persistent in (False, True):
+            state = play_opening(BitBoardState(15))
+            p_ctxs = {True : PersistentSearchContext(), False : PersistentSearchContext()}
+            maximize = False
+            elapsed, nodes = 0, 0
+            for _ in range(n_moves):
+                p_ctx = p_ctxs[maximize]
+                start = time.time()
+                move, sdata = gomoku_get_best_move(state, maximize, T_WEIGHTS, search_depth, tt=p_ctx.tt,
+                    search_version=2, threat_space=False, persistent_ctx=p_ctx if persistent else None)
+                elapsed += time.time() - start
+                nodes += sdata['nodes'] if 'nodes' in sdata else 0
+                state.make_move(move, maximize)
+                maximize = not maximize
+                if gomoku_check_winner(state)[0]:
+                    break
+            print('persistent context: %s\t%.3f s per move\t%d nodes per move' % (
+                persistent, elapsed / n_moves, nodes / n_moves))
+
+    def test_tt_bound_narrows_window():
+        #a stored upper bound equal to the value narrows beta to it: the search ends on the narrowed
+        #beta, but inside the window of the caller, so the result is stored as exact
+        state = play_opening(BitBoardState(15))
+        key = state.hash(True)
+        value = minimax(state, 2, True, T_WEIGHTS, search_data={'branching' : [], 'visited' : []},
+            ctx=SearchContext(TranspositionTable(1), None, None, None, 0))
+        tt = TranspositionTable(1)
+        tt.store(key, 2, value, TT_UPPER_BOUND)
+        assert minimax(state, 2, True, T_WEIGHTS, search_data={'branching' : [], 'visited' : []},
+            ctx=SearchContext(tt, None, None, None, 0)) == value
+        assert tt.probe(key)[1:3] == (value, TT_EXACT)
+
+        #negamax_pvs uses the table bounds on null windows only, which no float score falls inside:
+        #a fractional value fails high on the window just below it and low on the window just above it
+        t_weights = {'forcing' : 100, 'nforcing' : 0.3}
+        value = negamax_pvs(state, 2, True, t_weights, -math.inf, math.inf, search_data={'branching' : [], 'visited' : []},
+            ctx=SearchContext(TranspositionTable(1), None, None, None, 0))
+        assert value != int(value)
+        for alpha, beta, flag in ((_score_below(value), value, TT_LOWER_BOUND), (value, _score_above(value), TT_UPPER_BOUND)):
+            tt = TranspositionTable(1)
+            score = negamax_pvs(state, 2, True, t_weights, alpha, beta, search_data={'branching' : [], 'visited' : []},
+                ctx=SearchContext(tt, None, None, None, 0))
+            assert (score >= beta) if flag == TT_LOWER_BOUND else (score <= alpha)
+            assert tt.probe(key)[2] == flag
+
+    def test_threat_space_option():
+        #two open twos crossing at (7, 7), a win by continuous threats for black
+        import contextlib
+        import io
+        state = BitBoardState(15)
+        for i, m in enumerate([(7, 5), (0, 0), (7, 6), (0, 14), (5, 7), (14, 0), (6, 7), (14, 14)]):
+            state.make_move(m, i % 2 == 0)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            move, sdata = gomoku_get_best_move(state, True, T_WEIGHTS, 2, threat_space=True)
+        assert out.getvalue() == '' and sdata['threat_space'] == 'vct' and sdata['ts_sequence'][0] == move
+        #off by default
+        move, sdata = gomoku_get_best_move(state, True, T_WEIGHTS, 2, n_workers=1)
+        assert 'threat_space' not in sdata and sdata['ts_nodes'] == 0
+
+    def test_selective_search():
+        state = play_opening(BitBoardState(15))
+        key = state.hash(False)
+        for search_version in (1, 2):
+            args = {'t_weights' : T_WEIGHTS, 'search_depth' : 5, 'search_version' : search_version,
+                'threat_space' : False, 'n_workers' : 1}
+            move, sdata = gomoku_get_best_move(state, False, **args)
+            assert sdata['reductions'] == 0 and sdata['null_cutoffs'] == 0
+            move, sdata = gomoku_get_best_move(state, False, lmr=True, null_move=True, **args)
+            assert state.grid[move] == 0 and state.hash(False) == key
+            assert sdata['reductions'] > 0 and sdata['depth'] == 5
+            #the full windows of version 1 rarely give the static score a beta to beat
+            assert sdata['null_cutoffs'] > 0 or search_version == 1
+
+    def benchmark_selective_search(n_positions : int = 6, time_limit : float = 2.0):
+        #depth completed in time_limit seconds with and without late move reductions and null moves
+        positions = [play_random_game(n_moves, seed) for seed, n_moves in enumerate(range(8, 8 + 3 * n_positions, 3))]
+        depths = {}
+        for selective in (False, True):
+            depth, nodes = 0, 0
+            for state in positions:
+                move, sdata = gomoku_get_best_move(state, state.n_stones % 2 == 0, T_WEIGHTS, None,
+                    time_limit=time_limit, search_version=2, threat_space=False, lmr=selective, null_move=selective)
+                depth += sdata['depth']
+                nodes += sdata['nodes'] if 'nodes' in sdata else 0
+            depths[selective] = depth / len(positions)
+            print('lmr and null move: %s\t%.2f plies\t%d nodes per position' % (
+                selective, depths[selective], nodes / len(positions)))
+        print('gain: %+.2f plies' % (depths[True] - depths[False]))
+
+    test_incremental_eval()
+    test_persistent_context()
+    test_tt_bound_narrows_window()
+    test_threat_space_option()
+    test_selective_search()
+    benchmark_static_eval()
+    benchmark_persistent_context()
+    benchmark_selective_search()
@@ -0,0 +1,75 @@
+from boardstate import BoardState
+
+N_KILLERS = 2
+HASH_MOVE_PRIORITY = 100
+
+def get_threat_move_priorities(state : BoardState, maximize : bool) -> dict:
+    #Priority of the moves that raise or block a threat: moves on stronger threats come first
+    #and, at equal strength, raising our own threat comes before blocking the opponent's one.
+    #A move on a four scores 8 (7 to block it), on a three 6 (5), on a two 4 (3).
+    own, opp = (state.b_threats, state.w_threats) if maximize else (state.w_threats, state.b_threats)
+    priorities = {}
+    for threats, penalty in ((own, 0), (opp, 1)):
+        for bucket in ('forcing', 'nforcing'):
+            for t in threats[bucket]:
+                n = t.info['type'][0]
+                if n < 2:
+                    continue
+                priority = 2 * n - penalty
+                for m in t.get_counter_moves():
+                    if priorities.get(m, 0) < priority:
+                        priorities[m] = priority
+    return priorities
+
+class MoveOrdering:
+    #Killer moves (per ply) and history scores learned during a search, used to sort the
+    #children of each node: hash move, threat moves, killers, then history.
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.killers = []
+        self.history = {}
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+
+    def new_search(self, plies : int):
+        #Keeps the tables for a search whose root is plies moves after the previous root: killers
+        #move up to the ply they now belong to and history scores are halved, so the cutoffs of
+        #the latest search weigh most. A root before the previous one (plies < 0) drops the killers.
+        self.cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.killers = self.killers[plies:] if plies >= 0 else []
+        self.history = {k : v // 2 for k, v in self.history.items() if v > 1}
+
+    def get_killers(self, ply : int) -> list:
+        while len(self.killers) <= ply:
+            self.killers.append([None] * N_KILLERS)
+        return self.killers[ply]
+
+    def order(self, state : BoardState, children : list, maximize : bool, hash_move : tuple, ply : int) -> list:
+        priorities = get_threat_move_priorities(state, maximize)
+        killers = self.get_killers(ply)
+        history = self.history
+
+        def key(child):
+            move = child[0]
+            if move == hash_move:
+                return (HASH_MOVE_PRIORITY, 0, 0)
+            killer = N_KILLERS - killers.index(move) if move in killers else 0
+            return (priorities.get(move, 0), killer, history.get((move, maximize), 0))
+        return sorted(children, key=key, reverse=True)
+
+    def record_cutoff(self, move : tuple, maximize : bool, depth : int, ply : int, move_index : int):
+        self.cutoffs += 1
+        if move_index == 0:
+            self.first_move_cutoffs += 1
+
+        killers = self.get_killers(ply)
+        if killers[0] != move:
+            killers.insert(0, move)
+            killers.pop()
+        self.history[(move, maximize)] = self.history.get((move, maximize), 0) + depth * depth
+
+    def first_move_cutoff_rate(self) -> float:
+        return round(self.first_move_cutoffs / self.cutoffs, 4) if self.cutoffs > 0 else 0.0
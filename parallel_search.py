@@ -0,0 +1,429 @@
+import atexit
+import math
+import multiprocessing as mp
+import os
+import time
+
+from array import array
+from collections import OrderedDict
+from typing import List, Tuple
+from boardstate import BoardState, deepcopy_boardstate
+from minimax import (
+SearchContext,
+SearchTimeout,
+_eval_move,
+_get_aspiration_center,
+_get_ordered_children,
+_search_root_aspiration
+)
+from move_ordering import MoveOrdering
+from ttable import DEFAULT_TT_SIZE_MB, SharedTranspositionTable, TranspositionTable
+
+#One pool per worker count, kept alive across moves
+_ROOT_POOLS = {}
+#Lazy SMP helper pools, one per (helper count, table name)
+_SMP_POOLS = {}
+#Table used by Lazy SMP searches that are not given one
+_DEFAULT_SHARED_TT = None
+#Search state of a worker process, set by _init_worker
+_WORKER = None
+#Tables kept by a root search worker, one per caller and search settings (the two players of a match)
+WORKER_TABLES = 2
+
+def encode_moves(moves : list, size : int) -> bytes:
+    #Two bytes per move: (column * size + row) << 1 | is_black
+    return array('H', [((c * size + r) << 1) | int(black) for c,r,black in moves]).tobytes()
+
+def decode_moves(data : bytes, size : int) -> list:
+    codes = array('H')
+    codes.frombytes(data)
+    return [((code >> 1) // size, (code >> 1) % size, bool(code & 1)) for code in codes]
+
+def get_default_n_workers() -> int:
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def get_root_pool(n_workers : int = None) -> 'RootSearchPool':
+    n_workers = get_default_n_workers() if n_workers is None else n_workers
+    if n_workers not in _ROOT_POOLS:
+        _ROOT_POOLS[n_workers] = RootSearchPool(n_workers)
+    return _ROOT_POOLS[n_workers]
+
+def get_smp_pool(n_helpers : int, tt : SharedTranspositionTable) -> 'LazySMPPool':
+    key = (n_helpers, tt.name)
+    if key not in _SMP_POOLS:
+        _SMP_POOLS[key] = LazySMPPool(n_helpers, tt)
+    return _SMP_POOLS[key]
+
+def get_default_shared_tt() -> SharedTranspositionTable:
+    global _DEFAULT_SHARED_TT
+    if _DEFAULT_SHARED_TT is None:
+        _DEFAULT_SHARED_TT = SharedTranspositionTable(DEFAULT_TT_SIZE_MB)
+    return _DEFAULT_SHARED_TT
+
+def close_root_pools():
+    for pool in list(_ROOT_POOLS.values()) + list(_SMP_POOLS.values()):
+        pool.close()
+    _ROOT_POOLS.clear()
+    _SMP_POOLS.clear()
+
+atexit.register(close_root_pools)
+
+def _get_window(bound : float, maximize : bool) -> tuple:
+    #bound is the best score found so far at the root, from the point of view of the root player
+    return (bound, math.inf) if maximize else (-math.inf, -bound)
+
+def _is_exact(score : float, alpha : float, beta : float, maximize : bool) -> bool:
+    #Children only improving on the bound are exact, the others only proved they are not better
+    return score > alpha if maximize else score < beta
+
+def _collect_results(results : list, maximize : bool) -> tuple:
+    scores = [r[0] for r in results]
+    collective_sdata = [r[3] for r in results]
+    best_index = None
+    for i in range(len(results)):
+        score, alpha, beta, _ = results[i]
+        if not _is_exact(score, alpha, beta, maximize):
+            continue
+        if (best_index is None or
+            (maximize and score > scores[best_index]) or
+            (not maximize and score < scores[best_index])):
+            best_index = i
+    return scores, collective_sdata, best_index
+
+def search_root_serial(state : BoardState,
+                    children : List[Tuple],
+                    t_weights : dict,
+                    maximize : bool,
+                    search_depth : int,
+                    version : int,
+                    ctx : SearchContext) -> tuple:
+    #Same splitting as RootSearchPool in the calling process, used when only one core is available
+    search_state = deepcopy_boardstate(state)
+    bound = -math.inf
+    results = []
+    for child in children:
+        alpha, beta = _get_window(bound, maximize)
+        score, search_data = _eval_move(search_state, child, t_weights, maximize, search_depth - 1, alpha, beta, version, ctx)
+        if _is_exact(score, alpha, beta, maximize):
+            bound = max(bound, score if maximize else -score)
+        results.append((score, alpha, beta, search_data))
+    return _collect_results(results, maximize)
+
+def _init_worker(bound : mp.Value, tt_size_mb : float):
+    global _WORKER
+    _WORKER = {
+        'bound' : bound,
+        'tt_size_mb' : tt_size_mb,
+        'tables' : OrderedDict(),
+        'state' : None
+    }
+
+def _get_worker_tables(key : tuple) -> dict:
+    #Transposition table and move ordering of one caller and search settings: scores of another
+    #evaluation, or of searches pruned differently, can't be reused. The least recently used are dropped.
+    tables = _WORKER['tables']
+    if key in tables:
+        tables.move_to_end(key)
+    else:
+        if len(tables) >= WORKER_TABLES:
+            tables.popitem(last=False)
+        tables[key] = {
+            'tt' : TranspositionTable(_WORKER['tt_size_mb']),
+            'ordering' : MoveOrdering(),
+            'root' : None,
+            'root_ply' : 0
+        }
+    return tables[key]
+
+def _sync_worker_state(state_type : type, size : int, moves : list) -> BoardState:
+    #Workers keep the last position they searched and only replay the moves that differ,
+    #which in a game is usually the two moves played since the previous search
+    state = _WORKER['state']
+    if state is None or type(state) is not state_type or state.size != size:
+        state = state_type(size)
+        _WORKER['state'] = state
+
+    common = 0
+    while common < len(moves) and common < len(state.moves) and tuple(state.moves[common]) == moves[common]:
+        common += 1
+    while len(state.moves) > common:
+        state.unmake_last_move()
+    for c,r,black in moves[common:]:
+        state.make_move((c,r), black)
+    return state
+
+def _search_child_task(task : tuple) -> tuple:
+    index, owner, state_type, size, encoded, move, maximize, t_weights, depth, version, deadline, node_limit, quiescence, lmr, null_move = task
+    worker = _WORKER
+    moves = decode_moves(encoded, size)
+    state = _sync_worker_state(state_type, size, moves)
+    tables = _get_worker_tables((owner, tuple(sorted(t_weights.items())), version, quiescence, lmr, null_move))
+
+    #table generations and move ordering tables move on when the root position changes
+    root = (encoded, maximize)
+    if tables['root'] != root:
+        plies = -1 if tables['root'] is None else len(moves) - tables['root_ply']
+        tables['root'] = root
+        tables['root_ply'] = len(moves)
+        tables['tt'].new_search()
+        tables['ordering'].new_search(plies)
+
+    ctx = SearchContext(tables['tt'], None, node_limit, tables['ordering'], len(moves))
+    ctx.deadline = deadline
+    ctx.enforce_limits = deadline is not None or node_limit is not None
+    ctx.quiescence = quiescence
+    ctx.lmr = lmr
+    ctx.null_move = null_move
+
+    bound = worker['bound']
+    alpha, beta = _get_window(bound.value, maximize)
+    try:
+        score, search_data = _eval_move(state, (move, maximize), t_weights, maximize, depth - 1, alpha, beta, version, ctx)
+    except SearchTimeout:
+        #the interrupted search left moves on the board
+        worker['state'] = None
+        return index, None, ctx.nodes
+
+    if _is_exact(score, alpha, beta, maximize):
+        value = score if maximize else -score
+        with bound.get_lock():
+            if value > bound.value:
+                bound.value = value
+    return index, (score, alpha, beta, search_data), ctx.nodes
+
+class RootSearchPool:
+    #Process pool splitting the root children among workers. Each child is a separate task, so
+    #a worker becomes free as soon as its child is done and the next child starts with the best
+    #bound found so far, which the workers share through a double in shared memory.
+    #Workers keep a transposition table and move ordering for each caller (told apart by its own
+    #table) and search settings, so every player of a match keeps its tables from move to move.
+    def __init__(self, n_workers : int = None, tt_size_mb : float = DEFAULT_TT_SIZE_MB):
+        self.n_workers = get_default_n_workers() if n_workers is None else n_workers
+        self.bound = mp.Value('d', -math.inf)
+        self.pool = mp.Pool(self.n_workers, initializer=_init_worker, initargs=(self.bound, tt_size_mb))
+
+    def search(self,
+            state : BoardState,
+            children : List[Tuple],
+            t_weights : dict,
+            maximize : bool,
+            search_depth : int,
+            version : int,
+            ctx : SearchContext) -> tuple:
+        self.bound.value = -math.inf
+        encoded = encode_moves(state.moves, state.size)
+        deadline = ctx.deadline if ctx.enforce_limits else None
+        node_limit = None
+        if ctx.enforce_limits and ctx.node_limit is not None:
+            node_limit = max(0, ctx.node_limit - ctx.nodes)
+        #workers keep separate tables for every caller, identified by its transposition table
+        owner = id(ctx.tt)
+        tasks = [(i, owner, type(state), state.size, encoded, children[i][0], maximize, t_weights,
+                search_depth, version, deadline, node_limit, ctx.quiescence, ctx.lmr, ctx.null_move) for i in range(len(children))]
+
+        results = [None] * len(children)
+        timed_out = False
+        for index, result, nodes in self.pool.imap_unordered(_search_child_task, tasks):
+            ctx.nodes += nodes
+            if result is None:
+                timed_out = True
+            results[index] = result
+        #all the tasks are collected before giving up, so the next search starts on idle workers
+        if timed_out:
+            raise SearchTimeout()
+        return _collect_results(results, maximize)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+def _init_smp_helper(tt : SharedTranspositionTable, stop_flag : mp.Event):
+    global _WORKER
+    _WORKER = {
+        'tt' : tt,
+        'stop' : stop_flag,
+        'state' : None
+    }
+
+def _smp_helper_task(task : tuple) -> int:
+    helper, state_type, size, encoded, maximize, t_weights, search_depth, version, deadline, quiescence, lmr, null_move = task
+    worker = _WORKER
+    moves = decode_moves(encoded, size)
+    state = _sync_worker_state(state_type, size, moves)
+    tt = worker['tt']
+
+    ctx = SearchContext(tt, None, None, MoveOrdering(), len(moves))
+    ctx.deadline = deadline
+    ctx.stop_flag = worker['stop']
+    ctx.quiescence = quiescence
+    ctx.lmr = lmr
+    ctx.null_move = null_move
+    ctx.enforce_limits = True
+
+    children = _get_ordered_children(state, maximize, tt.get_move(state.hash(maximize)), ctx)
+    if len(children) < 2:
+        return 0
+    #every helper tries the moves after the first one in a different order, and half of them start
+    #one ply deeper, so they write different parts of the tree in the table
+    rest = children[1:]
+    shift = helper % len(rest)
+    children = [children[0]] + rest[shift:] + rest[:shift]
+    iteration_scores = []
+    try:
+        for depth in range(1 + (helper + 1) % 2, search_depth + 1):
+            score, index, _, _ = _search_root_aspiration(state, children, t_weights, maximize, depth, version, ctx,
+                                                        _get_aspiration_center(iteration_scores))
+            iteration_scores.append(score)
+            children.insert(0, children.pop(index))
+    except SearchTimeout:
+        worker['state'] = None
+    return ctx.nodes
+
+class LazySMPPool:
+    #Helper processes searching the same root as the main search, at staggered depths. They only
+    #communicate through the shared transposition table and run until the main search stops them.
+    def __init__(self, n_helpers : int, tt : SharedTranspositionTable):
+        self.n_helpers = n_helpers
+        self.stop_flag = mp.Event()
+        self.pool = mp.Pool(n_helpers, initializer=_init_smp_helper, initargs=(tt, self.stop_flag))
+        self.pending = []
+
+    def start(self,
+            state : BoardState,
+            maximize : bool,
+            t_weights : dict,
+            search_depth : int,
+            version : int,
+            deadline : float = None,
+            quiescence : bool = False,
+            lmr : bool = False,
+            null_move : bool = False):
+        self.stop_flag.clear()
+        encoded = encode_moves(state.moves, state.size)
+        self.pending = [self.pool.apply_async(_smp_helper_task,
+            ((i, type(state), state.size, encoded, maximize, t_weights, search_depth, version, deadline, quiescence, lmr, null_move),))
+            for i in range(self.n_helpers)]
+
+    def stop(self) -> int:
+        #returns the number of nodes searched by the helpers
+        self.stop_flag.set()
+        nodes = sum([r.get() for r in self.pending])
+        self.pending = []
+        return nodes
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+if __name__ == '__main__':
+    import contextlib
+    import io
+    import sys
+    from boardstate import BitBoardState
+    from minimax import gomoku_get_best_move
+
+    POSITIONS = [
+        [((7,7),True),((8,8),False),((7,8),True),((6,6),False),((8,7),True),((9,9),False)],
+        [((7,7),True),((7,8),False),((8,8),True),((6,6),False),((9,9),True),((10,10),False),((8,6),True)],
+        [((7,7),True),((6,8),False),((8,7),True),((9,7),False),((7,9),True),((7,8),False),((8,9),True),((6,9),False)],
+        [((5,5),True),((6,6),False),((5,7),True),((7,7),False),((6,5),True),((8,8),False),((4,6),True)],
+    ]
+    T_WEIGHTS = {'forcing' : 100, 'nforcing' : 1}
+
+    def get_positions():
+        states = []
+        for moves in POSITIONS:
+            state = BitBoardState(15)
+            for move, black in moves:
+                state.make_move(move, black)
+            states.append((state, len(moves) % 2 == 0))
+        return states
+
+    def test_encode_moves():
+        moves = [(7,7,True),(0,14,False),(14,0,True),(14,14,False)]
+        data = encode_moves(moves, 15)
+        assert len(data) == 2 * len(moves)
+        assert decode_moves(data, 15) == moves
+
+    def test_pool_matches_serial():
+        for state, maximize in get_positions():
+            expected = None
+            for n_workers in (1, 2):
+                with contextlib.redirect_stdout(io.StringIO()):
+                    move, sdata = gomoku_get_best_move(state, maximize, T_WEIGHTS, search_depth=3, n_workers=n_workers)
+                score = sdata.get('score')
+                if expected is None:
+                    expected = score
+                assert score == expected, (n_workers, score, expected)
+
+    def test_worker_tables_per_settings():
+        #a player searching with another evaluation, or a second player, gets its own worker tables
+        _init_worker(mp.Value('d', -math.inf), 1)
+        v1 = _get_worker_tables((1, (('forcing', 100), ('nforcing', 1)), 1, False, False, False))
+        v2 = _get_worker_tables((1, (('forcing', 100), ('nforcing', 1)), 2, False, False, False))
+        assert v1['tt'] is not v2['tt'] and v1['ordering'] is not v2['ordering']
+        assert _get_worker_tables((1, (('forcing', 100), ('nforcing', 1)), 1, False, False, False)) is v1
+        _get_worker_tables((2, (('forcing', 100), ('nforcing', 1)), 1, False, False, False))
+        assert len(_WORKER['tables']) == WORKER_TABLES and v2 not in _WORKER['tables'].values()
+
+        #the pool scores a version 2 search like a fresh search, after the same table searched with version 1
+        tt = TranspositionTable(8)
+        for state, maximize in get_positions():
+            with contextlib.redirect_stdout(io.StringIO()):
+                gomoku_get_best_move(state, maximize, T_WEIGHTS, search_depth=3, tt=tt, n_workers=2, threat_space=False)
+                _, sdata = gomoku_get_best_move(state, maximize, T_WEIGHTS, search_depth=3, version=2, tt=tt, n_workers=2, threat_space=False)
+                _, expected = gomoku_get_best_move(state, maximize, T_WEIGHTS, search_depth=3, version=2, n_workers=1, threat_space=False)
+            assert sdata['score'] == expected['score'], (sdata['score'], expected['score'])
+
+    def benchmark_root_search(depth : int = 4, worker_counts : tuple = (1, 2, 4, 8)):
+        print('cores available:', get_default_n_workers())
+        base_time = None
+        for n_workers in worker_counts:
+            if n_workers > 1:
+                #start the workers outside of the measurement
+                get_root_pool(n_workers)
+            start_time = time.time()
+            for state, maximize in get_positions():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    gomoku_get_best_move(state, maximize, T_WEIGHTS, search_depth=depth, n_workers=n_workers)
+            elapsed = time.time() - start_time
+            base_time = elapsed if base_time is None else base_time
+            print('workers: %d\ttime: %.2f s\tspeedup: %.2f' % (n_workers, elapsed, base_time / elapsed))
+
+    def test_lazy_smp_search():
+        #helpers may store deeper results than the main search asked for, so the score can differ
+        #from a single process search, but the search must complete with a legal move
+        tt = SharedTranspositionTable(8)
+        for state, maximize in get_positions():
+            with contextlib.redirect_stdout(io.StringIO()):
+                move, sdata = gomoku_get_best_move(state, maximize, T_WEIGHTS, search_depth=3,
+                                                tt=tt, search_version=3, n_workers=3)
+            assert state.grid[move] == 0
+            assert sdata['depth'] == 3 and sdata['pv'][0] == move
+        tt.close()
+
+    def benchmark_lazy_smp(depth : int = 4, worker_counts : tuple = (1, 2, 4, 8)):
+        base_time = None
+        for n_workers in worker_counts:
+            tt = SharedTranspositionTable(32)
+            if n_workers > 1:
+                get_smp_pool(n_workers - 1, tt)
+            start_time = time.time()
+            for state, maximize in get_positions():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    gomoku_get_best_move(state, maximize, T_WEIGHTS, search_depth=depth,
+                                        tt=tt, search_version=3, n_workers=n_workers)
+            elapsed = time.time() - start_time
+            base_time = elapsed if base_time is None else base_time
+            print('lazy smp workers: %d\ttime to depth %d: %.2f s\tspeedup: %.2f' % (n_workers, depth, elapsed, base_time / elapsed))
+
+    test_encode_moves()
+    test_pool_matches_serial()
+    test_worker_tables_per_settings()
+    test_lazy_smp_search()
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark_root_search()
+        benchmark_lazy_smp()
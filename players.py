@@ -1,11 +1,13 @@
 from operator import xor
 import random
 from shutil import ExecError
-from threats import B_THREAT_DATA, W_THREAT_DEP, B_THREAT_DEP, _get_threat_class_from_info
+from threats import B_THREAT_DATA, _get_threat_class_from_info
 from time import time
 from utils import is_valid_move
-from minimax import DEFAULT_SEARCH_DEPTH, gomoku_get_best_move, gomoku_state_static_eval
-import networkx as nx
+from mcts import DEFAULT_MCTS_TIME_LIMIT, MCTS_BATCH_SIZE, MCTS_EXPLORATION, mcts_get_best_move
+from minimax import DEFAULT_SEARCH_DEPTH, PersistentSearchContext, gomoku_get_best_move, gomoku_state_static_eval
+from ponder import Ponderer, get_ponder_time_limit
+from ttable import DEFAULT_TT_SIZE_MB, SharedTranspositionTable, TranspositionTable
 
 OPENINGS = [
     ([(7,7),(8,10)],[(8,7)]),
@@ -87,7 +89,16 @@ class AIPlayer(Player):
                 seed : int = None,
                 t_weights : dict = None,
                 version : int = 1,
-                opening_version : int = 1
+                opening_version : int = 1,
+                tt_size_mb : float = DEFAULT_TT_SIZE_MB,
+                time_limit : float = None,
+                search_version : int = 1,
+                n_workers : int = None,
+                quiescence : bool = False,
+                threat_space : bool = False,
+                ponder : bool = False,
+                lmr : bool = False,
+                null_move : bool = False
                 ):
 
         super().__init__()
@@ -99,6 +110,31 @@ class AIPlayer(Player):
         self.search_depth = search_depth
         self.version = version
         self.opening_version = opening_version
+        self.tt_size_mb = tt_size_mb
+        #Lazy SMP (search_version 3) helpers share the table through shared memory
+        self.tt = SharedTranspositionTable(tt_size_mb) if search_version == 3 else TranspositionTable(tt_size_mb)
+        #table, move ordering and search results kept from one move to the next
+        self.search_ctx = PersistentSearchContext(self.tt)
+        #game the search context belongs to
+        self.ctx_game = None
+        #With a time limit (seconds per move) search_depth is the deepest iteration of the search
+        self.time_limit = time_limit
+        #1: minimax with a parallel root, 2: principal variation search with aspiration windows,
+        #3: principal variation search with Lazy SMP helpers
+        self.search_version = search_version
+        #processes used by search_version 1 and 3, all the available cores if None
+        self.n_workers = n_workers
+        #extend the leaves of the search with forcing moves
+        self.quiescence = quiescence
+        #look for a win by continuous fours or threats before searching
+        self.threat_space = threat_space
+        #selective search: late move reductions and null-move pruning
+        self.lmr = lmr
+        self.null_move = null_move
+        #search the reply predicted by the principal variation while the opponent thinks
+        self.ponder = ponder
+        self.ponderer = Ponderer() if ponder else None
+        self.last_pv = []
         self.agg_sdata_coll = {}
 
         if t_weights is None:
@@ -166,12 +202,22 @@ class AIPlayer(Player):
         #     return
         
         # self.game.swap2_accept_or_place(self,'place')        
+        self._join_game()
         move,_=gomoku_get_best_move(
             state=bstate,
             maximize=False,
             t_weights=self.t_weights,
             search_depth=self.search_depth,
-            version=self.version)            
+            version=self.version,
+            tt=self.tt,
+            time_limit=self.time_limit,
+            search_version=self.search_version,
+            n_workers=self.n_workers,
+            quiescence=self.quiescence,
+            threat_space=self.threat_space,
+            lmr=self.lmr,
+            null_move=self.null_move,
+            persistent_ctx=self.search_ctx)            
         bstate.make_move(move,False)
         eval=gomoku_state_static_eval(state=bstate,t_weights=self.t_weights,version=self.version)
         bstate.unmake_last_move()        
@@ -207,12 +253,22 @@ class AIPlayer(Player):
 
         # state_score = gomoku_state_static_eval(state=bstate,t_weights=self.t_weights,version=self.version)
         # if state_score > 0:
+        self._join_game()
         best_white_move,_ = gomoku_get_best_move(
             state=bstate,
             maximize=False,
             t_weights=self.t_weights,
             search_depth=self.search_depth,                
-            version=self.version
+            version=self.version,
+            tt=self.tt,
+            time_limit=self.time_limit,
+            search_version=self.search_version,
+            n_workers=self.n_workers,
+            quiescence=self.quiescence,
+            threat_space=self.threat_space,
+            lmr=self.lmr,
+            null_move=self.null_move,
+            persistent_ctx=self.search_ctx
             )
         bstate.make_move(best_white_move, False)
         new_state_score = gomoku_state_static_eval(state=bstate,t_weights=self.t_weights,version=self.version)
@@ -228,7 +284,67 @@ class AIPlayer(Player):
         return {
             'search_depth' : self.search_depth,
             'version' : self.version,
-            'seed' : self.seed
+            'seed' : self.seed,
+            'tt_size_mb' : self.tt_size_mb,
+            'time_limit' : self.time_limit,
+            'search_version' : self.search_version,
+            'n_workers' : self.n_workers,
+            'quiescence' : self.quiescence,
+            'threat_space' : self.threat_space,
+            'ponder' : self.ponder,
+            'lmr' : self.lmr,
+            'null_move' : self.null_move
+        }
+
+    def assign_color(self, color):
+        super().assign_color(color)
+        self._join_game()
+        self.game.add_revert_callback(self.search_ctx.invalidate)
+        if self.ponderer is not None:
+            self.ponderer.cancel()
+            #an engine in the same process searches on our time, pondering would take its CPU
+            opponent = self.game.whitePlayer if self.game.blackPlayer is self else self.game.blackPlayer
+            if isinstance(opponent, AIPlayer):
+                return
+            self.game.add_turn_change_callback(self._on_turn_change)
+            self.game.add_game_end_callback(self.ponderer.cancel)
+
+    def _join_game(self):
+        #The context is kept through the game, the searches of swap2 included, and reset on a new one
+        if self.ctx_game is not self.game:
+            self.search_ctx.new_game()
+            self.ctx_game = self.game
+
+    def _on_turn_change(self):
+        #After our move ponder on the reply predicted by the last search, stop as soon as the
+        #opponent plays anything else (or a turn is reverted)
+        state = self.game.board_state
+        maximize = self.color == 'black'
+        if self.can_play():
+            if not self.ponderer.is_hit(state, maximize):
+                self.ponderer.cancel()
+        elif (self.game.winning_player is None and len(self.last_pv) > 1 and len(state.moves) > 0 
+                and tuple(state.moves[-1][:2]) == tuple(self.last_pv[0])):
+            self.ponderer.start(state, maximize, self.last_pv[1], self._get_ponder_search_args())
+        else:
+            self.ponderer.cancel()
+
+    def _get_ponder_search_args(self) -> dict:
+        #the process pools of the parallel searches are driven by the main thread only,
+        #so the ponder search runs serially (without the Lazy SMP helpers for search_version 3)
+        return {
+            't_weights' : self.t_weights,
+            'search_depth' : self.search_depth,
+            'time_limit' : get_ponder_time_limit(self.time_limit, self.search_depth),
+            'version' : self.version,
+            'tt' : self.tt,
+            'search_version' : self.search_version,
+            'n_workers' : 1,
+            'quiescence' : self.quiescence,
+            'threat_space' : self.threat_space,
+            'lmr' : self.lmr,
+            'null_move' : self.null_move,
+            'persistent_ctx' : self.search_ctx
         }
 
     def play_turn(self):
@@ -237,19 +353,95 @@ class AIPlayer(Player):
 
         print('ai', self.color,'thinking...')
         maximize = True if self.color == 'black' else False
-        best_move,agg_sdata = gomoku_get_best_move(
+        #on a ponder hit the search already running on this position gets the time of the move
+        pondered = None
+        if self.ponderer is not None:
+            pondered = self.ponderer.take(self.game.board_state, maximize, self.time_limit)
+        if pondered is not None:
+            best_move,agg_sdata = pondered
+        else:
+            best_move,agg_sdata = gomoku_get_best_move(
                                         state=self.game.board_state,
                                         search_depth=self.search_depth,
                                         maximize=maximize,
                                         t_weights=self.t_weights,
-                                        version=self.version
+                                        version=self.version,
+                                        tt=self.tt,
+                                        time_limit=self.time_limit,
+                                        search_version=self.search_version,
+                                        n_workers=self.n_workers,
+                                        quiescence=self.quiescence,
+                                        threat_space=self.threat_space,
+                                        lmr=self.lmr,
+                                        null_move=self.null_move,
+                                        persistent_ctx=self.search_ctx
                                         )
+        self.last_pv = agg_sdata['pv']
         
         self.agg_sdata_coll[str((best_move[0],best_move[1],maximize))] = agg_sdata
         if not self.game.turn(self,best_move):
             raise Exception('%s player was supposed to play but couldn\'t.' % (self.color))
         print('ai', self.color,'done')
 
+
+class MCTSPlayer(AIPlayer):
+    #Plays the moves found by a Monte Carlo tree search, the swap2 opening is left to the
+    #alpha-beta search of AIPlayer
+    def __init__(self,
+                time_limit : float = DEFAULT_MCTS_TIME_LIMIT,
+                n_playouts : int = None,
+                n_workers : int = None,
+                exploration : float = MCTS_EXPLORATION,
+                batch_size : int = MCTS_BATCH_SIZE,
+                search_depth : int = DEFAULT_SEARCH_DEPTH,
+                seed : int = None,
+                t_weights : dict = None,
+                version : int = 1,
+                opening_version : int = 1
+                ):
+        super().__init__(search_depth=search_depth, seed=seed, t_weights=t_weights, version=version,
+            opening_version=opening_version, time_limit=time_limit, n_workers=n_workers)
+        #playouts per tree, the search runs for time_limit seconds if None
+        self.n_playouts = n_playouts
+        self.exploration = exploration
+        #rollouts played from every leaf of the tree
+        self.batch_size = batch_size
+
+    def get_definition(self) -> dict:
+        return {
+            'search_depth' : self.search_depth,
+            'version' : self.version,
+            'seed' : self.seed,
+            'time_limit' : self.time_limit,
+            'n_playouts' : self.n_playouts,
+            'n_workers' : self.n_workers,
+            'exploration' : self.exploration,
+            'batch_size' : self.batch_size
+        }
+
+    def play_turn(self):
+        if not self.can_play():
+            return
+
+        print('ai', self.color,'thinking...')
+        maximize = True if self.color == 'black' else False
+        best_move,agg_sdata = mcts_get_best_move(
+                                    state=self.game.board_state,
+                                    maximize=maximize,
+                                    time_limit=self.time_limit,
+                                    n_playouts=self.n_playouts,
+                                    n_workers=self.n_workers,
+                                    exploration=self.exploration,
+                                    batch_size=self.batch_size,
+                                    seed=self.seed + len(self.game.board_state.moves)
+                                    )
+        self.last_pv = agg_sdata['pv']
+
+        self.agg_sdata_coll[str((best_move[0],best_move[1],maximize))] = agg_sdata
+        if not self.game.turn(self,best_move):
+            raise Exception('%s player was supposed to play but couldn\'t.' % (self.color))
+        print('ai', self.color,'done')
+
         
 class AIRandomPlayer(AIPlayer):
     def swap2_first_place_stones(self):
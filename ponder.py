@@ -0,0 +1,191 @@
+from threading import Event, Thread
+import time
+
+from boardstate import BoardState, deepcopy_boardstate
+from minimax import gomoku_get_best_move
+
+#A ponder search of a time limited player stops after this many times its time limit
+PONDER_TIME_FACTOR = 4
+#Seconds a ponder search may take when the player has neither a time limit nor a search depth
+PONDER_TIME_LIMIT = 10.0
+
+def get_ponder_time_limit(time_limit : float, search_depth : int) -> float:
+    #time_limit of the ponder search of a player searching for time_limit seconds (search_depth plies),
+    #None when the search depth alone bounds it
+    if time_limit is not None:
+        return PONDER_TIME_FACTOR * time_limit
+    if search_depth is None:
+        return PONDER_TIME_LIMIT
+    return None
+
+class Ponderer:
+    #Searches on the opponent's time. After the player moves, start() plays the reply predicted by
+    #the principal variation of its last search on a copy of the board and searches the resulting
+    #position in a background thread, deepening one ply at a time and filling the player's
+    #transposition table. If the opponent plays the predicted move, take() lets the search go on for
+    #the player's time budget and returns its best move, otherwise cancel() stops it.
+    #The thread shares the interpreter lock with the rest of the process, so the time won is the
+    #time the process would spend waiting (a human opponent, another process): AIPlayer does not
+    #ponder against another AIPlayer, and the search is bounded by get_ponder_time_limit.
+    def __init__(self):
+        self.stop_flag = Event()
+        self.thread = None
+        self.key = None
+        self.move = None
+        self.result = None
+        self.start_time = None
+
+    def is_active(self) -> bool:
+        return self.thread is not None
+
+    def start(self, state : BoardState, maximize : bool, predicted_move : tuple, search_args : dict):
+        #maximize is the side of the pondering player, predicted_move the opponent's reply and
+        #search_args the keyword arguments of gomoku_get_best_move but state, maximize and stop_flag
+        self.cancel()
+        ponder_state = deepcopy_boardstate(state)
+        ponder_state.make_move(predicted_move, not maximize)
+        self.key = ponder_state.hash(maximize)
+        self.move = predicted_move
+        self.result = None
+        self.start_time = time.time()
+        self.stop_flag.clear()
+        self.thread = Thread(target=self._run, args=(ponder_state, maximize, search_args), daemon=True)
+        self.thread.start()
+
+    def _run(self, state : BoardState, maximize : bool, search_args : dict):
+        self.result = gomoku_get_best_move(state=state, maximize=maximize, stop_flag=self.stop_flag, **search_args)
+
+    def is_hit(self, state : BoardState, maximize : bool) -> bool:
+        return self.is_active() and state.hash(maximize) == self.key
+
+    def take(self, state : BoardState, maximize : bool, time_limit : float = None) -> tuple:
+        #(best move, search data) of the ponder search if it is searching state, None otherwise.
+        #The search is given time_limit more seconds, or left to reach its depth if None.
+        if not self.is_hit(state, maximize):
+            self.cancel()
+            return None
+        ponder_time = time.time() - self.start_time
+        self.thread.join(time_limit)
+        self.cancel()
+        if self.result is None:
+            return None
+        best_move, agg_sdata = self.result
+        agg_sdata['ponder'] = 'hit'
+        agg_sdata['ponder_time'] = ponder_time
+        return best_move, agg_sdata
+
+    def cancel(self):
+        if self.thread is None:
+            return
+        self.stop_flag.set()
+        self.thread.join()
+        self.thread = None
+        self.key = None
+        self.move = None
+
+
+if __name__ == '__main__':
+    from boardstate import BitBoardState
+    from gomoku import Game
+    from players import AIPlayer, Player
+
+    class ScriptedPlayer(Player):
+        #plays the moves passed to play()
+        def play(self, move : tuple):
+            assert self.game.turn(self, move)
+
+    def setup_game(ponder : bool = True, **ai_args) -> tuple:
+        ai = AIPlayer(ponder=ponder, threat_space=False, n_workers=1, **ai_args)
+        opp = ScriptedPlayer()
+        game = Game(opp, ai, board_state_type=BitBoardState)
+        game.skip_swap2()
+        for i, m in enumerate([(7, 7), (8, 8), (7, 8), (9, 7)]):
+            game.board_state.make_move(m, i % 2 == 0)
+        return game, ai, opp
+
+    def test_ponder_hit():
+        game, ai, opp = setup_game(search_depth=3, search_version=2)
+        ai.play_turn()
+        assert ai.ponderer.is_active()
+        predicted = ai.ponderer.move
+        opp.play(predicted)
+        assert ai.ponderer.is_active()
+        ai.play_turn()
+        sdata = list(ai.agg_sdata_coll.values())[-1]
+        assert sdata['ponder'] == 'hit' and sdata['depth'] == 3
+        #and it ponders again on the next reply
+        assert ai.ponderer.is_active()
+        ai.ponderer.cancel()
+
+    def test_ponder_miss():
+        game, ai, opp = setup_game(search_depth=3, search_version=2)
+        ai.play_turn()
+        predicted = ai.ponderer.move
+        other = next(m for m in sorted(game.board_state.frontier) if m != predicted)
+        opp.play(other)
+        #the turn callback cancels the search as soon as the opponent's move is on the board
+        assert not ai.ponderer.is_active()
+        ai.play_turn()
+        sdata = list(ai.agg_sdata_coll.values())[-1]
+        assert 'ponder' not in sdata
+        ai.ponderer.cancel()
+
+    def test_ponder_time_limit():
+        #on a hit the search gets the player's time limit on top of the time it pondered
+        game, ai, opp = setup_game(search_depth=None, search_version=2, time_limit=0.5)
+        ai.play_turn()
+        predicted = ai.ponderer.move
+        time.sleep(1.0)
+        opp.play(predicted)
+        start = time.time()
+        ai.play_turn()
+        sdata = list(ai.agg_sdata_coll.values())[-1]
+        assert sdata['ponder'] == 'hit' and sdata['ponder_time'] >= 1.0
+        assert time.time() - start < 2.0
+        ai.ponderer.cancel()
+
+    def test_no_ponder_against_ai():
+        #both engines share the process, the ponder search would eat into the opponent's time
+        ai = AIPlayer(ponder=True, threat_space=False, n_workers=1, search_depth=2, search_version=2)
+        opp = AIPlayer(threat_space=False, n_workers=1, search_depth=2, search_version=2)
+        game = Game(opp, ai, board_state_type=BitBoardState)
+        game.skip_swap2()
+        for i, m in enumerate([(7, 7), (8, 8), (7, 8), (9, 7)]):
+            game.board_state.make_move(m, i % 2 == 0)
+        ai.play_turn()
+        assert not ai.ponderer.is_active()
+
+    def test_ponder_bounded():
+        #the ponder search stops on its own when the opponent never moves
+        game, ai, opp = setup_game(search_depth=None, search_version=2, time_limit=0.1)
+        ai.play_turn()
+        assert ai.ponderer.is_active()
+        ai.ponderer.thread.join(PONDER_TIME_FACTOR * 0.1 + 2.0)
+        assert not ai.ponderer.thread.is_alive()
+        ai.ponderer.cancel()
+
+    def benchmark_ponder(search_depth : int = 4, think_time : float = 2.0, n_moves : int = 4):
+        #wall-clock time of the player's turns when the opponent thinks for think_time seconds
+        #and always plays the predicted reply, with and without pondering
+        for ponder in (False, True):
+            game, ai, opp = setup_game(ponder, search_depth=search_depth, search_version=2)
+            elapsed = 0
+            for _ in range(n_moves):
+                start = time.time()
+                ai.play_turn()
+                elapsed += time.time() - start
+                if game.winning_player is not None:
+                    break
+                pv = ai.last_pv
+                time.sleep(think_time)
+                opp.play(pv[1] if len(pv) > 1 else next(iter(game.board_state.frontier)))
+            if ponder:
+                ai.ponderer.cancel()
+            print('ponder: %s\t%.2f s per move' % (ponder, elapsed / n_moves))
+
+    test_ponder_hit()
+    test_ponder_miss()
+    test_ponder_time_limit()
+    test_no_ponder_against_ai()
+    test_ponder_bounded()
+    benchmark_ponder()
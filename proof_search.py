@@ -0,0 +1,405 @@
+import argparse
+import json
+import os
+import pickle
+import time
+import numpy as np
+
+from boardstate import BitBoardState, BoardState
+from minimax import gomoku_get_state_children
+from threat_space import THREAT_SPACE_WIN, ThreatSpaceSolver, get_four_cells, get_three_defences, get_threat_moves
+
+PN_INFINITY = 10**9
+DEFAULT_PROOF_TABLE_MB = 64
+#Rough size of one proof table entry: the key, its list of four values and the dict slot
+PROOF_ENTRY_BYTES = 200
+#Share of the table kept by a garbage collection
+PROOF_TABLE_KEEP = 0.5
+#Largest solution tree written in a report, in nodes
+MAX_TREE_NODES = 2000
+#Nodes of the VCF search run at each attacker node, 0 to turn it off
+VCF_NODE_LIMIT = 50
+#Initial proof number of an attacker move that makes no four or open three
+QUIET_MOVE_PN = 4
+#Children are searched until their proof (disproof) number is 1 + DFPN_EPSILON times the second best one
+DFPN_EPSILON = 0.25
+#The clock is read once every (TIME_CHECK_INTERVAL + 1) nodes
+TIME_CHECK_INTERVAL = 255
+DEFAULT_CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proof_checkpoints')
+
+PROVEN = 'proven'
+DISPROVEN = 'disproven'
+UNKNOWN = 'unknown'
+
+def get_side_to_move(moves : list) -> bool:
+    return len(moves) == 0 or not moves[-1][2]
+
+def _get_child_key(state : BoardState, move : tuple, black : bool) -> int:
+    #state.hash(not black) after make_move(move, black), without making the move
+    key = state.zobrist_key ^ state.zobrist_cells[move[0] * state.size + move[1]][0 if black else 1]
+    return key ^ state.zobrist_white_to_move if black else key
+
+class ProofTable:
+    #Bounded map position hash -> [pn, dn, work, move], work being the nodes searched below the
+    #position. When the table is full the unsolved entries with the least work are dropped first,
+    #then the solved ones, so that proofs are the last thing to go.
+    def __init__(self, size_mb : float = DEFAULT_PROOF_TABLE_MB):
+        self.size_mb = size_mb
+        self.max_entries = max(64, int(size_mb * 2**20 / PROOF_ENTRY_BYTES))
+        self.entries = {}
+        self.collections = 0
+
+    def get(self, key : int) -> list:
+        return self.entries.get(key)
+
+    def store(self, key : int, pn : int, dn : int, work : int, move : tuple):
+        if key not in self.entries and len(self.entries) >= self.max_entries:
+            self.collect()
+        self.entries[key] = [pn, dn, work, move]
+
+    def collect(self):
+        ranked = sorted(self.entries.items(), key=lambda e: (e[1][0] == 0 or e[1][1] == 0, e[1][2]), reverse=True)
+        self.entries = dict(ranked[:int(self.max_entries * PROOF_TABLE_KEEP)])
+        self.collections += 1
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+class DfpnSolver:
+    #Depth-first proof-number search (df-pn) of whether attacker wins the position reached by
+    #moves, whoever is to move. Both sides may play any empty cell, a four forcing its block, so
+    #proofs and disproofs are exact; the threat moves, the defences of the attacker's open threes and
+    #the cells near the stones are tried first. A position is
+    #decided once the attacker has a five, a four to complete, or the defender faces two fours; a
+    #full board is a failure for the attacker. solve can be called again to continue a search that
+    #ran out of budget, also after a save/load round trip.
+    def __init__(self, moves : list, attacker : bool = None, size : int = 15,
+                table_mb : float = DEFAULT_PROOF_TABLE_MB, state_type : type = BitBoardState,
+                vcf_nodes : int = VCF_NODE_LIMIT):
+        self.moves = [tuple(m) for m in moves]
+        self.attacker = get_side_to_move(self.moves) if attacker is None else attacker
+        self.size = size
+        self.state_type = state_type
+        self.vcf_nodes = vcf_nodes
+        self.table = ProofTable(table_mb)
+        self.nodes = 0
+        self.elapsed = 0.0
+        self.state = None
+
+    def get_state(self) -> BoardState:
+        if self.state is None:
+            self.state = self.state_type(self.size)
+            for c, r, black in self.moves:
+                self.state.make_move((c, r), black)
+        return self.state
+
+    def solve(self, node_limit : int = None, time_limit : float = None) -> str:
+        #node_limit and time_limit bound this call only
+        state = self.get_state()
+        start_time = time.time()
+        self.deadline = None if time_limit is None else start_time + time_limit
+        self.max_nodes = None if node_limit is None else self.nodes + node_limit
+        self.stop = False
+        while self.get_result() == UNKNOWN and not self.stop:
+            self._mid(state, get_side_to_move(self.moves), PN_INFINITY, PN_INFINITY)
+        self.elapsed += time.time() - start_time
+        return self.get_result()
+
+    def get_result(self) -> str:
+        entry = self.table.get(self.get_state().hash(get_side_to_move(self.moves)))
+        if entry is None:
+            return UNKNOWN
+        if entry[0] == 0:
+            return PROVEN
+        if entry[1] == 0:
+            return DISPROVEN
+        return UNKNOWN
+
+    def _expand(self, state : BoardState, black : bool) -> tuple:
+        #(value, moves, n_threats) for black to move: value is the (pn, dn) of a decided position,
+        #else None, and the first n_threats moves make a four or an open three for the attacker.
+        #A position won by the side to move comes with its winning line instead.
+        is_or = black == self.attacker
+        won, lost = ((0, PN_INFINITY), (PN_INFINITY, 0)) if is_or else ((PN_INFINITY, 0), (0, PN_INFINITY))
+        if len((state.b_threats if black else state.w_threats)['winning']) > 0:
+            return won, [], 0
+        if len((state.w_threats if black else state.b_threats)['winning']) > 0:
+            return lost, [], 0
+        own_fours = get_four_cells(state, black)
+        if len(own_fours) > 0:
+            return won, [min(own_fours)], 0
+        opp_fours = get_four_cells(state, not black)
+        if len(opp_fours) > 1:
+            return lost, [], 0
+        if len(opp_fours) == 1:
+            return None, list(opp_fours), 1
+        if is_or and self.vcf_nodes > 0:
+            #a win by continuous fours is proved by the threat space search at a fraction of the cost
+            result, sequence = ThreatSpaceSolver(False, node_limit=self.vcf_nodes).solve(state, black)
+            if result == THREAT_SPACE_WIN:
+                return won, sequence, 0
+
+        #every empty cell is a child, so that proofs and disproofs hold against any move; the threats,
+        #the defences of the attacker's open threes and the moves near the stones come first
+        children = [m for m,_ in gomoku_get_state_children(state, black)]
+        if is_or:
+            threat_moves = get_threat_moves(state, black)
+            moves = threat_moves + children
+        else:
+            threat_moves = []
+            moves = get_three_defences(state, not black) + get_threat_moves(state, black, True) + children
+        moves = [m for m in moves if state.grid[m[0], m[1]] == 0]
+        moves = list(dict.fromkeys(moves + [(int(c), int(r)) for c, r in np.argwhere(state.grid == 0)]))
+        if len(moves) == 0:
+            #a draw is a failure for the attacker
+            return (PN_INFINITY, 0), [], 0
+        return None, moves, len(threat_moves)
+
+    def _check_budget(self):
+        if self.max_nodes is not None and self.nodes >= self.max_nodes:
+            self.stop = True
+        elif self.deadline is not None and (self.nodes & TIME_CHECK_INTERVAL) == 0 and time.time() > self.deadline:
+            self.stop = True
+
+    def _mid(self, state : BoardState, black : bool, th_pn : int, th_dn : int):
+        self.nodes += 1
+        self._check_budget()
+        start_nodes = self.nodes
+        key = state.hash(black)
+        value, moves, n_threats = self._expand(state, black)
+        if value is not None:
+            self.table.store(key, value[0], value[1], 1, moves[0] if len(moves) > 0 else None)
+            return
+
+        is_or = black == self.attacker
+        table = self.table
+        while True:
+            #OR: pn is the smallest child pn, dn the sum of the child dns; AND the other way round
+            pn, dn = (PN_INFINITY, 0) if is_or else (0, PN_INFINITY)
+            best, best_pn, best_dn, second = None, 0, 0, PN_INFINITY
+            for i, move in enumerate(moves):
+                entry = table.get(_get_child_key(state, move, black))
+                if entry is not None:
+                    c_pn, c_dn = entry[0], entry[1]
+                else:
+                    c_pn, c_dn = (1, 1) if not is_or or i < n_threats else (QUIET_MOVE_PN, 1)
+                if is_or:
+                    pn, dn = min(pn, c_pn), min(PN_INFINITY, dn + c_dn)
+                    c_value, b_value = c_pn, best_pn
+                else:
+                    pn, dn = min(PN_INFINITY, pn + c_pn), min(dn, c_dn)
+                    c_value, b_value = c_dn, best_dn
+                if best is None or c_value < b_value:
+                    if best is not None:
+                        second = b_value
+                    best, best_pn, best_dn = move, c_pn, c_dn
+                elif c_value < second:
+                    second = c_value
+
+            if pn >= th_pn or dn >= th_dn or self.stop:
+                break
+            #the 1 + epsilon thresholds keep the search below a child for longer
+            second = min(PN_INFINITY, int(second * (1 + DFPN_EPSILON)) + 1)
+            if is_or:
+                c_th_pn, c_th_dn = min(th_pn, second), th_dn - dn + best_dn
+            else:
+                c_th_pn, c_th_dn = th_pn - pn + best_pn, min(th_dn, second)
+            state.make_move(best, black)
+            self._mid(state, not black, c_th_pn, c_th_dn)
+            state.unmake_last_move()
+        table.store(key, pn, dn, self.nodes - start_nodes + 1, best)
+
+    def get_solution_tree(self, max_nodes : int = MAX_TREE_NODES) -> list:
+        #Proof tree of a proven position (the winning move at the attacker's turns, every defence at
+        #the defender's ones) or disproof tree of a disproven one, as nested
+        #{'move', 'black', 'children'} dicts. Branches beyond max_nodes are marked 'truncated'.
+        result = self.get_result()
+        if result == UNKNOWN:
+            return None
+        self.stop = False
+        self.max_nodes = None
+        self.deadline = None
+        self._tree_budget = max_nodes
+        return self._get_tree(self.get_state(), get_side_to_move(self.moves), result == PROVEN)
+
+    def _get_tree(self, state : BoardState, black : bool, proven : bool) -> list:
+        winner_to_move = (black == self.attacker) == proven
+        value, moves, _ = self._expand(state, black)
+        if value is not None:
+            if not winner_to_move or len(moves) == 0:
+                return []
+            #a five to complete, an open four to make or the main line of a win by continuous fours
+            leaf = {'move' : list(moves[0]), 'black' : black, 'children' : []}
+            if len(moves) > 1:
+                leaf['vcf'] = [list(m) for m in moves]
+            return [leaf]
+
+        if winner_to_move:
+            #entries of the chosen moves can have been dropped from the table, so search them again
+            moves = [self._get_solved_move(state, black, proven)]
+        tree = []
+        for move in moves:
+            node = {'move' : list(move), 'black' : black, 'children' : []}
+            tree.append(node)
+            self._tree_budget -= 1
+            if self._tree_budget <= 0:
+                node['truncated'] = True
+                continue
+            state.make_move(move, black)
+            if self._get_child_value(state, not black, proven) != 0:
+                self._mid(state, not black, PN_INFINITY, PN_INFINITY)
+            node['children'] = self._get_tree(state, not black, proven)
+            state.unmake_last_move()
+        return tree
+
+    def _get_child_value(self, state : BoardState, black : bool, proven : bool) -> int:
+        #pn (dn) of the position for a proof (disproof) tree, None when it is not in the table
+        entry = self.table.get(state.hash(black))
+        return None if entry is None else entry[0 if proven else 1]
+
+    def _get_solved_move(self, state : BoardState, black : bool, proven : bool) -> tuple:
+        entry = self.table.get(state.hash(black))
+        if entry is None or entry[0 if proven else 1] != 0:
+            self._mid(state, black, PN_INFINITY, PN_INFINITY)
+            entry = self.table.get(state.hash(black))
+        return entry[3]
+
+    def save(self, filename : str):
+        #write then rename, so an interrupted run never leaves a truncated checkpoint behind
+        data = {
+            'moves' : self.moves,
+            'attacker' : self.attacker,
+            'size' : self.size,
+            'table_mb' : self.table.size_mb,
+            'vcf_nodes' : self.vcf_nodes,
+            'entries' : self.table.entries,
+            'nodes' : self.nodes,
+            'elapsed' : self.elapsed
+        }
+        with open(filename + '.tmp', 'wb') as file:
+            pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def load(filename : str) -> 'DfpnSolver':
+        with open(filename, 'rb') as file:
+            data = pickle.load(file)
+        solver = DfpnSolver(data['moves'], data['attacker'], data['size'], data['table_mb'], vcf_nodes=data['vcf_nodes'])
+        solver.table.entries = data['entries']
+        solver.nodes = data['nodes']
+        solver.elapsed = data['elapsed']
+        return solver
+
+def solve_positions(positions : list,
+                    node_limit : int = None,
+                    time_limit : float = None,
+                    table_mb : float = DEFAULT_PROOF_TABLE_MB,
+                    checkpoint_dir : str = None,
+                    max_tree_nodes : int = MAX_TREE_NODES) -> list:
+    #positions are {'name', 'moves' : [[c, r, is_black], ...], 'attacker' : 'black' | 'white'}
+    #dicts, attacker defaults to the side to move. Limits apply to each position; with a
+    #checkpoint_dir a position searched before resumes from where its last run stopped.
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+    results = []
+    for i, position in enumerate(positions):
+        name = position.get('name', str(i))
+        attacker = position.get('attacker')
+        attacker = None if attacker is None else attacker == 'black'
+        checkpoint = None if checkpoint_dir is None else os.path.join(checkpoint_dir, '%s.pkl' % (name))
+
+        solver = DfpnSolver(position['moves'], attacker, position.get('size', 15), table_mb)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            #a checkpoint left by another position with the same name is started over
+            stored = DfpnSolver.load(checkpoint)
+            if stored.moves == solver.moves and stored.attacker == solver.attacker:
+                solver = stored
+        result = solver.solve(node_limit, time_limit)
+        if checkpoint is not None:
+            solver.save(checkpoint)
+
+        report = {
+            'name' : name,
+            'attacker' : 'black' if solver.attacker else 'white',
+            'result' : result,
+            'nodes' : solver.nodes,
+            'time' : round(solver.elapsed, 3),
+            'table_entries' : len(solver.table),
+            'table_collections' : solver.table.collections
+        }
+        if result != UNKNOWN:
+            report['tree'] = solver.get_solution_tree(max_tree_nodes)
+        results.append(report)
+        print('%s: %s for %s, %d nodes, %.2f s' % (name, result, report['attacker'], solver.nodes, solver.elapsed))
+    return results
+
+def test_proof_search():
+    import tempfile
+
+    #black three on row 7 plus a broken three on column 8: a win by continuous fours
+    moves = [(7, 5, True), (0, 0, False), (7, 6, True), (0, 2, False), (7, 7, True), (14, 14, False),
+            (9, 8, True), (14, 12, False), (10, 8, True), (0, 14, False), (12, 8, True), (14, 0, False)]
+    solver = DfpnSolver(moves)
+    assert solver.solve(20000) == PROVEN
+    tree = solver.get_solution_tree()
+    #the attacker always has a single move, the defender all its replies
+    node = tree
+    while len(node) > 0:
+        assert len(node) == 1 and node[0]['black']
+        replies = node[0]['children']
+        if len(replies) == 0:
+            break
+        node = replies[0]['children']
+
+    #white, attacking in the same position, can't win it: a disproof
+    solver = DfpnSolver(moves, False)
+    assert solver.solve(20000) == DISPROVEN
+
+    #an interrupted search continues from its checkpoint with the same result
+    moves = [(7, 5, True), (0, 0, False), (7, 6, True), (0, 14, False), (5, 7, True), (14, 0, False), (6, 7, True), (14, 14, False)]
+    reference = DfpnSolver(moves)
+    assert reference.solve(50000) == PROVEN
+    #the proof covers every reply to the double three, not only the defences of the threes
+    state = reference.get_state()
+    state.make_move((7, 7), True)
+    value, replies, _ = reference._expand(state, False)
+    assert value is None and sorted(replies) == sorted([(c, r) for c in range(15) for r in range(15) if state.grid[c, r] == 0])
+    state.unmake_last_move()
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'position.pkl')
+        solver = DfpnSolver(moves)
+        assert solver.solve(5) == UNKNOWN
+        solver.save(filename)
+        solver = DfpnSolver.load(filename)
+        assert solver.solve(50000) == PROVEN
+
+    #a table smaller than the search still proves it, dropping entries as it goes
+    solver = DfpnSolver(moves, table_mb=0.12)
+    assert solver.solve(50000) == PROVEN
+    assert solver.table.collections > 0 and len(solver.table) <= solver.table.max_entries
+    assert solver.get_solution_tree() is not None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prove or disprove a batch of positions with df-pn.')
+    parser.add_argument('positions', nargs='?', help='JSON list of {"name", "moves" : [[c, r, is_black], ...], "attacker"}')
+    parser.add_argument('--out', default=None, help='JSON report with the results and solution trees (default: stdout)')
+    parser.add_argument('--nodes', type=int, default=None, help='node budget per position and run')
+    parser.add_argument('--time', type=float, default=None, help='seconds per position and run')
+    parser.add_argument('--memory-mb', type=float, default=DEFAULT_PROOF_TABLE_MB, help='size of the proof table')
+    parser.add_argument('--checkpoint-dir', default=DEFAULT_CHECKPOINT_DIR, help='each position\'s search state, resumed by the next run')
+    parser.add_argument('--max-tree-nodes', type=int, default=MAX_TREE_NODES)
+    parser.add_argument('--test', action='store_true')
+    args = parser.parse_args()
+
+    if args.test:
+        test_proof_search()
+    if args.positions is not None:
+        with open(args.positions, 'r') as file:
+            positions = json.load(file)
+        results = solve_positions(positions, args.nodes, args.time, args.memory_mb, args.checkpoint_dir, args.max_tree_nodes)
+        if args.out is None:
+            print(json.dumps(results))
+        else:
+            with open(args.out, 'w') as file:
+                json.dump(results, file)
@@ -1,3 +1,6 @@
+import json
+import os
+from ast import literal_eval
 from time import time
 from experiment import Experiment
 
@@ -173,5 +176,93 @@ def run_v1_vs_v2():
     experiment.run()
     print('Experiment took %f to run.' % (round(time() - start_time,3)))    
 
+def run_selective_search():
+    ai_t1_v2 = {
+        'class' : 'ai',
+        'args' : {
+            'search_depth' : None,
+            'time_limit' : 1.0,
+            'search_version' : 2
+        }
+    }
+    ai_t1_v2_sel = {
+        'class' : 'ai',
+        'args' : {
+            'search_depth' : None,
+            'time_limit' : 1.0,
+            'search_version' : 2,
+            'lmr' : True,
+            'null_move' : True
+        }
+    }
+    players_defs = {
+        't1v2' : ai_t1_v2,
+        't1v2sel' : ai_t1_v2_sel
+    }
+    match_list = [
+        ('t1v2','t1v2sel'),
+        ('t1v2sel','t1v2')
+    ]
+
+    start_time = time()
+    experiment =  Experiment('selective-search', player_defs=players_defs, repetitions=25,match_list=match_list)
+    experiment.run()
+    print('Experiment took %f to run.' % (round(time() - start_time,3)))    
+    report_selective_search_depth(experiment.full_path, start_time)
+
+def report_selective_search_depth(experiment_path : str, since : float):
+    #Mean depth of the searches with and without lmr and null moves in the matches of an experiment
+    #saved after since (a time), the directory keeps the matches of the earlier runs too
+    depths = {False : [], True : []}
+    for fname in os.listdir(experiment_path):
+        fpath = os.path.join(experiment_path, fname)
+        if os.path.getmtime(fpath) < since:
+            continue
+        with open(fpath) as file:
+            data = json.load(file)
+        if 'select_color' in data['swap2_data']:
+            names = data['swap2_data']['select_color']
+        else:
+            names = {data['player_data'][n]['start_color'] : n for n in data['player_data']}
+        for mstr, mdata in data['move_data'].items():
+            sdata = mdata.get('search_data')
+            if sdata is None or sdata.get('cached') or sdata['depth'] == 0:
+                continue
+            pdef = data['player_data'][names['black' if literal_eval(mstr)[2] else 'white']]['def']
+            depths[bool(pdef.get('lmr') and pdef.get('null_move'))].append(sdata['depth'])
+    if len(depths[False]) == 0 or len(depths[True]) == 0:
+        return
+    plain, selective = sum(depths[False]) / len(depths[False]), sum(depths[True]) / len(depths[True])
+    print('Mean depth: %.2f plies, %.2f with lmr and null moves (%+.2f).' % (plain, selective, selective - plain))
+
+def run_mcts_vs_ai():
+    mcts_t1 = {
+        'class' : 'mcts',
+        'args' : {
+            'time_limit' : 1.0
+        }
+    }
+    ai_t1_v2 = {
+        'class' : 'ai',
+        'args' : {
+            'search_depth' : None,
+            'time_limit' : 1.0,
+            'search_version' : 2
+        }
+    }
+    players_defs = {
+        'mctst1' : mcts_t1,
+        't1v2' : ai_t1_v2
+    }
+    match_list = [
+        ('mctst1','t1v2'),
+        ('t1v2','mctst1')
+    ]
+
+    start_time = time()
+    experiment =  Experiment('mcts-vs-ai', player_defs=players_defs, repetitions=25,match_list=match_list)
+    experiment.run()
+    print('Experiment took %f to run.' % (round(time() - start_time,3)))    
+
 if __name__ == '__main__':
     run_v1_vs_v2()
\ No newline at end of file
@@ -0,0 +1,198 @@
+import argparse
+import itertools
+import json
+import os
+import re
+import sys
+import time
+
+from multiprocessing import Pool, cpu_count
+from tqdm import tqdm
+from threats import (
+THREAT_DATA_DIR,
+THREAT_DB_FILENAME,
+THREAT_JSON_FILENAME,
+convert_threat_data,
+store_precomputed_threats
+)
+
+WIN_RGX = re.compile('(?<!1)1{5}(?!1)')
+DEFAULT_CHECKPOINT_DIR = os.path.join(THREAT_DATA_DIR, 'threat_data_checkpoints')
+#Each task enumerates at most 2^TASK_SUFFIX_LEN sequences sharing the same prefix
+TASK_SUFFIX_LEN = 12
+
+def is_candidate_sequence(seq : str) -> bool:
+    #Same filter as threats.generate_all_sequences_of_len
+    length = len(seq)
+    if '1' not in seq or '111111' in seq:
+        return False
+    if length > 6 and seq.count('1') >= length - 1:
+        return False
+    return True
+
+def get_threat_level(seq : str) -> int:
+    #Largest number of stones in a window of 5, which is the level precompute_threats
+    #reads from the length 5 table (every non empty window of 5 is a threat)
+    return max([seq.count('1', i, i + 5) for i in range(len(seq) - 4)])
+
+def generate_threat_info_windowed(seq : str, lvl : int) -> tuple:
+    #Same result as threats.generate_threat_info without enumerating the 2^zeros fillings.
+    #A filling with 5 - lvl new stones that leaves exactly one run of five must fill every
+    #empty cell of that run, so it is exactly "complete one window of 5 holding lvl stones
+    #whose neighbours are not stones". Fillings that would need stones outside of the
+    #window are the ones generate_threat_info rejects (more than 5 stones with fewer
+    #than 5 on the line, or a count of new stones different from 5 - lvl).
+    n_wins = len(WIN_RGX.findall(seq))
+    if n_wins == 1:
+        return {seq},set(),set()
+
+    length = len(seq)
+    n_ones = seq.count('1')
+    possible_5s = set()
+    possible_moves = set()
+    n_of_blocks = {}
+    if n_wins == 0 and (n_ones >= 5 or n_ones == lvl):
+        for i in range(length - 4):
+            if seq.count('1', i, i + 5) != lvl:
+                continue
+            if i > 0 and seq[i - 1] == '1':
+                continue
+            if i + 5 < length and seq[i + 5] == '1':
+                continue
+            possible_5s.add(seq[:i] + '11111' + seq[i + 5:])
+            for j in range(i, i + 5):
+                if seq[j] == '0':
+                    possible_moves.add(j)
+                    n_of_blocks[j] = n_of_blocks.get(j, 0) + 1
+
+    zeros_pos = [i for i in range(length) if seq[i] == '0']
+    max_blocks = max([n_of_blocks.get(z, 0) for z in zeros_pos])
+    best_defences = {z for z in zeros_pos if n_of_blocks.get(z, 0) == max_blocks}
+    return possible_5s, possible_moves, best_defences
+
+def compute_threats_with_prefix(length : int, prefix : str) -> dict:
+    threats = {}
+    for suffix in itertools.product('01', repeat=length - len(prefix)):
+        seq = prefix + ''.join(suffix)
+        if not is_candidate_sequence(seq):
+            continue
+        lvl = get_threat_level(seq)
+        p_5s,p_moves,b_def = generate_threat_info_windowed(seq, lvl)
+        sev = len(p_5s)
+        if sev == 0:
+            continue
+        threats[seq] = {'type' : (lvl, sev), 'p_moves' : sorted(p_moves), 'b_def' : sorted(b_def)}
+    return threats
+
+def _compute_task(task : tuple) -> tuple:
+    length, prefix = task
+    return length, compute_threats_with_prefix(length, prefix)
+
+def _get_checkpoint_filename(checkpoint_dir : str, length : int) -> str:
+    return os.path.join(checkpoint_dir, 'threats_len_%d.json' % (length))
+
+def load_checkpoint(checkpoint_dir : str, length : int) -> dict:
+    filename = _get_checkpoint_filename(checkpoint_dir, length)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as file:
+        return json.load(file)
+
+def store_checkpoint(threats : dict, checkpoint_dir : str, length : int):
+    #write then rename, so an interrupted run never leaves a truncated checkpoint behind
+    filename = _get_checkpoint_filename(checkpoint_dir, length)
+    with open(filename + '.tmp', 'w') as file:
+        json.dump(threats, file)
+    os.replace(filename + '.tmp', filename)
+
+def precompute_threats_parallel(max_seq_len : int = 15,
+                                n_workers : int = None,
+                                checkpoint_dir : str = DEFAULT_CHECKPOINT_DIR) -> dict:
+    #Lengths already in checkpoint_dir are loaded instead of recomputed, so an interrupted
+    #run resumes from the last finished length
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    threats = {}
+    tasks = []
+    pending = {}
+    for length in range(5, max_seq_len + 1):
+        done = load_checkpoint(checkpoint_dir, length)
+        if done is not None:
+            threats[str(length)] = done
+            continue
+        prefix_len = max(0, length - TASK_SUFFIX_LEN)
+        prefixes = [''.join(p) for p in itertools.product('01', repeat=prefix_len)]
+        tasks.extend([(length, p) for p in prefixes])
+        pending[length] = len(prefixes)
+        threats[str(length)] = {}
+
+    if len(tasks) > 0:
+        n_workers = cpu_count() if n_workers is None else n_workers
+        with Pool(n_workers) as pool:
+            for length, result in tqdm(pool.imap_unordered(_compute_task, tasks), total=len(tasks)):
+                threats[str(length)].update(result)
+                pending[length] -= 1
+                if pending[length] == 0:
+                    store_checkpoint(threats[str(length)], checkpoint_dir, length)
+    return threats
+
+def compare_threat_tables(threats : dict, other : dict) -> bool:
+    #p_moves and b_def come from sets, so their order is not part of the table
+    if set(threats.keys()) != set(other.keys()):
+        return False
+    for l in threats:
+        if set(threats[l].keys()) != set(other[l].keys()):
+            return False
+        for seq, info in threats[l].items():
+            other_info = other[l][seq]
+            if tuple(info['type']) != tuple(other_info['type']):
+                return False
+            if set(info['p_moves']) != set(other_info['p_moves']):
+                return False
+            if set(info['b_def']) != set(other_info['b_def']):
+                return False
+    return True
+
+def test_windowed_matches_enumeration(max_seq_len : int = 11):
+    from threats import generate_all_sequences_of_len, generate_threat_info
+    for l in range(5, max_seq_len + 1):
+        for seq in generate_all_sequences_of_len(l):
+            lvl = get_threat_level(seq)
+            p_5s,p_moves,b_def = generate_threat_info(seq, lvl)
+            w_p_5s,w_p_moves,w_b_def = generate_threat_info_windowed(seq, lvl)
+            assert set(p_5s) == w_p_5s and set(p_moves) == w_p_moves
+            #b_def is only stored for threats
+            assert len(p_5s) == 0 or set(b_def) == w_b_def
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the threat table used by the engine.')
+    parser.add_argument('--max-len', type=int, default=15, help='longest line segment (19 for 19x19 boards)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--checkpoint-dir', default=DEFAULT_CHECKPOINT_DIR)
+    parser.add_argument('--json', default=None, help='write the table in JSON format to this file (%s for the engine)' % (THREAT_JSON_FILENAME))
+    parser.add_argument('--db', default=None, help='write the table in binary format to this file, converted from --json (%s for the engine)' % (THREAT_DB_FILENAME))
+    parser.add_argument('--check', action='store_true', help='compare the generated table with %s' % (THREAT_JSON_FILENAME))
+    parser.add_argument('--test', action='store_true', help='only compare the window based generator with the enumeration in threats.py')
+    args = parser.parse_args()
+    if args.db is not None and args.json is None:
+        parser.error('--db is converted from the table written to --json')
+
+    if args.test:
+        test_windowed_matches_enumeration()
+        print('window based generator matches the enumeration')
+        sys.exit(0)
+
+    start_time = time.time()
+    threats = precompute_threats_parallel(args.max_len, args.workers, args.checkpoint_dir)
+    print('generated %d threats in %.1f s' % (sum([len(t) for t in threats.values()]), time.time() - start_time))
+
+    if args.check:
+        with open(THREAT_JSON_FILENAME, 'r') as file:
+            reference = json.load(file)
+        print('identical to %s:' % (THREAT_JSON_FILENAME), compare_threat_tables(threats, reference))
+    if args.json is not None:
+        store_precomputed_threats(threats, args.json)
+        if args.db is not None:
+            convert_threat_data(args.json, args.db)
+    elif not args.check:
+        print('nothing written, pass --json (and --db) to store the table')
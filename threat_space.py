@@ -0,0 +1,238 @@
+import threats
+from boardstate import BoardState, deepcopy_boardstate
+
+THREAT_SPACE_WIN = 'win'
+THREAT_SPACE_FAIL = 'fail'
+THREAT_SPACE_UNKNOWN = 'unknown'
+
+#Longest sequences tried, in attacker moves
+VCF_MAX_DEPTH = 12
+VCT_MAX_DEPTH = 6
+#Nodes (attacker and defender moves) searched by find_forced_win before giving up
+THREAT_SPACE_NODE_LIMIT = 4000
+
+#(black, group) -> [(move, n, w)], the upgrades read from the dependency graphs
+_UPGRADES = {}
+
+def _get_upgrades(group : str, black : bool) -> list:
+    key = (black, group)
+    upgrades = _UPGRADES.get(key)
+    if upgrades is None:
+        graph = threats.B_THREAT_DEP if black else threats.W_THREAT_DEP
+        upgrades = graph.upgrades(group)
+        _UPGRADES[key] = upgrades
+    return upgrades
+
+def get_four_cells(state : BoardState, black : bool) -> set:
+    #Cells completing a five for black (white)
+    cells = set()
+    for t in (state.b_threats if black else state.w_threats)['forcing']:
+        if t.info['type'][0] == 4:
+            cells.update(t.get_open_slots())
+    return cells
+
+def get_threat_moves(state : BoardState, black : bool, fours_only : bool = False) -> list:
+    #Moves raising a threat of black (white) to a four or, unless fours_only, to an open three,
+    #strongest first: a move counts the open fours, fours and threes it makes on different lines
+    t_dict = state.b_threats if black else state.w_threats
+    min_n = 3 if fours_only else 2
+    moves = {}
+    for bucket in ('forcing', 'nforcing'):
+        for t in t_dict[bucket]:
+            if t.info['type'][0] < min_n:
+                continue
+            for m, n, w in _get_upgrades(t.group, black):
+                if n >= 4:
+                    rank = moves.setdefault(t.t_func(t.span[0] + m), [0, 0, 0])
+                    rank[0 if w > 1 else 1] += 1
+                elif not fours_only and n == 3 and w >= 2:
+                    rank = moves.setdefault(t.t_func(t.span[0] + m), [0, 0, 0])
+                    rank[2] += 1
+    return sorted(moves, key=lambda m: moves[m], reverse=True)
+
+def get_three_defences(state : BoardState, black : bool) -> list:
+    #Every cell of the windows of the open threes of black (white), best defences first
+    best, others = [], []
+    for t in (state.b_threats if black else state.w_threats)['forcing']:
+        if t.info['type'][0] != 3:
+            continue
+        for m in t.get_counter_moves():
+            if m not in best:
+                best.append(m)
+        for m in t.get_open_slots():
+            if m not in others:
+                others.append(m)
+    return best + [m for m in others if m not in best]
+
+class ThreatSpaceSolver:
+    #Depth-first search of the threat space of one attacker. The attacker only plays moves making a
+    #four (VCF) or also an open three (VCT), the defender only the moves that can stop them: the cell
+    #completing a four, the cells of an open three, or a four of its own. A win is proved when every
+    #defence leads to a double threat; a failure is proved when every line runs into a dead end or
+    #max_depth, and the result is unknown if node_limit runs out first.
+    def __init__(self, vct : bool = True, max_depth : int = None, node_limit : int = THREAT_SPACE_NODE_LIMIT):
+        self.vct = vct
+        self.max_depth = max_depth if max_depth is not None else (VCT_MAX_DEPTH if vct else VCF_MAX_DEPTH)
+        self.node_limit = node_limit
+        self.nodes = 0
+        #position hash -> largest depth at which it was proved a failure
+        self.failed = {}
+
+    def solve(self, state : BoardState, black : bool) -> tuple:
+        #(result, sequence): sequence alternates attacker and defender moves along the main line
+        self.black = black
+        return self._attack(state, self.max_depth)
+
+    def _count_node(self) -> bool:
+        self.nodes += 1
+        return self.node_limit is not None and self.nodes > self.node_limit
+
+    def _attack(self, state : BoardState, depth : int) -> tuple:
+        black = self.black
+        own_fours = get_four_cells(state, black)
+        if len(own_fours) > 0:
+            return THREAT_SPACE_WIN, [next(iter(own_fours))]
+        opp_fours = get_four_cells(state, not black)
+        if len(opp_fours) > 1 or depth == 0:
+            return THREAT_SPACE_FAIL, []
+
+        key = state.hash(black)
+        if self.failed.get(key, -1) >= depth:
+            return THREAT_SPACE_FAIL, []
+        if self._count_node():
+            return THREAT_SPACE_UNKNOWN, []
+
+        moves = get_threat_moves(state, black, not self.vct)
+        if len(opp_fours) == 1:
+            #the attacker has to block, the threats it has left must do the rest
+            moves = list(opp_fours)
+
+        result = THREAT_SPACE_FAIL
+        for move in moves:
+            state.make_move(move, black)
+            m_result, sequence = self._defend(state, depth - 1)
+            state.unmake_last_move()
+            if m_result == THREAT_SPACE_WIN:
+                return THREAT_SPACE_WIN, [move] + sequence
+            if m_result == THREAT_SPACE_UNKNOWN:
+                result = THREAT_SPACE_UNKNOWN
+                if self.node_limit is not None and self.nodes > self.node_limit:
+                    break
+        if result == THREAT_SPACE_FAIL:
+            self.failed[key] = depth
+        return result, []
+
+    def _defend(self, state : BoardState, depth : int) -> tuple:
+        black = self.black
+        if len(get_four_cells(state, not black)) > 0:
+            return THREAT_SPACE_FAIL, []
+        att_fours = get_four_cells(state, black)
+        if len(att_fours) > 1:
+            return THREAT_SPACE_WIN, []
+        if len(att_fours) == 1:
+            replies = list(att_fours)
+        elif self.vct:
+            replies = get_three_defences(state, black)
+            if len(replies) == 0:
+                return THREAT_SPACE_FAIL, []
+            replies += [m for m in get_threat_moves(state, not black, True) if m not in replies]
+        else:
+            return THREAT_SPACE_FAIL, []
+
+        if self._count_node():
+            return THREAT_SPACE_UNKNOWN, []
+        main_line = None
+        for reply in replies:
+            state.make_move(reply, not black)
+            r_result, sequence = self._attack(state, depth)
+            state.unmake_last_move()
+            if r_result != THREAT_SPACE_WIN:
+                return r_result, []
+            if main_line is None:
+                main_line = [reply] + sequence
+        return THREAT_SPACE_WIN, main_line
+
+def find_forced_win(state : BoardState, black : bool, node_limit : int = THREAT_SPACE_NODE_LIMIT, vct : bool = True) -> dict:
+    #Victory by continuous fours, then (if vct) by continuous threats with the nodes left.
+    #The state is searched in place and restored before returning.
+    solver = ThreatSpaceSolver(False, node_limit=node_limit)
+    result, sequence = solver.solve(state, black)
+    nodes = solver.nodes
+    kind = 'vcf'
+    if result != THREAT_SPACE_WIN and vct and (node_limit is None or nodes < node_limit):
+        solver = ThreatSpaceSolver(True, node_limit=None if node_limit is None else node_limit - nodes)
+        vct_result, vct_sequence = solver.solve(state, black)
+        nodes += solver.nodes
+        if vct_result == THREAT_SPACE_WIN or result == THREAT_SPACE_FAIL:
+            result, sequence, kind = vct_result, vct_sequence, 'vct'
+    return {'result' : result, 'sequence' : sequence, 'nodes' : nodes, 'type' : kind}
+
+
+if __name__ == '__main__':
+    import time
+    from boardstate import BitBoardState
+
+    def play(state : BoardState, moves : list, black_first : bool = True) -> BoardState:
+        for i, move in enumerate(moves):
+            state.make_move(move, black_first == (i % 2 == 0))
+        return state
+
+    def check_sequence(state : BoardState, black : bool, sequence : list):
+        #the main line must end with a five or a double four of the attacker
+        state = deepcopy_boardstate(state)
+        play(state, sequence, black)
+        t_dict = state.b_threats if black else state.w_threats
+        assert len(t_dict['winning']) > 0 or len(get_four_cells(state, black)) > 1
+
+    def test_vcf():
+        #black three in a row on 7 and a broken three on column 9 sharing no cell with white's stones
+        state = play(BitBoardState(15), [(7, 5), (0, 0), (7, 6), (0, 2), (7, 7), (14, 14),
+                                        (9, 8), (14, 12), (10, 8), (0, 14), (12, 8), (14, 0)])
+        result = find_forced_win(state, True, vct=False)
+        assert result['result'] == THREAT_SPACE_WIN and result['type'] == 'vcf'
+        check_sequence(state, True, result['sequence'])
+        #white has nothing to attack with
+        assert find_forced_win(state, False)['result'] == THREAT_SPACE_FAIL
+
+    def test_vct():
+        #two open twos crossing at (7, 7): making both open threes at once wins
+        state = play(BitBoardState(15), [(7, 5), (0, 0), (7, 6), (0, 14), (5, 7), (14, 0), (6, 7), (14, 14)])
+        assert find_forced_win(state, True, vct=False)['result'] != THREAT_SPACE_WIN
+        result = find_forced_win(state, True)
+        assert result['result'] == THREAT_SPACE_WIN and result['type'] == 'vct'
+        check_sequence(state, True, result['sequence'])
+
+    def test_counter_four_refutes():
+        #same double three as test_vct, but white answers it with an open four
+        state = play(BitBoardState(15), [(7, 5), (2, 2), (7, 6), (2, 3), (5, 7), (2, 4), (6, 7), (14, 14)])
+        key = state.hash(True)
+        assert find_forced_win(state, True)['result'] != THREAT_SPACE_WIN
+        assert state.hash(True) == key
+
+    def benchmark_solver(n_positions : int = 30):
+        import random
+        rng = random.Random(7)
+        wins, nodes, start = 0, 0, time.time()
+        for _ in range(n_positions):
+            state = BitBoardState(15)
+            black = True
+            for _ in range(rng.randint(10, 30)):
+                while True:
+                    move = (rng.randint(4, 10), rng.randint(4, 10))
+                    if state.grid[move] == 0:
+                        break
+                state.make_move(move, black)
+                black = not black
+            if len(get_four_cells(state, True)) + len(get_four_cells(state, False)) > 0:
+                continue
+            result = find_forced_win(state, black)
+            nodes += result['nodes']
+            if result['result'] == THREAT_SPACE_WIN:
+                wins += 1
+                check_sequence(state, black, result['sequence'])
+        print('%d wins, %d nodes in %.2f s' % (wins, nodes, time.time() - start))
+
+    test_vcf()
+    test_vct()
+    test_counter_four_refutes()
+    benchmark_solver()
@@ -1,10 +1,19 @@
 import itertools
+import os
 import re
-import networkx as nx
 import json 
+import numpy as np
+from collections.abc import Mapping
 from tqdm import tqdm
 from utils import get_index_transform_func
 
+THREAT_DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+THREAT_JSON_FILENAME = os.path.join(THREAT_DATA_DIR, 'threat_data.json')
+THREAT_DB_FILENAME = os.path.join(THREAT_DATA_DIR, 'threat_data.npy')
+#One fixed-size record per slot (see get_threat_slot). n == 0 marks an empty slot,
+#p_moves and b_def hold one bit per position of the sequence.
+THREAT_DB_DTYPE = np.dtype([('n', 'u1'), ('w', 'u1'), ('p_moves', '<u4'), ('b_def', '<u4')])
+
 
 WINNING_THREAT_TYPES = [(5,1)]
 FORCING_THREAT_TYPES = [(4,2),(4,1),(3,3),(3,2)]
@@ -12,6 +21,18 @@ NON_FORCING_THREAT_TYPES = [(3,1)]
 for i in range(1,3):
     NON_FORCING_THREAT_TYPES.extend([(i,j) for j in range(1, 6 - i + 1)])
 
+THREAT_PRIORITY = [
+    [1,1,1,1,1],
+    [2,2,2,2],
+    [3,6,6],
+    [7,8],
+    [8]
+]
+#Which of t_weights a threat score is multiplied by in the static evaluation
+EVAL_FORCING = 0
+EVAL_NFORCING = 1
+EVAL_UNWEIGHTED = 2
+
 def replace_char(string : str, index : int, char):
     return string[:index] + char + string[index + 1:]
 
@@ -101,7 +122,13 @@ def precompute_threats(max_seq_len = 7) -> dict:
             threats[l][s] = {'type' : (lvl, sev), 'p_moves' : list(p_moves), 'b_def' : list(b_def)}
     return threats
 
-def generate_dependency_graph(threats : dict, black : bool = True) -> nx.DiGraph:
+def get_threat_slot(code : int, length : int) -> int:
+    #Sequences of every length are packed one after the other in a dense table:
+    #length l starts at 2^l - 32, and code is the sequence read as a binary number
+    return (1 << length) - 32 + code
+
+def generate_dependency_graph(threats : dict, black : bool = True) -> 'nx.DiGraph':
+    import networkx as nx
     graph = nx.DiGraph()
     graph.add_nodes_from(threats.keys())
     for seq,info in threats.items():
@@ -113,7 +140,178 @@ def store_precomputed_threats(threats, filename = 'threat_data.json'):
     with open(filename, 'w') as file:
         json.dump(threats, file)
 
-def load_precomputed_threats(filename = 'threat_data.json'):
+def convert_threat_data(json_filename : str = THREAT_JSON_FILENAME, db_filename : str = THREAT_DB_FILENAME) -> np.ndarray:
+    with open(json_filename, 'r') as file:
+        l_threats = json.load(file)
+
+    max_len = max([int(l) for l in l_threats.keys()])
+    db = np.zeros(get_threat_slot(0, max_len + 1), dtype=THREAT_DB_DTYPE)
+    for l, seqs in l_threats.items():
+        for seq, info in seqs.items():
+            record = db[get_threat_slot(int(seq, 2), int(l))]
+            record['n'], record['w'] = info['type']
+            record['p_moves'] = sum([1 << int(m) for m in info['p_moves']])
+            record['b_def'] = sum([1 << int(d) for d in info['b_def']])
+
+    if db_filename is not None:
+        np.save(db_filename, db)
+    return db
+
+def load_threat_db(filename : str = THREAT_DB_FILENAME) -> np.ndarray:
+    #The database is memory-mapped read-only, so every process importing this module
+    #shares the same pages instead of parsing its own copy of the JSON table
+    if not os.path.exists(filename):
+        try:
+            convert_threat_data(db_filename=filename)
+        except OSError:
+            return convert_threat_data(db_filename=None)
+    return np.load(filename, mmap_mode='r')
+
+class ThreatData(Mapping):
+    #Read-only view of the threat database for one color, indexed by sequence like the
+    #dictionaries returned by load_precomputed_threats. Info dicts are built on first access.
+    def __init__(self, db : np.ndarray, black : bool = True):
+        self.db = db
+        self.black = black
+        self.stone = '1' if black else '2'
+        self.max_len = (len(db) + 32).bit_length() - 2
+        #slot -> (group, info, class), None for empty slots and False until loaded
+        self.table = [False] * len(db)
+        self._len = None
+
+    def load_slot(self, slot : int) -> tuple:
+        n, w, p_moves, b_def = self.db[slot].tolist()
+        if n == 0:
+            entry = None
+        else:
+            length = (slot + 32).bit_length() - 1
+            code = slot - get_threat_slot(0, length)
+            group = format(code, '0%db' % (length)).replace('1', self.stone)
+            info = {
+                'type' : (n, w),
+                'p_moves' : [i for i in range(length) if p_moves >> i & 1],
+                'b_def' : [i for i in range(length) if b_def >> i & 1],
+                'eval' : get_threat_eval_terms((n, w))
+            }
+            entry = (group, info, _get_threat_class_from_info(info))
+        self.table[slot] = entry
+        return entry
+
+    def get_entry(self, seq : str) -> tuple:
+        length = len(seq)
+        if length < 5 or length > self.max_len:
+            return None
+        try:
+            code = int(seq.replace(self.stone, '1'), 2)
+        except ValueError:
+            return None
+        slot = get_threat_slot(code, length)
+        entry = self.table[slot]
+        if entry is False:
+            entry = self.load_slot(slot)
+        return entry
+
+    def __getitem__(self, seq : str) -> dict:
+        entry = self.get_entry(seq)
+        if entry is None:
+            raise KeyError(seq)
+        return entry[1]
+
+    def __contains__(self, seq) -> bool:
+        return isinstance(seq, str) and self.get_entry(seq) is not None
+
+    def _iter_entries(self):
+        table = self.table
+        for slot in np.flatnonzero(self.db['n']).tolist():
+            entry = table[slot]
+            if entry is False:
+                entry = self.load_slot(slot)
+            yield entry
+
+    def __iter__(self):
+        for entry in self._iter_entries():
+            yield entry[0]
+
+    def items(self):
+        for entry in self._iter_entries():
+            yield entry[0], entry[1]
+
+    def __len__(self) -> int:
+        if self._len is None:
+            self._len = int(np.count_nonzero(self.db['n']))
+        return self._len
+
+def slot_to_sequence(slot : int, stone : str = '1') -> str:
+    length = (slot + 32).bit_length() - 1
+    return format(slot - get_threat_slot(0, length), '0%db' % (length)).replace('1', stone)
+
+class ThreatDependencyGraph:
+    #Same edges as generate_dependency_graph (threat -> threat raised by one of its p_moves)
+    #stored as a CSR adjacency over database slots: the successors of slot s are
+    #targets[offsets[s] : offsets[s + 1]], reached by playing moves[offsets[s] : offsets[s + 1]].
+    def __init__(self, data : ThreatData):
+        self.data = data
+        self.stone = data.stone
+        db = data.db
+        n_slots = len(db)
+
+        sources = np.flatnonzero(db['n'])
+        lengths = np.array([(int(s) + 32).bit_length() - 1 for s in sources], dtype=np.int64)
+        p_moves = db['p_moves'][sources].astype(np.int64)
+
+        edge_src, edge_tgt, edge_move = [], [], []
+        for m in range(data.max_len):
+            has_move = ((p_moves >> m) & 1).astype(bool) & (lengths > m)
+            src = sources[has_move]
+            edge_src.append(src)
+            edge_tgt.append(src + (1 << (lengths[has_move] - 1 - m)))
+            edge_move.append(np.full(len(src), m, dtype=np.uint8))
+
+        edge_src = np.concatenate(edge_src)
+        order = np.argsort(edge_src, kind='stable')
+        self.targets = np.concatenate(edge_tgt)[order].astype(np.int32)
+        self.moves = np.concatenate(edge_move)[order]
+        self.offsets = np.zeros(n_slots + 1, dtype=np.int32)
+        np.cumsum(np.bincount(edge_src, minlength=n_slots), out=self.offsets[1:])
+
+    def _get_slot(self, seq : str) -> int:
+        return get_threat_slot(int(seq.replace(self.stone, '1'), 2), len(seq))
+
+    def successor_slots(self, slot : int) -> np.ndarray:
+        return self.targets[self.offsets[slot] : self.offsets[slot + 1]]
+
+    def successors_with_moves(self, seq : str) -> list:
+        slot = self._get_slot(seq)
+        start, end = self.offsets[slot], self.offsets[slot + 1]
+        return [(slot_to_sequence(t, self.stone), m) 
+                for t, m in zip(self.targets[start:end].tolist(), self.moves[start:end].tolist())]
+
+    def successors(self, seq : str) -> list:
+        return [s for s,_ in self.successors_with_moves(seq)]
+
+    def upgrades(self, seq : str) -> list:
+        #(move, n, w) for every move raising seq, with the type of the threat it becomes
+        slot = self._get_slot(seq)
+        start, end = self.offsets[slot], self.offsets[slot + 1]
+        targets = self.targets[start:end]
+        db = self.data.db
+        return list(zip(self.moves[start:end].tolist(), db['n'][targets].tolist(), db['w'][targets].tolist()))
+
+    def __getitem__(self, seq : str) -> dict:
+        #adjacency in the same form as networkx: {successor : {'move' : m}}
+        return {s : {'move' : m} for s,m in self.successors_with_moves(seq)}
+
+    def __contains__(self, seq) -> bool:
+        return seq in self.data
+
+    def number_of_nodes(self) -> int:
+        #threats plus the sequences they lead to that are not threats themselves
+        return len(np.union1d(np.flatnonzero(self.data.db['n']), self.targets))
+
+    def number_of_edges(self) -> int:
+        return len(self.targets)
+
+def load_precomputed_threats(filename = THREAT_JSON_FILENAME):
     with open(filename, 'r') as file:
         l_threats = json.load(file)
 
@@ -172,10 +370,8 @@ class Threat:
     def __eq__(self, other) -> bool:
         if not isinstance(other,Threat):
             return False        
-        #Check
-        if self.__hash__() == other.__hash__():
-            return True
-        return False
+        #Different spans can share the same hash value, so compare what identifies the threat
+        return self.span == other.span and self.angle == other.angle
 
     def __str__(self) -> str:
         return '(Threat / group = \'%s\', type = %s, span = (%d, %d), angle = %d°)' % (
@@ -186,6 +382,20 @@ class Threat:
             self.angle
             )
 
+def get_threat_eval_terms(type : tuple) -> tuple:
+    #(weight, priority): the threat adds priority * t_weights[weight] to the static evaluation
+    n = type[0] - 1
+    w = type[1] - 1
+    n = n if n <= 4 else 4
+    w = w if w <= 6 - n - 2 else 6 - n - 2
+
+    priority = THREAT_PRIORITY[n][w]
+    if type in FORCING_THREAT_TYPES:
+        return EVAL_FORCING, priority
+    if type in NON_FORCING_THREAT_TYPES:
+        return EVAL_NFORCING, priority
+    return EVAL_UNWEIGHTED, priority
+
 def _get_threat_class(threat:Threat):
     info = threat.info
     return _get_threat_class_from_info(info)
@@ -206,6 +416,19 @@ def _get_threat_class_from_info(info:dict):
     
 
 
+THREAT_DB = load_threat_db()
+B_THREAT_DATA = ThreatData(THREAT_DB, True)
+W_THREAT_DATA = ThreatData(THREAT_DB, False)
+
+def __getattr__(name : str):
+    #The dependency graphs are only built when something asks for them
+    if name == 'B_THREAT_DEP' or name == 'W_THREAT_DEP':
+        graph = ThreatDependencyGraph(B_THREAT_DATA if name == 'B_THREAT_DEP' else W_THREAT_DATA)
+        globals()[name] = graph
+        return graph
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+
 if __name__ == '__main__':
     # start_time = time.time()
     # threats = precompute_threats(15)
@@ -221,6 +444,59 @@ if __name__ == '__main__':
     #     pass
 
     # print('elapsed time:', round(time.time() - start_time,4))
+    def test_threat_db_matches_json():
+        b_threats, w_threats = load_precomputed_threats()
+        db = convert_threat_data(db_filename=None)
+        for threats, data in ((b_threats, ThreatData(db, True)), (w_threats, ThreatData(db, False))):
+            assert len(data) == len(threats)
+            for seq, info in threats.items():
+                assert data[seq]['type'] == info['type']
+                assert set(data[seq]['p_moves']) == set(info['p_moves'])
+                assert set(data[seq]['b_def']) == set(info['b_def'])
+        assert '22222' not in ThreatData(db, True)
+
+    def benchmark_threat_loading():
+        import time
+        import tracemalloc
+        tracemalloc.start()
+        start = time.time()
+        b_threats, w_threats = load_precomputed_threats()
+        elapsed = time.time() - start
+        print('json: %.3f s, %.1f MB allocated' % (elapsed, tracemalloc.get_traced_memory()[0] / 2**20))
+        del b_threats, w_threats
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        start = time.time()
+        db = load_threat_db()
+        b_data, w_data = ThreatData(db, True), ThreatData(db, False)
+        elapsed = time.time() - start
+        print('memory-mapped db: %.3f s, %.1f MB allocated, %.1f MB shared file' % (
+            elapsed, tracemalloc.get_traced_memory()[0] / 2**20, db.nbytes / 2**20))
+        tracemalloc.stop()
+
+    def test_dependency_graph_matches_networkx():
+        b_threats, w_threats = load_precomputed_threats()
+        for threats, data, black in ((b_threats, B_THREAT_DATA, True), (w_threats, W_THREAT_DATA, False)):
+            nx_graph = generate_dependency_graph(threats, black)
+            graph = ThreatDependencyGraph(data)
+            assert graph.number_of_nodes() == nx_graph.number_of_nodes()
+            assert graph.number_of_edges() == nx_graph.number_of_edges()
+            for seq in itertools.islice(threats, 0, None, 97):
+                assert graph[seq] == dict(nx_graph[seq])
+
+    def test_dependency_graph_upgrades():
+        for data, seq in ((B_THREAT_DATA, '0011100'), (W_THREAT_DATA, '0022200')):
+            graph = ThreatDependencyGraph(data)
+            upgrades = graph.upgrades(seq)
+            assert [m for m,_,_ in upgrades] == [m for _,m in graph.successors_with_moves(seq)]
+            #the inner moves make an open four, the outer ones a four with one way to five
+            assert sorted(upgrades) == [(0, 4, 1), (1, 4, 2), (5, 4, 2), (6, 4, 1)]
+
+    test_threat_db_matches_json()
+    test_dependency_graph_matches_networkx()
+    test_dependency_graph_upgrades()
+    benchmark_threat_loading()
     info0 = {'type' : (3,5)}
     assert _get_threat_class_from_info(info0) == 'forcing'
     info0 = {'type' : (3,1)}
@@ -229,8 +505,3 @@ if __name__ == '__main__':
     assert _get_threat_class_from_info(info0) == 'nforcing'
     info0 = {'type' : (5,1)}
     assert _get_threat_class_from_info(info0) == 'winning'
-
-
-B_THREAT_DATA, W_THREAT_DATA = load_precomputed_threats()
-B_THREAT_DEP = generate_dependency_graph(B_THREAT_DATA)
-W_THREAT_DEP = generate_dependency_graph(W_THREAT_DATA)
\ No newline at end of file
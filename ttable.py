@@ -0,0 +1,329 @@
+import atexit
+import os
+import struct
+
+from multiprocessing import shared_memory
+
+TT_EXACT = 0
+TT_LOWER_BOUND = 1
+TT_UPPER_BOUND = 2
+
+DEFAULT_TT_SIZE_MB = 32
+#Rough size of one slot: the list pointer, the entry tuple and the objects it holds
+TT_ENTRY_BYTES = 192
+#Slot of SharedTranspositionTable: check, score and meta words
+SHARED_TT_ENTRY_WORDS = 3
+SHARED_TT_ENTRY_BYTES = 8 * SHARED_TT_ENTRY_WORDS
+#meta word layout
+META_FLAG_SHIFT = 8
+META_GENERATION_SHIFT = 10
+META_MOVE_SHIFT = 18
+META_VALID = 1 << 34
+
+_DOUBLE = struct.Struct('<d')
+_QWORD = struct.Struct('<Q')
+
+class TranspositionTable:
+    def __init__(self, size_mb : float = DEFAULT_TT_SIZE_MB):
+        #Each bucket has two slots: slot 0 is depth-preferred, slot 1 is always-replace.
+        #The number of buckets is the largest power of two that fits in size_mb.
+        n_buckets = max(1, int(size_mb * 1024 * 1024) // (2 * TT_ENTRY_BYTES))
+        self.n_buckets = 1 << (n_buckets.bit_length() - 1)
+        self.mask = self.n_buckets - 1
+        self.size_mb = size_mb
+        self.generation = 0
+        self.clear()
+
+    def clear(self):
+        #Entries are stored as a single tuple per slot, so a reader running in another thread
+        #always sees either the old or the new entry, never half of each.
+        self.slots = [None] * (2 * self.n_buckets)
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.stores = 0
+        self.overwrites = 0
+
+    def new_search(self):
+        #Entries from older searches are kept for probing but no longer protect the depth-preferred slot
+        self.generation += 1
+
+    def probe(self, key : int) -> tuple:
+        index = (key & self.mask) << 1
+        slots = self.slots
+        entry = slots[index]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1:5]
+        other = slots[index + 1]
+        if other is not None and other[0] == key:
+            self.hits += 1
+            return other[1:5]
+
+        self.misses += 1
+        if entry is not None or other is not None:
+            self.collisions += 1
+        return None
+
+    def store(self, key : int, depth : int, score : float, flag : int, move : tuple = None):
+        index = (key & self.mask) << 1
+        slots = self.slots
+        entry = (key, depth, score, flag, move, self.generation)
+        self.stores += 1
+
+        preferred = slots[index]
+        if (preferred is None or
+            preferred[0] == key or
+            depth >= preferred[1] or
+            preferred[5] != self.generation):
+            if preferred is not None and preferred[0] != key:
+                self.overwrites += 1
+            slots[index] = entry
+        else:
+            replaced = slots[index + 1]
+            if replaced is not None and replaced[0] != key:
+                self.overwrites += 1
+            slots[index + 1] = entry
+
+    def get_move(self, key : int) -> tuple:
+        entry = self.probe(key)
+        return entry[3] if entry is not None else None
+
+    def stats(self) -> dict:
+        probes = self.hits + self.misses
+        return {
+            'size_mb' : self.size_mb,
+            'slots' : len(self.slots),
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'collisions' : self.collisions,
+            'stores' : self.stores,
+            'overwrites' : self.overwrites,
+            'hit_rate' : round(self.hits / probes, 4) if probes > 0 else 0.0
+        }
+
+def _encode_move(move : tuple) -> int:
+    return 0 if move is None else ((move[0] << 5) | move[1]) + 1
+
+def _decode_move(code : int) -> tuple:
+    return None if code == 0 else ((code - 1) >> 5, (code - 1) & 31)
+
+class SharedTranspositionTable:
+    #TranspositionTable kept in multiprocessing shared memory, so every search process reads
+    #and writes the same entries. There are no locks: each slot is three 64-bit words
+    #(check, score as float64 bits, meta) with check = key ^ score ^ meta, and a slot torn by
+    #two processes writing it at the same time fails the check and reads as a miss.
+    #Word 0 of the buffer holds the generation, shared by all the processes.
+    def __init__(self, size_mb : float = DEFAULT_TT_SIZE_MB, name : str = None):
+        n_buckets = max(1, int(size_mb * 1024 * 1024) // (2 * SHARED_TT_ENTRY_BYTES))
+        self.n_buckets = 1 << (n_buckets.bit_length() - 1)
+        self.mask = self.n_buckets - 1
+        self.size_mb = size_mb
+        n_bytes = 8 + 2 * self.n_buckets * SHARED_TT_ENTRY_BYTES
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=n_bytes)
+            self.owner_pid = os.getpid()
+            atexit.register(self.close)
+        else:
+            #only the creating process unlinks the memory, attached processes just close it
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner_pid = None
+        self.name = self.shm.name
+        self.words = self.shm.buf.cast('Q')
+        if name is None:
+            self.clear()
+        else:
+            self.reset_stats()
+
+    def __getstate__(self) -> dict:
+        return {'size_mb' : self.size_mb, 'name' : self.name}
+
+    def __setstate__(self, state : dict):
+        self.__init__(state['size_mb'], state['name'])
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.stores = 0
+        self.overwrites = 0
+
+    def clear(self):
+        self.shm.buf[:] = bytes(len(self.shm.buf))
+        self.reset_stats()
+
+    @property
+    def generation(self) -> int:
+        return self.words[0]
+
+    def new_search(self):
+        self.words[0] = (self.words[0] + 1) & 0xFF
+
+    def _read_slot(self, index : int) -> tuple:
+        #returns (key, score bits, meta) of a valid slot, None for empty slots
+        words = self.words
+        meta = words[index + 2]
+        if not meta & META_VALID:
+            return None
+        score_bits = words[index + 1]
+        return words[index] ^ score_bits ^ meta, score_bits, meta
+
+    def probe(self, key : int) -> tuple:
+        index = 1 + ((key & self.mask) << 1) * SHARED_TT_ENTRY_WORDS
+        occupied = False
+        for i in (index, index + SHARED_TT_ENTRY_WORDS):
+            slot = self._read_slot(i)
+            if slot is None:
+                continue
+            occupied = True
+            if slot[0] == key:
+                self.hits += 1
+                meta = slot[2]
+                score = _DOUBLE.unpack(_QWORD.pack(slot[1]))[0]
+                return (meta & 0xFF, score, (meta >> META_FLAG_SHIFT) & 3, _decode_move((meta >> META_MOVE_SHIFT) & 0xFFFF))
+
+        self.misses += 1
+        if occupied:
+            self.collisions += 1
+        return None
+
+    def store(self, key : int, depth : int, score : float, flag : int, move : tuple = None):
+        index = 1 + ((key & self.mask) << 1) * SHARED_TT_ENTRY_WORDS
+        words = self.words
+        generation = words[0]
+        self.stores += 1
+
+        preferred = self._read_slot(index)
+        if not (preferred is None or
+            preferred[0] == key or
+            depth >= (preferred[2] & 0xFF) or
+            (preferred[2] >> META_GENERATION_SHIFT) & 0xFF != generation):
+            index += SHARED_TT_ENTRY_WORDS
+            replaced = self._read_slot(index)
+        else:
+            replaced = preferred
+        if replaced is not None and replaced[0] != key:
+            self.overwrites += 1
+
+        score_bits = _QWORD.unpack(_DOUBLE.pack(score))[0]
+        meta = (META_VALID |
+            min(depth, 0xFF) |
+            flag << META_FLAG_SHIFT |
+            generation << META_GENERATION_SHIFT |
+            _encode_move(move) << META_MOVE_SHIFT)
+        words[index + 1] = score_bits
+        words[index + 2] = meta
+        words[index] = key ^ score_bits ^ meta
+
+    def get_move(self, key : int) -> tuple:
+        entry = self.probe(key)
+        return entry[3] if entry is not None else None
+
+    def stats(self) -> dict:
+        probes = self.hits + self.misses
+        return {
+            'size_mb' : self.size_mb,
+            'slots' : 2 * self.n_buckets,
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'collisions' : self.collisions,
+            'stores' : self.stores,
+            'overwrites' : self.overwrites,
+            'hit_rate' : round(self.hits / probes, 4) if probes > 0 else 0.0
+        }
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, 'words', None) is None:
+            return
+        self.words.release()
+        self.words = None
+        self.shm.close()
+        if self.owner_pid == os.getpid():
+            self.shm.unlink()
+
+
+if __name__ == '__main__':
+    def test_store_probe():
+        tt = TranspositionTable(size_mb=0.01)
+        tt.store(12345, 3, 10.0, TT_EXACT, (7,7))
+        assert tt.probe(12345) == (3, 10.0, TT_EXACT, (7,7))
+        assert tt.probe(54321) is None
+        assert tt.hits == 1 and tt.misses == 1
+
+    def test_replacement_policy():
+        tt = TranspositionTable(size_mb=0.01)
+        k0 = 5
+        k1 = k0 + tt.n_buckets
+        k2 = k0 + 2 * tt.n_buckets
+        tt.store(k0, 4, 1.0, TT_EXACT, (1,1))
+        #shallower entry on the same bucket goes to the always-replace slot
+        tt.store(k1, 2, 2.0, TT_LOWER_BOUND, (2,2))
+        assert tt.probe(k0) == (4, 1.0, TT_EXACT, (1,1))
+        assert tt.probe(k1) == (2, 2.0, TT_LOWER_BOUND, (2,2))
+        tt.store(k2, 1, 3.0, TT_UPPER_BOUND, (3,3))
+        assert tt.probe(k1) is None
+        assert tt.probe(k0) is not None
+        assert tt.collisions == 1
+        #after a new search the old deep entry can be replaced
+        tt.new_search()
+        tt.store(k1, 1, 4.0, TT_EXACT, (4,4))
+        assert tt.probe(k0) is None
+        assert tt.probe(k1) == (1, 4.0, TT_EXACT, (4,4))
+
+    def test_shared_store_probe():
+        tt = SharedTranspositionTable(size_mb=0.01)
+        tt.store(12345, 3, 10.5, TT_EXACT, (7,7))
+        tt.store(777, 2, -2.0, TT_UPPER_BOUND, None)
+        assert tt.probe(12345) == (3, 10.5, TT_EXACT, (7,7))
+        assert tt.probe(777) == (2, -2.0, TT_UPPER_BOUND, None)
+        assert tt.probe(54321) is None
+        tt.close()
+
+    def test_shared_replacement_policy():
+        tt = SharedTranspositionTable(size_mb=0.01)
+        k0 = (1 << 63) + 5
+        k1 = k0 + tt.n_buckets
+        k2 = k0 + 2 * tt.n_buckets
+        tt.store(k0, 4, 1.0, TT_EXACT, (1,1))
+        tt.store(k1, 2, 2.0, TT_LOWER_BOUND, (2,2))
+        assert tt.probe(k0) == (4, 1.0, TT_EXACT, (1,1))
+        assert tt.probe(k1) == (2, 2.0, TT_LOWER_BOUND, (2,2))
+        tt.store(k2, 1, 3.0, TT_UPPER_BOUND, (3,3))
+        assert tt.probe(k1) is None
+        tt.new_search()
+        tt.store(k1, 1, 4.0, TT_EXACT, (4,4))
+        assert tt.probe(k0) is None
+        assert tt.probe(k1) == (1, 4.0, TT_EXACT, (4,4))
+        tt.close()
+
+    def test_shared_torn_write():
+        tt = SharedTranspositionTable(size_mb=0.01)
+        key = 99
+        tt.store(key, 5, 42.0, TT_EXACT, (3,4))
+        index = 1 + ((key & tt.mask) << 1) * SHARED_TT_ENTRY_WORDS
+        #a writer that only got to update the score word of the slot
+        tt.words[index + 1] = _QWORD.unpack(_DOUBLE.pack(-1.0))[0]
+        assert tt.probe(key) is None
+        tt.close()
+
+    def test_shared_across_processes():
+        import multiprocessing as mp
+        tt = SharedTranspositionTable(size_mb=0.01)
+        for method in ('fork', 'spawn'):
+            tt.clear()
+            #with spawn the table is pickled by name and attached again in the child
+            process = mp.get_context(method).Process(target=tt.store, args=(2024, 6, 8.0, TT_LOWER_BOUND, (14,14)))
+            process.start()
+            process.join()
+            assert tt.probe(2024) == (6, 8.0, TT_LOWER_BOUND, (14,14))
+        tt.close()
+
+    test_store_probe()
+    test_replacement_policy()
+    test_shared_store_probe()
+    test_shared_replacement_policy()
+    test_shared_torn_write()
+    test_shared_across_processes()